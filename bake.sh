@@ -0,0 +1,61 @@
+#!/bin/bash
+
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+#
+# Provision a node image: install packages.txt, fetch the tarballs of
+# artifacts.txt into /opt/tarfiles, unpack them as the install layers of
+# install-layers.sh and cache the lxc base rootfs. Run by "yarn-ec2 bake" as
+# root from the directory holding its inputs, with the bake hash as its
+# argument; the hash is recorded in /etc/yarn-ec2-baked so that setup.sh and
+# setup-slave.sh can skip these steps, and the layer hashes in
+# /var/lib/yarn-ec2 so that setup-slave.sh skips the layers.
+#
+
+set -euxo pipefail
+
+exec 1>&2
+
+BAKE_HASH="$1"
+
+sudo apt-get update && sudo apt-get -y upgrade
+
+sudo apt-get install -y `sed '/^#/d' packages.txt`
+
+ARTIFACT_PORT=${ARTIFACT_PORT:-8000}
+ARTIFACT_NODE_ID=0 ARTIFACT_PORT=$ARTIFACT_PORT ARTIFACT_LIST=`pwd`/artifacts.txt \
+    bash fetch-artifacts.sh
+sudo pkill -f "http[.]server $ARTIFACT_PORT" || :
+
+. ./trace.sh
+. ./install-layers.sh
+
+sudo cp -f lxc/share/lxc/templates/* /usr/share/lxc/templates/
+sudo cp -f lxc/etc/default/* /etc/default/
+sudo cp -f lxc/etc/lxc/* /etc/lxc/
+
+### leaves the rootfs in /var/cache/lxc for setup-slave.sh's lxc-create ###
+sudo lxc-create -n bake -t debian -- --release wheezy
+sudo lxc-destroy -f -n bake
+
+sudo apt-get clean
+
+echo "$BAKE_HASH" | sudo tee /etc/yarn-ec2-baked
+
+exit 0
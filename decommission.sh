@@ -0,0 +1,101 @@
+#!/bin/bash
+
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+#
+# Take the racks given as arguments (by id) out of the cluster before their
+# nodes are terminated: their vms are excluded from yarn, their datanodes
+# are decommissioned from hdfs, which moves their blocks to the other racks,
+# and both are then stopped. Run on the master by "yarn-ec2 remove-slaves";
+# fails if hdfs has not finished within $DECOMMISSION_TIMEOUT seconds.
+#
+
+set -euxo pipefail
+
+exec 1>&2
+
+. ~/share/yarn-ec2/trace.sh
+trace_begin decommission
+
+export JAVA_HOME=/usr/lib/jvm/sunjdk
+
+DECOMMISSION_TIMEOUT=${DECOMMISSION_TIMEOUT:-3600}
+
+SSH_OPTS="-o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null"
+
+pushd ~/var/yarn-ec2 > /dev/null
+
+rm -f leaving-racks leaving-vms
+for rack in "$@" ; do
+    echo r"$rack" >> leaving-racks
+    awk -v r=$rack '$1 == "vm" && $2 == r { print $4 }' topology >> leaving-vms
+done
+
+sudo touch /srv/hdfs/conf/excludes /srv/yarn/conf/excludes
+cat /srv/hdfs/conf/excludes leaving-racks | sort -u > excludes
+sudo cp excludes /srv/hdfs/conf/excludes
+cat /srv/yarn/conf/excludes leaving-vms | sort -u > excludes
+sudo cp excludes /srv/yarn/conf/excludes
+rm -f excludes
+
+echo "decommissioning node managers..."
+yarn_wrapper rmadmin -refreshNodes
+echo "decommissioning datanodes..."
+hdfs_wrapper dfsadmin -refreshNodes
+
+function is_decommissioned() {
+    hdfs_wrapper dfsadmin -report > report
+    awk 'NR == FNR { leaving[$1] ; next }
+        /^Hostname:/ { host = $2 }
+        /^Decommission Status/ && host in leaving && $NF != "Decommissioned" { pending++ }
+        END { exit pending > 0 }' leaving-racks report
+}
+
+trace_begin wait-for-decommission
+waited=0
+until is_decommissioned ; do
+    if [ $waited -ge $DECOMMISSION_TIMEOUT ] ; then
+        echo "!!! ERROR !!! datanodes still decommissioning after $waited seconds... exit"
+        exit 1
+    fi
+    sleep 10
+    waited=$(( waited + 10 ))
+done
+rm -f report
+trace_end wait-for-decommission
+
+echo "stopping node managers and datanodes..."
+parallel-ssh --extra-args "-t -t -q $SSH_OPTS" \
+    --timeout 0 \
+    --hosts leaving-vms \
+    --inline \
+    nmstop || :
+parallel-ssh --extra-args "-t -t -q $SSH_OPTS" \
+    --timeout 0 \
+    --hosts leaving-racks \
+    --inline \
+    dnstop || :
+
+rm -f leaving-racks leaving-vms
+
+popd > /dev/null
+
+trace_end decommission
+
+exit 0
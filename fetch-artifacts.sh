@@ -0,0 +1,141 @@
+#!/bin/bash
+
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+#
+# Fetch the tarballs listed in artifacts.txt into /opt/tarfiles.
+#
+# Node 0 (the master) downloads each file from $ARTIFACT_BASE_URL and
+# checks it against its pinned sha256: the one in artifacts.txt, or else the
+# one yarn-ec2 recorded in $ARTIFACT_PINS from an earlier download. Files
+# without a pin are only taken from an https $ARTIFACT_BASE_URL, whose
+# certificate is checked; pinned files may come from any mirror. Every
+# other node i downloads it from node (i - 1) / 2 once that node has it, so
+# files fan out along a binary tree over the cluster network instead of
+# being fetched from S3 by every node. A node waits for its parent at most
+# $ARTIFACT_TIMEOUT seconds in all before fetching the files it still
+# misses from $ARTIFACT_BASE_URL itself. Each node serves /opt/tarfiles over
+# http on $ARTIFACT_PORT, to its own subnet only, until setup.sh stops it.
+# A <file>.sha256 is only written once <file> is complete and verified, and
+# is what children wait for.
+#
+# Run from ~/var/yarn-ec2; the node is located by its primary ip in
+# all-nodes, or by $ARTIFACT_NODE_ID if set.
+#
+
+set -euxo pipefail
+
+exec 1>&2
+
+. `dirname $0`/trace.sh
+trace_begin fetch-artifacts
+
+ARTIFACT_BASE_URL=${ARTIFACT_BASE_URL:-https://s3.amazonaws.com/ubuntu-ursus-packages}
+ARTIFACT_PORT=${ARTIFACT_PORT:-8000}
+ARTIFACT_DIR=${ARTIFACT_DIR:-/opt/tarfiles}
+ARTIFACT_LIST=${ARTIFACT_LIST:-~/share/yarn-ec2/artifacts.txt}
+### <sha256>  <file> lines, deployed by yarn-ec2 through setup-topology.sh ###
+ARTIFACT_PINS=${ARTIFACT_PINS:-~/var/yarn-ec2/artifact-pins}
+### seconds to wait for a parent, over all files, before falling back to ###
+### $ARTIFACT_BASE_URL for the files still missing ###
+ARTIFACT_TIMEOUT=${ARTIFACT_TIMEOUT:-1800}
+DEADLINE=$(( `date +%s` + ARTIFACT_TIMEOUT ))
+
+PRIMARY_IP=`curl http://169.254.169.254/latest/meta-data/local-ipv4`
+MAC=`curl http://169.254.169.254/latest/meta-data/mac`
+CIDR=`curl http://169.254.169.254/latest/meta-data/network/interfaces/macs/$MAC/subnet-ipv4-cidr-block`
+if [ -z "${ARTIFACT_NODE_ID:-}" ] ; then
+    OFFSET=`cat all-nodes | grep -n ^$PRIMARY_IP$ | cut -d: -f1`
+    ARTIFACT_NODE_ID=$(( OFFSET - 1 ))
+fi
+ID=$ARTIFACT_NODE_ID
+PARENT=""
+if [ $ID -gt 0 ] ; then
+    PARENT=`sed -n "$(( (ID - 1) / 2 + 1 ))p" all-nodes`
+fi
+
+sudo mkdir -p $ARTIFACT_DIR
+cd $ARTIFACT_DIR
+
+### serve our copies to our children, and to no one outside our subnet, ###
+### as the security group may open every port to the world ###
+if ! sudo iptables -C INPUT -p tcp --dport $ARTIFACT_PORT ! -s $CIDR -j DROP 2>/dev/null ; then
+    sudo iptables -I INPUT -p tcp --dport $ARTIFACT_PORT ! -s $CIDR -j DROP
+fi
+if ! pgrep -f "http.server $ARTIFACT_PORT" > /dev/null ; then
+    sudo setsid nohup python3 -m http.server $ARTIFACT_PORT --bind $PRIMARY_IP \
+        > /dev/null 2>&1 < /dev/null &
+fi
+
+function is_fetched() {
+### @param file, sha256 ###
+    [ -s $1 -a -s $1.sha256 ] || return 1
+    if [ x"$2" != x"-" ] ; then
+        [ x"`cut -d' ' -f1 $1.sha256`" = x"$2" ] || return 1
+    fi
+    sha256sum --status -c $1.sha256
+}
+
+function fetch_from_parent() {
+### @param file ###
+    until sudo wget -q http://$PARENT:$ARTIFACT_PORT/$1.sha256 -O $1.sha256.part ; do
+        if [ `date +%s` -ge $DEADLINE ] ; then
+            PARENT=""  ### not asked again for the remaining files ###
+            return 1
+        fi
+        sleep 1
+    done
+    sudo wget -q http://$PARENT:$ARTIFACT_PORT/$1 -O $1.part
+    sed "s/ .*$/  $1.part/" $1.sha256.part | sha256sum --status -c
+}
+
+function fetch_from_origin() {
+### @param file, sha256 ###
+    if [ x"$2" = x"-" ] && [ x"${ARTIFACT_BASE_URL%%://*}" != x"https" ] ; then
+        echo "!!! ERROR !!! $1 has no pinned sha256 and $ARTIFACT_BASE_URL is not https... exit"
+        return 1
+    fi
+    sudo wget $ARTIFACT_BASE_URL/$1 -O $1.part
+    sha256sum $1.part | sed "s/ .*$/  $1/" | sudo tee $1.sha256.part
+    if [ x"$2" != x"-" ] ; then
+        echo "$2  $1.part" | sha256sum --status -c
+    fi
+}
+
+sed '/^#/d;/^$/d' $ARTIFACT_LIST | while read file sha256 ; do
+    if [ x"$sha256" = x"-" ] && [ -f $ARTIFACT_PINS ] ; then
+        sha256=`awk -v f=$file '$2 == f { print $1 }' $ARTIFACT_PINS`
+        sha256=${sha256:--}
+    fi
+    if is_fetched $file $sha256 ; then
+        continue
+    fi
+    trace_begin "fetch $file"
+    sudo rm -f $file.sha256
+    if [ -z "$PARENT" ] || ! fetch_from_parent $file ; then
+        fetch_from_origin $file $sha256
+    fi
+    sudo mv -f $file.part $file
+    sudo mv -f $file.sha256.part $file.sha256
+    trace_end "fetch $file"
+done
+
+trace_end fetch-artifacts
+
+exit 0
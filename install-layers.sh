@@ -0,0 +1,121 @@
+#!/bin/bash
+
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+#
+# Install layers shared by setup-slave.sh and bake.sh, sourced by both: the
+# thrift, hadoop and sun jdk tarballs of /opt/tarfiles (see
+# fetch-artifacts.sh) are unpacked into /opt and mounted read-only where the
+# node scripts expect them. A node baked into an image already has its
+# layers, which setup-slave.sh then only mounts again.
+#
+
+### every install layer below records the hash of its inputs in $LAYERS ###
+### and is skipped when that hash has not changed since it was installed ###
+LAYERS=/var/lib/yarn-ec2
+sudo mkdir -p $LAYERS
+
+function layer_hash() {
+### @param tarball... ###
+    ( cd /opt/tarfiles && cat `printf "%s.sha256 " $@` ) | sha256sum | cut -d' ' -f1
+}
+
+function is_installed() {
+### @param layer, hash ###
+    [ x"`cat $LAYERS/$1 2>/dev/null || :`" = x"$2" ]
+}
+
+function begin_install() {
+### @param layer ###
+    sudo rm -f $LAYERS/$1
+}
+
+function end_install() {
+### @param layer, hash ###
+    echo "$2" | sudo tee $LAYERS/$1
+}
+
+function mount_ro() {
+### @param dir, mount_point ###
+    if ! mountpoint -q $2 ; then
+        sudo mkdir -p $2
+        sudo mount --bind -o ro $1 $2
+    fi
+}
+
+HADOOP_TGZ=hadoop-2.2.0.tar.gz
+TAPACK_TGZ=yarn-2.2.0-ta-pack-v1.tar.gz
+SUNJDK_TGZ=jdk-8u121-linux-x64.tar.gz
+THRIFT_TGZ=thrift-0.9.1.tar.gz
+
+trace_begin install-thrift
+THRIFT_HASH=`layer_hash $THRIFT_TGZ`
+if ! is_installed thrift $THRIFT_HASH ; then
+    begin_install thrift
+    sudo umount -l /usr/local/thrift || :
+    sudo rm -rf /opt/thrift*
+    sudo tar xzf /opt/tarfiles/$THRIFT_TGZ -C /opt
+    sudo chown -R root:root /opt/thrift-0.9.1
+    cat <<EOF | sudo tee /etc/ld.so.conf.d/libthrift.conf
+/usr/local/thrift/lib
+
+
+EOF
+    mount_ro /opt/thrift-0.9.1 /usr/local/thrift
+    sudo ldconfig
+    end_install thrift $THRIFT_HASH
+fi
+mount_ro /opt/thrift-0.9.1 /usr/local/thrift
+trace_end install-thrift
+
+trace_begin install-hadoop
+HADOOP_HASH=`layer_hash $HADOOP_TGZ $TAPACK_TGZ $THRIFT_TGZ`
+if ! is_installed hadoop $HADOOP_HASH ; then
+    begin_install hadoop
+    sudo umount -l /usr/local/hd || :
+    sudo rm -rf /opt/yarn*
+    sudo rm -rf /opt/hadoop*
+    sudo tar xzf /opt/tarfiles/$HADOOP_TGZ -C /opt
+    sudo chown -R root:root /opt/hadoop-2.2.0
+    sudo tar xzf /opt/tarfiles/$TAPACK_TGZ -C /opt
+    sudo chown -R root:root /opt/yarn-2.2.0-ta-pack-v1
+    sudo cp /opt/yarn-2.2.0-ta-pack-v1/jobexe/* /opt/hadoop-2.2.0/
+    sudo mv /opt/hadoop-2.2.0/share/hadoop/yarn/hadoop-yarn-server-resourcemanager-2.2.0.jar \
+        /opt/hadoop-2.2.0/share/hadoop/yarn/hadoop-yarn-server-resourcemanager-2.2.0.jar.origin
+    sudo cp /opt/yarn-2.2.0-ta-pack-v1/hadoop-yarn-server-resourcemanager-2.2.0.jar /opt/hadoop-2.2.0/share/hadoop/yarn/
+    sudo cp /opt/yarn-2.2.0-ta-pack-v1/hadoop-yarn-applications-mpirunner-2.2.0.jar /opt/hadoop-2.2.0/
+    sudo cp /opt/yarn-2.2.0-ta-pack-v1/hadoop-yarn-applications-gpu-2.2.0.jar /opt/hadoop-2.2.0/
+    sudo cp /opt/thrift-0.9.1/share/*.jar /opt/hadoop-2.2.0/share/hadoop/yarn/lib/
+    end_install hadoop $HADOOP_HASH
+fi
+mount_ro /opt/hadoop-2.2.0 /usr/local/hd
+trace_end install-hadoop
+
+trace_begin install-sunjdk
+SUNJDK_HASH=`layer_hash $SUNJDK_TGZ`
+if ! is_installed sunjdk $SUNJDK_HASH ; then
+    begin_install sunjdk
+    sudo umount -l /usr/lib/jvm/sunjdk || :
+    sudo rm -rf /opt/jdk*
+    sudo tar xzf /opt/tarfiles/$SUNJDK_TGZ -C /opt
+    sudo chown -R root:root /opt/jdk1.8.0_121
+    end_install sunjdk $SUNJDK_HASH
+fi
+mount_ro /opt/jdk1.8.0_121 /usr/lib/jvm/sunjdk
+trace_end install-sunjdk
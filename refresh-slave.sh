@@ -0,0 +1,135 @@
+#!/bin/bash
+
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+#
+# (Re)write the state of a node that depends on which nodes are in the
+# cluster: hdfs and yarn slaves, /etc/hosts of the node and of its vms, the
+# nat rules of its vms and, on the master, the resource manager's worker
+# list and node excludes, and the rpc handler counts and scheduler bounds
+# that yarn-ec2 sizes from the racks of the cluster (see tune.rc). Run at the
+# end of setup-slave.sh, and by resize.sh on nodes that stay up while others
+# join or leave; running vms are updated in place.
+#
+
+set -euxo pipefail
+
+exec 1>&2
+
+. ~/share/yarn-ec2/trace.sh
+trace_begin refresh-slave
+
+pushd ~/var/yarn-ec2 > /dev/null
+
+ID=`cat my_id`
+GOLDEN=golden
+ROOTFS="/mnt/$GOLDEN/rootfs"
+
+. rack-$ID/tune.rc
+
+awk '$1 == "rack" { print $3 }' topology | sudo tee /srv/hdfs/conf/slaves
+awk '$1 == "vm" { print $4 }' topology | sudo tee /srv/yarn/conf/slaves
+for conf in /mnt/r"$ID"h*/yarn/conf ; do
+    if [ -d $conf ] ; then
+        sudo cp -f /srv/yarn/conf/slaves $conf/
+    fi
+done
+
+### heaps and gc settings are read by the daemon start scripts ###
+for conf in /srv/hdfs/conf /srv/yarn/conf /mnt/r"$ID"h*/yarn/conf ; do
+    if [ -d $conf ] ; then
+        sudo cp -f rack-$ID/tune.rc $conf/
+    fi
+done
+
+sudo cp ~/share/yarn-ec2/hd/conf/hdfs-site.xml /srv/hdfs/conf/hdfs-site.xml
+sudo sed -i "s/dfs.namenode.handler.count.value/$NN_HANDLERS/" \
+    /srv/hdfs/conf/hdfs-site.xml
+sudo sed -i "s/dfs.datanode.handler.count.value/${DN_HANDLERS:-10}/" \
+    /srv/hdfs/conf/hdfs-site.xml
+
+### nodes that left stay excluded until they join again ###
+for conf in /srv/hdfs/conf /srv/yarn/conf ; do
+    sudo touch $conf/excludes
+    grep -vxFf $conf/slaves $conf/excludes > excludes || :
+    sudo cp excludes $conf/excludes
+    rm -f excludes
+done
+
+if [ $ID -eq 0 ] ; then
+    sudo cp ~/share/yarn-ec2/resource-mngr/conf/yarn-site.xml \
+        /srv/yarn/conf/yarn-site.xml
+    sudo sed -i "s/yarn.resourcemanager.scheduler.class.value/`cat ~/etc/yarn-scheduler.txt`/" \
+        /srv/yarn/conf/yarn-site.xml
+    WORKERS=`awk '$1 == "vm" && $2 != 0 { print $4 }' topology | paste -sd, -`
+    sudo sed -i "s/yarn.tetris.hostnames.value/$WORKERS/" \
+        /srv/yarn/conf/yarn-site.xml
+    sudo sed -i "s/yarn.scheduler.minimum-allocation-mb.value/$MIN_ALLOCATION_MB/" \
+        /srv/yarn/conf/yarn-site.xml
+    sudo sed -i "s/yarn.scheduler.maximum-allocation-mb.value/$MAX_ALLOCATION_MB/" \
+        /srv/yarn/conf/yarn-site.xml
+    sudo sed -i "s/yarn.scheduler.minimum-allocation-vcores.value/$MIN_ALLOCATION_VCORES/" \
+        /srv/yarn/conf/yarn-site.xml
+    sudo sed -i "s/yarn.scheduler.maximum-allocation-vcores.value/$MAX_ALLOCATION_VCORES/" \
+        /srv/yarn/conf/yarn-site.xml
+    sudo sed -i "s/yarn.resourcemanager.resource-tracker.client.thread-count.value/$RM_HANDLERS/" \
+        /srv/yarn/conf/yarn-site.xml
+    sudo sed -i "s/yarn.resourcemanager.scheduler.client.thread-count.value/$RM_HANDLERS/" \
+        /srv/yarn/conf/yarn-site.xml
+fi
+
+cat <<EOF | sudo tee /etc/hosts
+127.0.0.1   localhost
+
+4.4.4.4 mashiro
+8.8.8.8 ibuki
+
+# The following lines are desirable for IPv6 capable hosts
+::1     ip6-localhost ip6-loopback
+fe00::0 ip6-localnet
+ff00::0 ip6-mcastprefix
+ff02::1 ip6-allnodes
+ff02::2 ip6-allrouters
+
+
+EOF
+
+cat hosts | sudo tee -a /etc/hosts
+### our own vms are reached at their container addresses ###
+paste -d' ' rack-$ID/vmips rack-$ID/vmaddrs | while read ip addr ; do
+    sudo sed -i "s/^$ip /$addr /" /etc/hosts
+done
+
+sudo sed -i '/ r[0-9]*h[0-9]*$/d' $ROOTFS/etc/hosts
+cat vmhosts | sudo tee -a $ROOTFS/etc/hosts
+awk -v r=$ID '$1 == "vm" && $2 != r { print $5, $6, $2 }' topology | \
+    sort -t. -k1,1n -k2,2n -k3,3n -k4,4n | \
+    awk -f ~/share/yarn-ec2/vm-nat.awk | sudo tee $ROOTFS/etc/yarn-nat.rules > /dev/null
+
+### vms already running get the new files right away ###
+for vm in `sudo lxc-ls --running` ; do
+    sudo lxc-attach -n $vm -- tee /etc/hosts < $ROOTFS/etc/hosts > /dev/null
+    sudo lxc-attach -n $vm -- iptables-restore < $ROOTFS/etc/yarn-nat.rules
+done
+
+popd > /dev/null
+
+trace_end refresh-slave
+
+exit 0
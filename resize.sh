@@ -0,0 +1,130 @@
+#!/bin/bash
+
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+#
+# Bring a running cluster in line with newly deployed node lists, without
+# setting it up again: the nodes given as arguments (by address) are set up
+# and started from scratch, and every other node only has its cluster
+# membership state refreshed by refresh-slave.sh. The resource manager is
+# restarted to pick up the new worker list. Run on the master by
+# "yarn-ec2 add-slaves", and with no arguments by "yarn-ec2 remove-slaves"
+# once the leaving nodes are gone.
+#
+
+set -euxo pipefail
+
+exec 1>&2
+
+. ~/share/yarn-ec2/trace.sh
+trace_begin resize
+
+export JAVA_HOME=/usr/lib/jvm/sunjdk
+
+pushd ~/var/yarn-ec2 > /dev/null
+
+mkdir -p ~/tmp
+
+SSH_OPTS="-o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null -o ConnectTimeout=5"
+export PDSH_SSH_ARGS_APPEND="$SSH_OPTS"
+PDSH="pdsh -S -R ssh -b"
+### port the nodes serve their artifacts on, see fetch-artifacts.sh ###
+ARTIFACT_PORT=${ARTIFACT_PORT:-8000}
+
+echo "resizing YARN on `hostname`..."
+echo "ensuring executable permissions on scripts..."
+find ~/share/yarn-ec2 -regex "^.+\.sh$" | xargs chmod a+x
+~/share/yarn-ec2/setup-topology.sh
+
+printf "%s\n" "$@" | sed '/^$/d' > new-nodes
+grep -vxFf new-nodes all-nodes > old-nodes || :
+
+echo "distributing packages..."
+for node in `cat slaves` ; do
+    echo $node > /dev/null
+    rsync -e "ssh $SSH_OPTS" -az ~/share/yarn-ec2 \
+        $node:~/share &
+    sleep 0.1
+    rsync -e "ssh $SSH_OPTS" -az --exclude 'my_*' ~/var/yarn-ec2 \
+        $node:~/var &
+    sleep 0.1
+done
+
+wait
+
+if [ -s new-nodes ] ; then
+    echo "setting up new cluster nodes..."
+    trace_begin setup-slaves
+    $PDSH -w ^old-nodes "cd ~/var/yarn-ec2 && ARTIFACT_PORT=$ARTIFACT_PORT ~/share/yarn-ec2/fetch-artifacts.sh"
+    $PDSH -w ^new-nodes ARTIFACT_PORT=$ARTIFACT_PORT ~/share/yarn-ec2/setup-slave.sh \
+        2>&1 | tee ~/tmp/setup-slaves.log
+    trace_end setup-slaves
+    echo "stopping artifact servers..."
+    $PDSH -w ^all-nodes "sudo pkill -f 'http[.]server $ARTIFACT_PORT' || :"
+fi
+if [ -s old-nodes ] ; then
+    echo "refreshing existing cluster nodes..."
+    trace_begin refresh-slaves
+    $PDSH -w ^old-nodes ~/share/yarn-ec2/refresh-slave.sh \
+        2>&1 | tee ~/tmp/refresh-slaves.log
+    trace_end refresh-slaves
+fi
+
+### the resource manager only reads yarn.tetris.hostnames, which ###
+### refresh-slave.sh rewrote for the new vm list, when it starts ###
+echo "restarting the resource manager..."
+trace_begin restart-resource-mngr
+rmstop || :
+rmstart
+trace_end restart-resource-mngr
+if [ -s new-nodes ] ; then
+    trace_begin start-slaves
+    $PDSH -w ^new-nodes ~/share/yarn-ec2/start-slave.sh \
+        2>&1 | tee ~/tmp/start-slaves.log
+    trace_end start-slaves
+    echo "starting datanodes and node managers on new cluster nodes..."
+    awk 'NR == FNR { joining[$1] ; next }
+        $1 == "rack" && $4 in joining { print $3 }' new-nodes topology > new-racks
+    awk 'NR == FNR { joining[$1] ; next }
+        $1 == "rack" && $4 in joining { racks[$2] }
+        $1 == "vm" && $2 in racks { print $4 }' new-nodes topology > new-vms
+    parallel-ssh --extra-args "-t -t -q $SSH_OPTS" \
+        --timeout 0 \
+        --hosts new-racks \
+        --inline \
+        dnstart
+    parallel-ssh --extra-args "-t -t -q $SSH_OPTS" \
+        --timeout 0 \
+        --hosts new-vms \
+        --inline \
+        nmstart
+fi
+
+### nodes that joined again are no longer excluded ###
+hdfs_wrapper dfsadmin -refreshNodes || :
+yarn_wrapper rmadmin -refreshNodes || :
+
+echo "marking cluster nodes as provisioned..."
+$PDSH -w ^all-nodes "sudo cp ~/var/yarn-ec2/provision-id /mnt/yarn-ec2-provisioned"
+
+popd > /dev/null
+
+trace_end resize
+
+exit 0
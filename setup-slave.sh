@@ -22,18 +22,30 @@ set -euxo pipefail
 
 exec 1>&2
 
-sudo apt-get update && sudo apt-get -y upgrade
-
-sudo apt-get install -y csh wget curl vim git realpath tree htop lynx libsnappy1v5 \
-    lxc lvm2 xfsprogs pssh gcc g++ make gdb libboost-all-dev
+. ~/share/yarn-ec2/trace.sh
+trace_begin setup-slave
 
 pushd ~/var/yarn-ec2 > /dev/null
 
+### nodes launched from an image baked from the same inputs have it all ###
+trace_begin packages
+if [ x"`cat /etc/yarn-ec2-baked 2>/dev/null || :`" != x"`cat bake-hash`" ] ; then
+    sudo apt-get update && sudo apt-get -y upgrade
+    sudo apt-get install -y `sed '/^#/d' ~/share/yarn-ec2/packages.txt`
+fi
+trace_end packages
+
+### vms are overlay clones of the golden container, which goes last ###
+trace_begin cleanup
+GOLDEN=golden
 for vm in `sudo lxc-ls` ; do
-    sudo lxc-stop -k -n $vm || :
-    sudo lxc-destroy -f -n $vm
-    sleep 0.1
+    if [ x"$vm" != x"$GOLDEN" ] ; then
+        sudo lxc-stop -k -n $vm || :
+        sudo lxc-destroy -f -n $vm
+        sleep 0.1
+    fi
 done
+sudo lxc-destroy -f -n $GOLDEN || :
 
 sudo service lxc stop
 sudo service lxc-net stop
@@ -44,126 +56,76 @@ sleep 0.1
 sudo rm -rf /tmp/Jetty*
 sudo rm -rf /tmp/hadoop*
 sudo rm -rf /tmp/yarn*
+trace_end cleanup
+
+~/share/yarn-ec2/fetch-artifacts.sh
+
+. ~/share/yarn-ec2/install-layers.sh
+
+### the link trees also change with this script ###
+trace_begin install-links
+LINKS_HASH=`( echo $HADOOP_HASH ; cat $0 ) | sha256sum | cut -d' ' -f1`
+if ! is_installed links $LINKS_HASH ; then
+    begin_install links
+    sudo rm -rf /srv/hdfs*
+    sudo rm -rf /srv/yarn*
+
+    sudo mkdir /srv/hdfs
+
+    sudo ln -s /usr/local/hd/bin /srv/hdfs/
+    sudo ln -s /usr/local/hd/lib /srv/hdfs/
+    sudo ln -s /usr/local/hd/libexec /srv/hdfs/
+    sudo ln -s /usr/local/hd/sbin /srv/hdfs/
+    sudo ln -s /usr/local/hd/share /srv/hdfs/
+
+    sudo mkdir /srv/hdfs/logs
+    sudo mkdir /srv/hdfs/conf
+
+    sudo ln -s /usr/local/hd/etc/hadoop/* /srv/hdfs/conf/
+
+    sudo rm -f /srv/hdfs/conf/core-site.xml
+    sudo rm -f /srv/hdfs/conf/hdfs-site.xml
+    sudo rm -f /srv/hdfs/conf/container*
+    sudo rm -f /srv/hdfs/conf/httpfs*
+    sudo rm -f /srv/hdfs/conf/mapred*
+    sudo rm -f /srv/hdfs/conf/yarn*
+    sudo rm -f /srv/hdfs/conf/*-scheduler.xml
+    sudo rm -f /srv/hdfs/conf/*example
+    sudo rm -f /srv/hdfs/conf/*cmd
+
+    sudo mkdir /srv/yarn
+
+    sudo ln -s /usr/local/hd/bin /srv/yarn/
+    sudo ln -s /usr/local/hd/lib /srv/yarn/
+    sudo ln -s /usr/local/hd/libexec /srv/yarn/
+    sudo ln -s /usr/local/hd/sbin /srv/yarn/
+    sudo ln -s /usr/local/hd/share /srv/yarn/
+    sudo ln -s /usr/local/hd/hadoop-yarn-applications-* /srv/yarn/
+    sudo ln -s /usr/local/hd/bt* /srv/yarn/
+    sudo ln -s /usr/local/hd/cg* /srv/yarn/
+    sudo ln -s /usr/local/hd/ft* /srv/yarn/
+    sudo ln -s /usr/local/hd/sp* /srv/yarn/
+
+    sudo mkdir /srv/yarn/logs
+    sudo mkdir /srv/yarn/conf
+    sudo mkdir /srv/yarn/local  ### mount point of the per-vm local dirs ###
+
+    sudo ln -s /usr/local/hd/etc/hadoop/* /srv/yarn/conf/
+
+    sudo rm -f /srv/yarn/conf/core-site.xml
+    sudo rm -r /srv/yarn/conf/yarn-site.xml
+    sudo rm -f /srv/yarn/conf/hdfs*
+    sudo rm -f /srv/yarn/conf/httpfs*
+    sudo rm -f /srv/yarn/conf/mapred*
+    sudo rm -f /srv/yarn/conf/*example
+    sudo rm -f /srv/yarn/conf/*cmd
+    end_install links $LINKS_HASH
+fi
+trace_end install-links
 
-sudo mkdir -p /opt/tarfiles
-
-sudo rm -rf /opt/yarn*
-sudo rm -rf /opt/thrift*
-sudo rm -rf /opt/hadoop*
-sudo rm -rf /opt/jdk*
-
-HADOOP_TGZ=hadoop-2.2.0.tar.gz
-HADOOP_URL=https://s3.amazonaws.com/ubuntu-ursus-packages/$HADOOP_TGZ
-[ ! -e /opt/tarfiles/$HADOOP_TGZ -o ! -s /opt/tarfiles/$HADOOP_TGZ ] && \
-sudo wget --no-check-certificate $HADOOP_URL -O /opt/tarfiles/$HADOOP_TGZ
-sudo tar xzf /opt/tarfiles/$HADOOP_TGZ -C /opt
-sudo chown -R root:root /opt/hadoop-2.2.0
-sudo umount -l /usr/local/hd || :
-sudo mkdir -p /usr/local/hd
-sudo mount --bind -o ro /opt/hadoop-2.2.0 /usr/local/hd
-
-TAPACK_TGZ=yarn-2.2.0-ta-pack-v1.tar.gz
-TAPACK_URL=https://s3.amazonaws.com/ubuntu-ursus-packages/$TAPACK_TGZ
-[ ! -e /opt/tarfiles/$TAPACK_TGZ -o ! -s /opt/tarfiles/$TAPACK_TGZ ] && \
-    sudo wget --no-check-certificate $TAPACK_URL -O /opt/tarfiles/$TAPACK_TGZ
-sudo tar xzf /opt/tarfiles/$TAPACK_TGZ -C /opt
-sudo chown -R root:root /opt/yarn-2.2.0-ta-pack-v1
-sudo cp /opt/yarn-2.2.0-ta-pack-v1/jobexe/* /opt/hadoop-2.2.0/
-sudo mv /opt/hadoop-2.2.0/share/hadoop/yarn/hadoop-yarn-server-resourcemanager-2.2.0.jar \
-    /opt/hadoop-2.2.0/share/hadoop/yarn/hadoop-yarn-server-resourcemanager-2.2.0.jar.origin
-sudo cp /opt/yarn-2.2.0-ta-pack-v1/hadoop-yarn-server-resourcemanager-2.2.0.jar /opt/hadoop-2.2.0/share/hadoop/yarn/
-sudo cp /opt/yarn-2.2.0-ta-pack-v1/hadoop-yarn-applications-mpirunner-2.2.0.jar /opt/hadoop-2.2.0/
-sudo cp /opt/yarn-2.2.0-ta-pack-v1/hadoop-yarn-applications-gpu-2.2.0.jar /opt/hadoop-2.2.0/
-
-SUNJDK_TGZ=jdk-8u121-linux-x64.tar.gz
-SUNJDK_URL=https://s3.amazonaws.com/ubuntu-ursus-packages/$SUNJDK_TGZ
-[ ! -e /opt/tarfiles/$SUNJDK_TGZ -o ! -s /opt/tarfiles/$SUNJDK_TGZ ] && \
-    sudo wget --no-check-certificate $SUNJDK_URL -O /opt/tarfiles/$SUNJDK_TGZ
-sudo tar xzf /opt/tarfiles/$SUNJDK_TGZ -C /opt
-sudo chown -R root:root /opt/jdk1.8.0_121
-sudo umount -l /usr/lib/jvm/sunjdk || :
-sudo mkdir -p /usr/lib/jvm/sunjdk
-sudo mount --bind -o ro /opt/jdk1.8.0_121 /usr/lib/jvm/sunjdk
-
-THRIFT_TGZ=thrift-0.9.1.tar.gz
-THRIFT_URL=https://s3.amazonaws.com/ubuntu-ursus-packages/$THRIFT_TGZ
-[ ! -e /opt/tarfiles/$THRIFT_TGZ -o ! -s /opt/tarfiles/$THRIFT_TGZ ] && \
-    sudo wget --no-check-certificate $THRIFT_URL -O /opt/tarfiles/$THRIFT_TGZ
-sudo tar xzf /opt/tarfiles/$THRIFT_TGZ -C /opt
-sudo chown -R root:root /opt/thrift-0.9.1
-sudo umount -l /usr/local/thrift || :
-sudo mkdir -p /usr/local/thrift
-sudo mount --bind -o ro /opt/thrift-0.9.1 /usr/local/thrift
-sudo cp /opt/thrift-0.9.1/share/*.jar /opt/hadoop-2.2.0/share/hadoop/yarn/lib/
-
-cat <<EOF | sudo tee /etc/ld.so.conf.d/libthrift.conf
-/usr/local/thrift/lib
-
-
-EOF
-
-sudo ldconfig
-
-sudo rm -rf /srv/hdfs*
-sudo rm -rf /srv/yarn*
-
-sudo mkdir /srv/hdfs
-
-sudo ln -s /usr/local/hd/bin /srv/hdfs/
-sudo ln -s /usr/local/hd/lib /srv/hdfs/
-sudo ln -s /usr/local/hd/libexec /srv/hdfs/
-sudo ln -s /usr/local/hd/sbin /srv/hdfs/
-sudo ln -s /usr/local/hd/share /srv/hdfs/
-
-sudo mkdir /srv/hdfs/logs
-sudo mkdir /srv/hdfs/conf
-
-sudo ln -s /usr/local/hd/etc/hadoop/* /srv/hdfs/conf/
-
-sudo rm -f /srv/hdfs/conf/core-site.xml
-sudo rm -f /srv/hdfs/conf/hdfs-site.xml
-sudo rm -f /srv/hdfs/conf/container*
-sudo rm -f /srv/hdfs/conf/httpfs*
-sudo rm -f /srv/hdfs/conf/mapred*
-sudo rm -f /srv/hdfs/conf/yarn*
-sudo rm -f /srv/hdfs/conf/*-scheduler.xml
-sudo rm -f /srv/hdfs/conf/*example
-sudo rm -f /srv/hdfs/conf/*cmd
-
-sudo rm -f /srv/hdfs/conf/slaves
-cat hosts | fgrep r | fgrep -v h | cut -d' ' -f2 | sudo tee /srv/hdfs/conf/slaves
 echo "r0" | sudo tee /srv/hdfs/conf/boss
 sudo cp ~/share/yarn-ec2/hd/conf/core-site.xml /srv/hdfs/conf/
-sudo cp ~/share/yarn-ec2/hd/conf/hdfs-site.xml /srv/hdfs/conf/
-
-sudo mkdir /srv/yarn
-
-sudo ln -s /usr/local/hd/bin /srv/yarn/
-sudo ln -s /usr/local/hd/lib /srv/yarn/
-sudo ln -s /usr/local/hd/libexec /srv/yarn/
-sudo ln -s /usr/local/hd/sbin /srv/yarn/
-sudo ln -s /usr/local/hd/share /srv/yarn/
-sudo ln -s /usr/local/hd/hadoop-yarn-applications-* /srv/yarn/
-sudo ln -s /usr/local/hd/bt* /srv/yarn/
-sudo ln -s /usr/local/hd/cg* /srv/yarn/
-sudo ln -s /usr/local/hd/ft* /srv/yarn/
-sudo ln -s /usr/local/hd/sp* /srv/yarn/
-
-sudo mkdir /srv/yarn/logs
-sudo mkdir /srv/yarn/conf
-
-sudo ln -s /usr/local/hd/etc/hadoop/* /srv/yarn/conf/
-
-sudo rm -f /srv/yarn/conf/core-site.xml
-sudo rm -r /srv/yarn/conf/yarn-site.xml
-sudo rm -f /srv/yarn/conf/hdfs*
-sudo rm -f /srv/yarn/conf/httpfs*
-sudo rm -f /srv/yarn/conf/mapred*
-sudo rm -f /srv/yarn/conf/*example
-sudo rm -f /srv/yarn/conf/*cmd
-
-sudo rm -f /srv/yarn/conf/slaves
-cat hosts | fgrep r | fgrep h | cut -d' ' -f2 | sudo tee /srv/yarn/conf/slaves
+
 echo "r0" | sudo tee /srv/yarn/conf/boss
 sudo cp ~/share/yarn-ec2/hd/conf/core-site.xml /srv/yarn/conf/
 
@@ -182,41 +144,18 @@ CIDR=`curl http://169.254.169.254/latest/meta-data/network/interfaces/macs/$MAC/
 echo "$CIDR" > my_cidr
 PRIVATE_IPS=`curl http://169.254.169.254/latest/meta-data/network/interfaces/macs/$MAC/local-ipv4s`
 echo "$PRIVATE_IPS" > my_ips
-OFFSET=`cat all-nodes | grep -n ^$PRIMARY_IP$ | cut -d: -f1`
-ID=$(( OFFSET - 1 ))
+### our rack, which yarn-ec2 keeps across resizes, not our place in all-nodes ###
+ID=`awk -v ip=$PRIMARY_IP '$1 == "rack" && $4 == ip { print $2 }' topology`
+if [ -z "$ID" ] ; then
+    echo "!!! ERROR !!! $PRIMARY_IP is not in the topology... exit"
+    exit 1
+fi
 echo "$ID" > my_id
 
-MASK=`echo $CIDR | cut -d/ -f2`
 DEV=`ls -1 /sys/class/net/ | fgrep -v lxc | fgrep -v lo | head -1`
 echo "$DEV" > my_nic
 
-sudo ip link set dev $DEV mtu 1500
-
-sudo ip addr show dev $DEV
-sudo ip addr flush secondary dev $DEV
-for ipv4 in `cat my_ips` ; do
-    if [ x"$ipv4" != x"$PRIMARY_IP" ] ; then
-        sudo ip addr add $ipv4/$MASK brd + dev $DEV
-    fi
-done
-sudo ip addr show dev $DEV
-
-cat <<EOF | sudo tee /etc/hosts
-127.0.0.1   localhost
-
-4.4.4.4 mashiro
-8.8.8.8 ibuki
-
-# The following lines are desirable for IPv6 capable hosts
-::1     ip6-localhost ip6-loopback
-fe00::0 ip6-localnet
-ff00::0 ip6-mcastprefix
-ff02::1 ip6-allnodes
-ff02::2 ip6-allrouters
-
-
-EOF
-
+### rewritten by refresh-slave.sh once the vms exist ###
 cat hosts | sudo tee -a /etc/hosts
 HOSTNAME=`echo r"$ID"`
 echo $HOSTNAME | sudo tee /etc/hostname
@@ -239,6 +178,7 @@ function try_fgrep() {
     fgrep $@ || :
 }
 
+trace_begin disks
 XFS_MOUNT_OPTS="defaults,noatime,nodiratime,allocsize=8m"
 DISKS=`lsblk -ln | fgrep disk | cut -d' ' -f1 | try_fgrep -v da`
 echo -n "$DISKS" | awk '{print "/dev/" $0}' > my_disks
@@ -270,7 +210,7 @@ if [ $NUM_DISKS -gt 0 ] ; then
         -n $LV_NAME $VG_NAME
     sleep 0.1
     if [ -e $LV ] ; then
-        sudo mkfs.xfs -f $LV
+        sudo mkfs.xfs -f -n ftype=1 $LV  ### ftype=1 is required by overlayfs ###
         sudo mount -o $XFS_MOUNT_OPTS $LV /mnt
     fi
 fi
@@ -280,6 +220,7 @@ sudo mkdir /mnt/hdscratch
 sudo lsblk
 
 sudo df -h
+trace_end disks
 
 NUM_CPUS=`cat /proc/cpuinfo | fgrep proc | wc -l`
 echo "$NUM_CPUS" > my_ncpus
@@ -289,46 +230,58 @@ sudo cp -f ~/share/yarn-ec2/lxc/etc/default/* /etc/default/
 sudo cp -f ~/share/yarn-ec2/lxc/etc/lxc/* /etc/lxc/
 
 function setup_vm_iptables() {
-### @param rack_id, host_id ###
-    VM_NAME=`echo r"$1"h"$2"`
-    IFCONF="/mnt/$VM_NAME/rootfs/etc/network/interfaces"
-    echo "post-up iptables -t nat -F" | sudo tee -a $IFCONF
-    echo "post-up tc qdisc add dev eth0 root handle 1: htb default 1" \
-        | sudo tee -a $IFCONF
-    echo "post-up tc class add dev eth0 parent 1: classid 1:1 htb rate 1250mbit ceil 1250mbit" \
-        | sudo tee -a $IFCONF
-    cat hosts | try_fgrep h | while read ln ; do
-        PEER_NAME=`echo $ln | cut -d' ' -f2`
-        PEER_RACK=`echo $PEER_NAME | cut -dr -f2 | cut -dh -f1`
-        PEER_HOST=`echo $PEER_NAME | cut -dr -f2 | cut -dh -f2`
-        if [ $1 -ne $PEER_RACK ] ; then
-            PEER_ID=$(( PEER_HOST + PEER_RACK * 10 + 100))
-            PEER_IP=`echo $ln | cut -d' ' -f1`
-            echo -n "post-up iptables -t nat -A OUTPUT " | sudo tee -a $IFCONF
-            echo "-d 192.168.1.$PEER_ID -j DNAT --to $PEER_IP" | sudo tee -a $IFCONF
-            echo -n "post-up iptables -t nat -A INPUT " | sudo tee -a $IFCONF
-            echo "-s $PEER_IP -j SNAT --to 192.168.1.$PEER_ID" | sudo tee -a $IFCONF
-        fi
-    done
+### @param rack_id ###
+    ROOTFS="/mnt/$GOLDEN/rootfs"
+    ### /etc/yarn-nat.rules itself is written by refresh-slave.sh ###
+    VM_LINK=`cat rack-$1/vmlink`
+    cat <<EOF | sudo tee -a $ROOTFS/etc/network/interfaces
+post-up iptables-restore < /etc/yarn-nat.rules
+post-up tc qdisc add dev eth0 root handle 1: htb default 1
+post-up tc class add dev eth0 parent 1: classid 1:1 htb rate ${VM_LINK}mbit ceil ${VM_LINK}mbit
+EOF
+}
+
+function create_golden_vm() {
+### @param rack_id ###
+    sudo lxc-create -n $GOLDEN -t debian -- \
+        --release wheezy  ### --packages ??? ###
+    ROOTFS="/mnt/$GOLDEN/rootfs"
+    sudo cp -r ~/.ssh $ROOTFS/root/
+    sudo chown -R root:root $ROOTFS/root/.ssh
+    sudo cp -f /etc/ssh/ssh_config $ROOTFS/etc/ssh/
+    sudo cp -f /etc/profile $ROOTFS/etc/
+    setup_vm_iptables $1
+}
+
+function setup_vm_conf() {
+### @param vm_name, vmem, nvcores ###
+    VM_CONF="/mnt/$1/yarn/conf"
+    sudo rm -rf $VM_CONF
+    sudo mkdir -p $VM_CONF
+    sudo cp -a /srv/yarn/conf/. $VM_CONF/
+    sudo rm -f $VM_CONF/yarn-site.xml
+    sudo cp ~/share/yarn-ec2/node-mngr/conf/yarn-site.xml $VM_CONF/
+    sudo sed -i "s/yarn.nodemanager.hostname.value/$1/" $VM_CONF/yarn-site.xml
+    sudo sed -i "s/yarn.nodemanager.resource.cpu-vcores.value/$3/" $VM_CONF/yarn-site.xml
+    sudo sed -i "s/yarn.nodemanager.resource.memory-mb.value/$2/" $VM_CONF/yarn-site.xml
 }
 
 function create_vm() {
 ### @param rack_id, host_id, ip, mem, ncpus, vmem, nvcores ###
     VM_NAME=`echo r"$1"h"$2"`
-    sudo lxc-create -n $VM_NAME -t debian -- \
-        --release wheezy  ### --packages ??? ###
-    sudo cp -r ~/.ssh /mnt/$VM_NAME/rootfs/root/
-    sudo chown -R root:root /mnt/$VM_NAME/rootfs/root/.ssh
-    sudo cp -f /etc/ssh/ssh_config /mnt/$VM_NAME/rootfs/etc/ssh/
-    sudo cp -f /etc/profile /mnt/$VM_NAME/rootfs/etc/
-    sudo cp -r /srv/yarn /srv/yarn-$VM_NAME
-    sudo rm -f /srv/yarn-$VM_NAME/conf/yarn-site.xml
-    sudo cp ~/share/yarn-ec2/node-mngr/conf/yarn-site.xml /srv/yarn-$VM_NAME/conf/
-    sudo sed -i "s/yarn.nodemanager.hostname.value/$VM_NAME/" /srv/yarn-$VM_NAME/conf/yarn-site.xml
-    sudo sed -i "s/yarn.nodemanager.resource.cpu-vcores.value/$7/" /srv/yarn-$VM_NAME/conf/yarn-site.xml
-    sudo sed -i "s/yarn.nodemanager.resource.memory-mb.value/$6/" /srv/yarn-$VM_NAME/conf/yarn-site.xml
-    echo "lxc.mount.entry = /srv/yarn-$VM_NAME srv/yarn none rw,bind,create=dir" | \
-         sudo tee -a /mnt/$VM_NAME/config
+    trace_begin "create-vm $VM_NAME"
+    sudo lxc-copy -n $GOLDEN -N $VM_NAME -s -B overlayfs
+    setup_vm_conf $VM_NAME $6 $7
+    ### all vms share the read-only /srv/yarn, over which their own ###
+    ### conf, logs and local dirs are mounted ###
+    VM_YARN="/mnt/$VM_NAME/yarn"
+    sudo mkdir -p $VM_YARN/logs $VM_YARN/local
+    cat <<EOF | sudo tee -a /mnt/$VM_NAME/config
+lxc.mount.entry = /srv/yarn srv/yarn none ro,bind,create=dir
+lxc.mount.entry = $VM_YARN/conf srv/yarn/conf none ro,bind
+lxc.mount.entry = $VM_YARN/logs srv/yarn/logs none rw,bind
+lxc.mount.entry = $VM_YARN/local srv/yarn/local none rw,bind
+EOF
     sudo sed -i "/lxc.network.ipv4 =/c lxc.network.ipv4 = $3" \
         /mnt/$VM_NAME/config
     sudo sed -i "/lxc.cgroup.memory.max_usage_in_bytes =/c lxc.cgroup.memory.max_usage_in_bytes = ${4}M" \
@@ -340,31 +293,29 @@ function create_vm() {
     VM_CPUS=`echo "$core_begin"-"$core_end"`
     sudo sed -i "/lxc.cgroup.cpuset.cpus =/c lxc.cgroup.cpuset.cpus = $VM_CPUS" \
         /mnt/$VM_NAME/config
-    cat vmhosts | sudo tee -a /mnt/$VM_NAME/rootfs/etc/hosts
-    setup_vm_iptables $1 $2
+    trace_end "create-vm $VM_NAME"
 }
 
 RACK_ID="$ID"
-if [ $RACK_ID -eq 0 ] ; then
-    sudo cp ~/share/yarn-ec2/resource-mngr/conf/yarn-site.xml \
-        /srv/yarn/conf/yarn-site.xml
-    sudo sed -i "s/yarn.resourcemanager.scheduler.class.value/`cat ~/etc/yarn-scheduler.txt`/" \
-        /srv/yarn/conf/yarn-site.xml
-    WORKER_LIST=`cat hosts | try_fgrep r | try_fgrep h | try_fgrep -v r0`
-    WORKERS=`echo -n "$WORKER_LIST" | cut -d' ' -f2 | tr '\n' ','`
-    sudo sed -i "s/yarn.tetris.hostnames.value/${WORKERS:0:-1}/" \
-        /srv/yarn/conf/yarn-site.xml
-fi
+trace_begin create-golden-vm
+create_golden_vm $RACK_ID
+trace_end create-golden-vm
 
+### clone all vms at once, then fail if any of them failed ###
+trace_begin create-vms
+VM_PIDS=""
 HOST_ID=0
-for ip in `cat rack-$ID/vmips` ; do
-    NODE_ID=$(( HOST_ID + RACK_ID * 10 + 100))
-    sudo sed -i "s/$ip /192.168.1.$NODE_ID /" /etc/hosts
-    create_vm $RACK_ID $HOST_ID "192.168.1.$NODE_ID/24 192.168.1.255" \
+for addr in `cat rack-$ID/vmaddrs` ; do
+    create_vm $RACK_ID $HOST_ID "$addr/16 192.168.255.255" \
         "`cat rack-$ID/vmmem`" "`cat rack-$ID/vmncpus`" \
-        "`cat rack-$ID/vmvmem`" "`cat rack-$ID/vmnvcpus`"
+        "`cat rack-$ID/vmvmem`" "`cat rack-$ID/vmnvcpus`" &
+    VM_PIDS="$VM_PIDS $!"
     HOST_ID=$(( HOST_ID + 1 ))
 done
+for pid in $VM_PIDS ; do
+    wait $pid
+done
+trace_end create-vms
 
 sudo service lxc-net start
 sudo iptables -t nat -F  ### will use our own rules ###
@@ -377,10 +328,14 @@ sudo cp -f ~/share/yarn-ec2/hd/exec/* /usr/local/sbin/
 sudo cp -f ~/share/yarn-ec2/resource-mngr/exec/* /usr/local/sbin/
 sudo cp -f ~/share/yarn-ec2/node-mngr/exec/* /usr/local/sbin/
 
+~/share/yarn-ec2/refresh-slave.sh
+
 sudo mkdir -p ~/lib
 sudo mkdir -p ~/bin
 sudo mkdir -p ~/src
 
 popd > /dev/null
 
+trace_end setup-slave
+
 exit 0
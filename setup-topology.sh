@@ -0,0 +1,75 @@
+#!/bin/bash
+
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+#
+# Generate the cluster files of ~/var/yarn-ec2 (node lists, topology, hosts,
+# per-rack vm shapes and artifact pins) from the files deployed by yarn-ec2. Run on the
+# master by setup.sh, and again by resize.sh whenever nodes join or leave.
+#
+
+set -euxo pipefail
+
+exec 1>&2
+
+. ~/share/yarn-ec2/trace.sh
+trace_begin setup-topology
+
+[ -f ~/etc/yarn-ec2.rc ] && [ -r ~/etc/yarn-ec2.rc ] && . ~/etc/yarn-ec2.rc
+
+pushd ~/var/yarn-ec2 > /dev/null
+
+rm -rf rack-*
+
+echo "$MASTERS" | sed '/^$/d' > masters
+echo "$SLAVES" | sed '/^$/d' > slaves
+cat masters slaves > all-nodes
+echo "$BAKE_HASH" > bake-hash
+cp ~/etc/yarn-artifacts.sha256 artifact-pins
+sha1sum ~/var/yarn-ec2-deploy.sha1 | cut -d' ' -f1 > provision-id
+sed '/^#/d;/^$/d' ~/etc/yarn-topology.txt > topology
+awk '$1 == "rack" { print $4, $3 } $1 == "vm" { print $5, $4 }' topology > hosts
+awk '$1 == "vm" { print $6, $4 }' topology > vmhosts
+
+function setup_rack() {
+### @param rack_id, vm_mem, vm_ncpus, vm_vmem, vm_nvcpus, vm_rate, vm_link ###
+    RACKDIR=`echo rack-"$1"`
+    mkdir -p $RACKDIR
+    echo $7 > $RACKDIR/vmlink
+    echo $6 > $RACKDIR/vmrate
+    echo $5 > $RACKDIR/vmnvcpus
+    echo $4 > $RACKDIR/vmvmem
+    echo $3 > $RACKDIR/vmncpus
+    echo $2 > $RACKDIR/vmmem
+    awk -v r=$1 '$1 == "vm" && $2 == r { print $5 }' topology > $RACKDIR/vmips
+    awk -v r=$1 '$1 == "vm" && $2 == r { print $6 }' topology > $RACKDIR/vmaddrs
+    cp ~/etc/yarn-net/rack-"$1".tc $RACKDIR/net.tc
+    cp ~/etc/yarn-net/rack-"$1".mangle $RACKDIR/net.mangle
+    cp ~/etc/yarn-tune/rack-"$1".rc $RACKDIR/tune.rc
+}
+
+awk '$1 == "rack" { print $2, $6, $7, $8, $9, $10, $11 }' topology | while read rack shape ; do
+    setup_rack $rack $shape
+done
+
+popd > /dev/null
+
+trace_end setup-topology
+
+exit 0
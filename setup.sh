@@ -22,11 +22,17 @@ set -euxo pipefail
 
 exec 1>&2
 
-sudo apt-get update && sudo apt-get -y upgrade
+[ -f ~/etc/yarn-ec2.rc ] && [ -r ~/etc/yarn-ec2.rc ] && . ~/etc/yarn-ec2.rc
 
-sudo apt-get install -y pdsh
+. ~/share/yarn-ec2/trace.sh
+trace_begin setup
 
-[ -f ~/etc/yarn-ec2.rc ] && [ -r ~/etc/yarn-ec2.rc ] && . ~/etc/yarn-ec2.rc
+trace_begin packages
+if [ x"`cat /etc/yarn-ec2-baked 2>/dev/null || :`" != x"$BAKE_HASH" ] ; then
+    sudo apt-get update && sudo apt-get -y upgrade
+    sudo apt-get install -y pdsh
+fi
+trace_end packages
 
 mkdir -p ~/var/yarn-ec2 && rm -rf ~/var/yarn-ec2/*
 
@@ -37,46 +43,16 @@ mkdir -p ~/tmp
 SSH_OPTS="-o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null -o ConnectTimeout=5"
 export PDSH_SSH_ARGS_APPEND="$SSH_OPTS"
 PDSH="pdsh -S -R ssh -b"
+### port the nodes serve their artifacts on, see fetch-artifacts.sh ###
+ARTIFACT_PORT=${ARTIFACT_PORT:-8000}
 
 echo "setting up YARN on `hostname`..."
-echo "$MASTERS" | sed '/^$/d' > masters
-echo "$SLAVES" | sed '/^$/d' > slaves
-cat masters slaves > all-nodes
-NRACKS=`cat all-nodes | wc -l`
-rm -f vmhosts
-rm -f hosts
-
-function setup_rack() {
-### @param rack_id, rack_ips ###
-    RACKDIR=`echo rack-"$1"`
-    mkdir -p $RACKDIR
-    VMINFO=`cat ~/etc/yarn-topo.txt | fgrep $RACKDIR`
-    echo $VMINFO | cut -d' ' -f6 > $RACKDIR/vmnvcpus
-    echo $VMINFO | cut -d' ' -f5 > $RACKDIR/vmvmem
-    echo $VMINFO | cut -d' ' -f4 > $RACKDIR/vmncpus
-    echo $VMINFO | cut -d' ' -f3 > $RACKDIR/vmmem
-    R=$1
-    H=0
-    CAP=`echo $VMINFO | cut -d' ' -f2`
-    echo "$2" | head -n $CAP > $RACKDIR/vmips
-    echo `cat all-nodes | head -n $(( $1 + 1 )) | tail -n 1` r"$1" >> hosts
-    for ip in `cat $RACKDIR/vmips` ; do
-        SEQ=$(( H + R * 10 + 100 ))
-        echo 192.168.1.$SEQ r"$R"h"$H" >> vmhosts
-        echo $ip r"$R"h"$H" >> hosts
-        H=$(( H + 1 ))
-    done
-}
-
-[ $NRACKS -gt 0 ] && setup_rack 0 "$RACK0"
-[ $NRACKS -gt 1 ] && setup_rack 1 "$RACK1"
-[ $NRACKS -gt 2 ] && setup_rack 2 "$RACK2"
-[ $NRACKS -gt 3 ] && setup_rack 3 "$RACK3"
-[ $NRACKS -gt 4 ] && setup_rack 4 "$RACK4"
-
 echo "ensuring executable permissions on scripts..."
 find ~/share/yarn-ec2 -regex "^.+\.sh$" | xargs chmod a+x
+~/share/yarn-ec2/setup-topology.sh
+
 echo "distributing packages..."
+trace_begin distribute
 for node in `cat slaves` ; do
     echo $node > /dev/null
     rsync -e "ssh $SSH_OPTS" -az ~/share/yarn-ec2 \
@@ -88,16 +64,29 @@ for node in `cat slaves` ; do
 done
 
 wait
+trace_end distribute
 
 echo "setting up cluster nodes..."
-$PDSH -w ^all-nodes ~/share/yarn-ec2/setup-slave.sh \
+trace_begin setup-slaves
+$PDSH -w ^all-nodes ARTIFACT_PORT=$ARTIFACT_PORT ~/share/yarn-ec2/setup-slave.sh \
     2>&1 | tee ~/tmp/setup-slaves.log
+trace_end setup-slaves
+echo "stopping artifact servers..."
+$PDSH -w ^all-nodes "sudo pkill -f 'http[.]server $ARTIFACT_PORT' || :"
+trace_begin format-namenode
 env JAVA_HOME=/usr/lib/jvm/sunjdk HADOOP_PREFIX=/srv/hdfs HADOOP_HDFS_HOME=/srv/hdfs \
     HADOOP_CONF_DIR=/srv/hdfs/conf HADOOP_LOG_DIR=/srv/hdfs/logs \
     /srv/hdfs/bin/hdfs namenode -format -force
+trace_end format-namenode
+trace_begin start-slaves
 $PDSH -w ^all-nodes ~/share/yarn-ec2/start-slave.sh \
     2>&1 | tee ~/tmp/start-slaves.log
+trace_end start-slaves
+echo "marking cluster nodes as provisioned..."
+$PDSH -w ^all-nodes "sudo cp ~/var/yarn-ec2/provision-id /mnt/yarn-ec2-provisioned"
 
 popd > /dev/null
 
+trace_end setup
+
 exit 0
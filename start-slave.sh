@@ -22,42 +22,93 @@ set -euxo pipefail
 
 exec 1>&2
 
+. ~/share/yarn-ec2/trace.sh
+trace_begin start-slave
+
 pushd ~/var/yarn-ec2 > /dev/null
 
 CIDR=`cat my_cidr`
 ID=`cat my_id`
 DEV=`cat my_nic`
+PRIMARY_IP=`cat my_primary_ip`
+MASK=`echo $CIDR | cut -d/ -f2`
+
+### secondary ips and bind mounts are gone after a reboot ###
+trace_begin restore-node
+sudo ip link set dev $DEV mtu 1500
+
+sudo ip addr show dev $DEV
+sudo ip addr flush secondary dev $DEV
+for ipv4 in `cat my_ips` ; do
+    if [ x"$ipv4" != x"$PRIMARY_IP" ] ; then
+        sudo ip addr add $ipv4/$MASK brd + dev $DEV
+    fi
+done
+sudo ip addr show dev $DEV
+
+function mount_ro() {
+### @param dir, mount_point ###
+    if ! mountpoint -q $2 ; then
+        sudo mkdir -p $2
+        sudo mount --bind -o ro $1 $2
+    fi
+}
 
+mount_ro /opt/thrift-0.9.1 /usr/local/thrift
+mount_ro /opt/hadoop-2.2.0 /usr/local/hd
+mount_ro /opt/jdk1.8.0_121 /usr/lib/jvm/sunjdk
+trace_end restore-node
+
+trace_begin stop-vms
 for vm in `sudo lxc-ls` ; do
     sudo lxc-stop -k -n $vm || :
     sleep 0.1
 done
+trace_end stop-vms
 
+trace_begin network
 sudo tc qdisc del dev $DEV root || :  ### purge old network queues ###
-sudo iptables -t nat -F  ### will use our own rules ###
-
-sudo tc qdisc add dev $DEV root handle 1: htb
 
 RACK_ID="$ID"
 HOST_ID=0
-for ip in `cat rack-$ID/vmips` ; do
-    NODE_ID=$(( HOST_ID + RACK_ID * 10 + 100))
-    cat /etc/hosts | fgrep "192.168.1.$NODE_ID "
-    sudo iptables -t nat -A PREROUTING -s $CIDR -d $ip -j DNAT --to 192.168.1.$NODE_ID
-    sudo iptables -t nat -A POSTROUTING -s 192.168.1.$NODE_ID -d $CIDR -j SNAT --to $ip
-    sudo tc class add dev $DEV parent 1: classid 1:$NODE_ID htb rate 625mbit ceil 625mbit
-    sudo tc filter add dev $DEV protocol ip parent 1: prio 1 u32 match ip src $ip flowid 1:$NODE_ID
+### all nat rules and tc classes go in at once; ###
+### net.tc and net.mangle are compiled by yarn-ec2 from yarn-topo.txt ###
+paste -d' ' rack-$ID/vmips rack-$ID/vmaddrs | awk -v cidr=$CIDR -v ip=`cat my_primary_ip` '
+    BEGIN {
+        print "*nat"
+        print ":PREROUTING ACCEPT [0:0]"
+        print ":INPUT ACCEPT [0:0]"
+        print ":OUTPUT ACCEPT [0:0]"
+        print ":POSTROUTING ACCEPT [0:0]"
+    }
+    {
+        print "-A PREROUTING -s " cidr " -d " $1 " -j DNAT --to-destination " $2
+        print "-A POSTROUTING -s " $2 " -d " cidr " -j SNAT --to-source " $1
+    }
+    END {
+        print "-A POSTROUTING -s 192.168.0.0/16 ! -d 192.168.0.0/16 -j SNAT --to-source " ip
+        print "COMMIT"
+    }' > nat.rules
+cat nat.rules rack-$ID/net.mangle | sudo iptables-restore
+sed "s/nic.value/$DEV/" rack-$ID/net.tc > tc.batch
+sudo tc -batch tc.batch
+trace_end network
+
+trace_begin start-vms
+for addr in `cat rack-$ID/vmaddrs` ; do
+    cat /etc/hosts | fgrep "$addr "
     VM_NAME=`echo r"$RACK_ID"h"$HOST_ID"`
     sudo lxc-start -n $VM_NAME
     HOST_ID=$(( HOST_ID + 1 ))
 done
+trace_end start-vms
 
-sudo iptables -t nat -A POSTROUTING -s 192.168.1.0/24 ! -d 192.168.1.0/24 \
-    -j SNAT --to `cat my_primary_ip`
 sudo iptables -t nat -L -n
 sudo tc filter show dev $DEV
 sudo lxc-ls -f
 
 popd > /dev/null
 
+trace_end start-slave
+
 exit 0
@@ -22,6 +22,9 @@ set -euxo pipefail
 
 exec 1>&2
 
+. ~/share/yarn-ec2/trace.sh
+trace_begin start
+
 pushd ~/var/yarn-ec2 > /dev/null
 
 mkdir -p ~/tmp
@@ -36,4 +39,6 @@ $PDSH -w ^all-nodes ~/share/yarn-ec2/start-slave.sh \
 
 popd > /dev/null
 
+trace_end start
+
 exit 0
@@ -0,0 +1,46 @@
+#!/bin/bash
+
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+#
+# Span helpers sourced by the node scripts. trace_begin and trace_end log
+# the steps of a script as Chrome trace events, one JSON object per line,
+# to $YARN_EC2_TRACE; yarn-ec2 collects them from every node and merges
+# them into the trace of its run. Spans nest per process, so steps run in
+# the background get their own.
+#
+
+YARN_EC2_TRACE=${YARN_EC2_TRACE:-~/var/yarn-ec2-trace.jsonl}
+mkdir -p `dirname $YARN_EC2_TRACE`
+
+function trace_event() {
+### @param phase, name ###
+    echo "{\"name\": \"$2\", \"ph\": \"$1\", \"ts\": `date +%s%6N`, \"tid\": $BASHPID}" \
+        >> $YARN_EC2_TRACE
+}
+
+function trace_begin() {
+### @param name ###
+    trace_event B "$1"
+}
+
+function trace_end() {
+### @param name ###
+    trace_event E "$1"
+}
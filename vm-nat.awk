@@ -0,0 +1,121 @@
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+#
+# Generate the nat table of the VMs of a rack as an iptables-restore
+# payload. Input lines read
+#   <peer ip> <peer container address> <peer rack id>
+# for every VM of the other racks, sorted by ip.
+#
+# Connections to a peer's container address are DNATed to the peer's ip by
+# one chain per rack, picked by the rack's block of container addresses
+# (see get_container_ip() in yarn-ec2.py) through a binary tree of chains
+# over the racks, entered once for 192.168.0.0/16.
+# Connections from a peer's ip are SNATed to its container address through
+# a binary tree of chains over ip ranges. Either way a lookup walks a number
+# of rules that barely grows with the cluster.
+#
+
+BEGIN {
+    LEAF = 16  ### max rules per leaf chain of the DNAT and SNAT trees ###
+    RACK_NET_SIZE = 64  ### container addresses per rack, a /26 ###
+}
+
+{
+    n++
+    ip[n] = $1
+    addr[n] = $2
+    if (!($3 in dnat)) {
+        racks[++nracks] = $3
+    }
+    dnat[$3] = dnat[$3] "-A to-r" $3 " -d " $2 " -j DNAT --to-destination " $1 "\n"
+}
+
+### first (last = 0) or last (last = 1) container address of rack r ###
+function rack_net(r, last,    a) {
+    a = 256 + r * RACK_NET_SIZE + last * (RACK_NET_SIZE - 1)
+    return "192.168." int(a / 256) "." a % 256
+}
+
+function dnat_tree(name, lo, hi,    mid, i) {
+    chains = chains ":" name " - [0:0]\n"
+    if (hi - lo < LEAF) {
+        for (i = lo; i <= hi; i++) {
+            lookup = lookup "-A " name " -d " rack_net(racks[i], 0) "/26 -j to-r" racks[i] "\n"
+        }
+        return
+    }
+    mid = int((lo + hi) / 2)
+    lookup = lookup "-A " name " -m iprange --dst-range " rack_net(racks[lo], 0) "-" \
+        rack_net(racks[mid], 1) " -j " name "0\n"
+    lookup = lookup "-A " name " -m iprange --dst-range " rack_net(racks[mid + 1], 0) "-" \
+        rack_net(racks[hi], 1) " -j " name "1\n"
+    dnat_tree(name "0", lo, mid)
+    dnat_tree(name "1", mid + 1, hi)
+}
+
+function snat_tree(name, lo, hi,    mid, i) {
+    chains = chains ":" name " - [0:0]\n"
+    if (hi - lo < LEAF) {
+        for (i = lo; i <= hi; i++) {
+            snat = snat "-A " name " -s " ip[i] " -j SNAT --to-source " addr[i] "\n"
+        }
+        return
+    }
+    mid = int((lo + hi) / 2)
+    snat = snat "-A " name " -m iprange --src-range " ip[lo] "-" ip[mid] " -j " name "0\n"
+    snat = snat "-A " name " -m iprange --src-range " ip[mid + 1] "-" ip[hi] " -j " name "1\n"
+    snat_tree(name "0", lo, mid)
+    snat_tree(name "1", mid + 1, hi)
+}
+
+END {
+    print "*nat"
+    print ":PREROUTING ACCEPT [0:0]"
+    print ":INPUT ACCEPT [0:0]"
+    print ":OUTPUT ACCEPT [0:0]"
+    print ":POSTROUTING ACCEPT [0:0]"
+    ### racks in id order, so that each subtree covers a range of addresses ###
+    for (k = 2; k <= nracks; k++) {
+        r = racks[k]
+        for (j = k - 1; j >= 1 && racks[j] + 0 > r + 0; j--) {
+            racks[j + 1] = racks[j]
+        }
+        racks[j + 1] = r
+    }
+    for (k = 1; k <= nracks; k++) {
+        print ":to-r" racks[k] " - [0:0]"
+    }
+    if (n > 0) {
+        dnat_tree("to", 1, nracks)
+        snat_tree("from", 1, n)
+    }
+    printf "%s", chains
+    if (n > 0) {
+        print "-A OUTPUT -d 192.168.0.0/16 -j to"
+    }
+    printf "%s", lookup
+    for (k = 1; k <= nracks; k++) {
+        printf "%s", dnat[racks[k]]
+    }
+    if (n > 0) {
+        print "-A INPUT -j from"
+    }
+    printf "%s", snat
+    print "COMMIT"
+}
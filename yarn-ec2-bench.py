@@ -0,0 +1,808 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+#
+# Offline benchmark of the yarn-ec2 control plane. The launch, wait,
+# reassign, deploy and destroy steps of yarn-ec2.py are run against an
+# in-process stand-in for EC2 and for ssh, at several cluster sizes, and
+# the EC2 API calls, ssh commands and wall time of each are reported.
+# Nothing leaves the machine: no instance is launched and no money spent.
+#
+# Waits are simulated: yarn-ec2's sleeps advance a virtual clock that also
+# drives the fake instances through their states, so a run takes seconds
+# and only the latencies given below are spent for real.
+#
+
+from __future__ import division, print_function, with_statement
+
+import collections
+import contextlib
+import io
+import json
+import os
+import os.path
+import random
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+from optparse import OptionParser
+
+YARN_EC2_DIR = os.path.dirname(os.path.realpath(__file__))
+
+ZONES = ["us-east-1a", "us-east-1b", "us-east-1c"]
+
+
+def parse_args():
+    parser = OptionParser(
+        prog="yarn-ec2-bench",
+        usage="%prog [options] [action...]\n\n"
+              + "<action> can be: " + ", ".join(name for name, _ in SCENARIOS)
+              + " (default: all of them)")
+
+    parser.add_option(
+        "-n", "--nodes", default="5,50,500",
+        help="Comma-separated cluster sizes, master included (default: %default)")
+    parser.add_option(
+        "--ssh-parallelism", type="int", default=16,
+        help="Max number of cluster nodes to run SSH commands on concurrently (default: %default)")
+    parser.add_option(
+        "--ssh-latency", metavar="SECONDS", type="float", default=0.01,
+        help="Real time taken by each ssh command (default: %default)")
+    parser.add_option(
+        "--ssh-failure-rate", metavar="RATE", type="float", default=0.0,
+        help="Fraction of ssh commands, reads excepted, failing with ssh's exit status 255 " +
+             "(default: %default)")
+    parser.add_option(
+        "--api-latency", metavar="SECONDS", type="float", default=0.005,
+        help="Real time taken by each EC2 API call (default: %default)")
+    parser.add_option(
+        "--boot-time", metavar="SECONDS", type="float", default=30,
+        help="Virtual time instances take to start running, or to terminate (default: %default)")
+    parser.add_option(
+        "--status-time", metavar="SECONDS", type="float", default=60,
+        help="Virtual time running instances take to pass their status checks " +
+             "(default: %default)")
+    parser.add_option(
+        "--spot-time", metavar="SECONDS", type="float", default=20,
+        help="Virtual time spot requests take to be fulfilled (default: %default)")
+    parser.add_option(
+        "--visibility-delay", metavar="SECONDS", type="float", default=5,
+        help="Virtual time new instances cannot be looked up or tagged by id " +
+             "(default: %default)")
+    parser.add_option(
+        "--seed", type="int", default=0,
+        help="Seed of the injected ssh failures (default: %default)")
+    parser.add_option(
+        "--json", metavar="FILE",
+        help="Also write the results to FILE, to compare runs")
+    parser.add_option(
+        "-v", "--verbose", action="store_true", default=False,
+        help="Show the output of yarn-ec2")
+
+    (opts, args) = parser.parse_args()
+    known = [name for name, _ in SCENARIOS]
+    for action in args:
+        if action not in known:
+            parser.error("unknown action: " + action)
+    opts.actions = args or known
+    try:
+        opts.nodes = [int(n) for n in opts.nodes.split(",")]
+    except ValueError:
+        parser.error("--nodes must be a comma-separated list of numbers")
+    if any(n < 1 for n in opts.nodes):
+        parser.error("a cluster has at least one node, its master")
+    return opts
+
+
+# Load yarn-ec2.py as a module (its file name is not a valid module name)
+def load_yarn_ec2():
+    path = os.path.join(YARN_EC2_DIR, "yarn-ec2.py")
+    if sys.version < "3":
+        import imp
+        return imp.load_source("yarn_ec2", path)
+    import importlib.util
+    spec = importlib.util.spec_from_file_location("yarn_ec2", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class VirtualClock(object):
+    """
+    Stand-in for the time module of yarn-ec2: sleeping advances the clock instead of blocking.
+    Time otherwise runs as usual, so that the latencies spent for real are accounted for too.
+    """
+
+    def __init__(self):
+        self.offset = 0.0
+        self.lock = threading.Lock()
+
+    def time(self):
+        return time.time() + self.offset
+
+    def sleep(self, seconds):
+        with self.lock:
+            self.offset += max(seconds, 0)
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+class FakeNetworkInterface(object):
+    def __init__(self, nif_id, private_ip_address):
+        self.id = nif_id
+        self.private_ip_addresses = [FakePrivateIPAddress(private_ip_address, True)]
+
+    def snapshot(self):
+        nif = FakeNetworkInterface.__new__(FakeNetworkInterface)
+        nif.id = self.id
+        nif.private_ip_addresses = list(self.private_ip_addresses)
+        return nif
+
+    def _update(self, updated):
+        self.__dict__.update(updated.__dict__)
+
+
+class FakePrivateIPAddress(object):
+    def __init__(self, private_ip_address, primary):
+        self.private_ip_address = private_ip_address
+        self.primary = primary
+
+
+class FakeInstance(object):
+    """
+    Stand-in for a boto.ec2.instance.Instance. The connection keeps one of these per
+    instance, and hands out snapshots of it, which are only updated by _update().
+    """
+
+    def __init__(self, connection, instance_id, instance_type, group_names, launched_at,
+                 launch_index, private_ip_address, spot_instance_request_id=None):
+        self.connection = connection
+        self.id = instance_id
+        self.state = "pending"
+        self.instance_type = instance_type
+        self.group_names = group_names
+        self.launched_at = launched_at
+        self.terminated_at = None
+        self.launch_time = time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime(launched_at))
+        self.ami_launch_index = launch_index
+        self.spot_instance_request_id = spot_instance_request_id
+        self.private_ip_address = private_ip_address
+        self.ip_address = "52." + private_ip_address.split(".", 1)[1]
+        self.public_dns_name = "ec2-{ip}.compute-1.amazonaws.com".format(
+            ip=self.ip_address.replace(".", "-"))
+        self.tags = {}
+        self.interfaces = [FakeNetworkInterface(connection.new_id("eni"), private_ip_address)]
+
+    def snapshot(self):
+        inst = FakeInstance.__new__(FakeInstance)
+        inst.__dict__.update(self.__dict__)
+        inst.tags = dict(self.tags)
+        inst.interfaces = [nif.snapshot() for nif in self.interfaces]
+        return inst
+
+    def _update(self, updated):
+        self.__dict__.update(updated.__dict__)
+
+    def start(self):
+        self._update(self.connection.start_instances([self.id])[0])
+
+    def terminate(self):
+        self._update(self.connection.terminate_instances([self.id])[0])
+
+    def add_tag(self, key, value=""):
+        self.connection.create_tags([self.id], {key: value})
+        self.tags[key] = value
+
+
+class FakeSpotInstanceRequest(object):
+    def __init__(self, request_id, instance_type, group_names, created_at):
+        self.id = request_id
+        self.state = "open"
+        self.instance_id = None
+        self.instance_type = instance_type
+        self.group_names = group_names
+        self.created_at = created_at
+
+    def snapshot(self):
+        req = FakeSpotInstanceRequest.__new__(FakeSpotInstanceRequest)
+        req.__dict__.update(self.__dict__)
+        return req
+
+
+class FakeSecurityGroup(object):
+    def __init__(self, connection, group_id, name):
+        self.connection = connection
+        self.id = group_id
+        self.name = name
+        self.rules = []
+
+    def authorize(self, ip_protocol=None, from_port=None, to_port=None, cidr_ip=None,
+                  src_group=None):
+        self.connection.call("AuthorizeSecurityGroupIngress")
+        self.rules.append(FakeRule(ip_protocol, from_port, to_port, [cidr_ip or src_group]))
+        return True
+
+    def revoke(self, ip_protocol=None, from_port=None, to_port=None, cidr_ip=None,
+               src_group=None):
+        self.connection.call("RevokeSecurityGroupIngress")
+        self.rules = [r for r in self.rules
+                      if (r.ip_protocol, r.from_port, r.to_port) != (ip_protocol, from_port, to_port)]
+        return True
+
+
+class FakeRule(object):
+    def __init__(self, ip_protocol, from_port, to_port, grants):
+        self.ip_protocol = ip_protocol
+        self.from_port = from_port
+        self.to_port = to_port
+        self.grants = grants
+
+
+class FakeImage(object):
+    def __init__(self, connection, image_id):
+        self.connection = connection
+        self.id = image_id
+
+    def run(self, min_count=1, max_count=1, **kwargs):
+        return self.connection.run_instances(self.id, min_count, max_count, **kwargs)
+
+
+class FakeReservation(object):
+    def __init__(self, instances):
+        self.instances = instances
+
+
+class FakeZone(object):
+    def __init__(self, name):
+        self.name = name
+
+
+class FakeStatus(object):
+    def __init__(self, status):
+        self.status = status
+
+
+class FakeInstanceStatus(object):
+    def __init__(self, instance_id, status):
+        self.id = instance_id
+        self.system_status = FakeStatus(status)
+        self.instance_status = FakeStatus(status)
+
+
+class FakeEC2Connection(object):
+    """
+    In-process stand-in for a boto EC2Connection, holding the instances, network interfaces,
+    spot requests and security groups of one region. Only the calls yarn-ec2 makes are
+    implemented; each is counted under the name of its EC2 API action and takes
+    --api-latency. Instances start running --boot-time seconds after they are launched and
+    pass their status checks --status-time seconds later. Like on EC2, they cannot be
+    looked up or tagged by id during the first --visibility-delay seconds.
+    """
+
+    def __init__(self, boto, clock, bench_opts):
+        self.boto = boto
+        self.clock = clock
+        self.bench_opts = bench_opts
+        self.calls = collections.Counter()
+        self.lock = threading.RLock()
+        self.instances = collections.OrderedDict()
+        self.nifs = {}
+        self.spot_requests = collections.OrderedDict()
+        self.groups = collections.OrderedDict()
+        self.next_id = 0
+        self.next_ip = 10
+
+    # Count a call of an EC2 API action, and wait for its response
+    def call(self, action):
+        with self.lock:
+            self.calls[action] += 1
+        if self.bench_opts.api_latency > 0:
+            time.sleep(self.bench_opts.api_latency)
+
+    def new_id(self, prefix):
+        with self.lock:
+            self.next_id += 1
+            return "{p}-{n:08x}".format(p=prefix, n=self.next_id)
+
+    def new_ip(self):
+        with self.lock:
+            self.next_ip += 1
+            return "10.{a}.{b}.{c}".format(
+                a=self.next_ip >> 16 & 255, b=self.next_ip >> 8 & 255, c=self.next_ip & 255)
+
+    def launch(self, count, instance_type, group_names, launched_at, spot_instance_request_id=None):
+        launched = []
+        for index in range(count):
+            inst = FakeInstance(self, self.new_id("i"), instance_type, group_names, launched_at,
+                                index, self.new_ip(), spot_instance_request_id)
+            self.instances[inst.id] = inst
+            self.nifs[inst.interfaces[0].id] = inst.interfaces[0]
+            launched.append(inst)
+        return launched
+
+    # Move an instance on to the state it is in by now
+    def refresh(self, inst):
+        now = self.clock.time()
+        if inst.terminated_at is not None:
+            if now >= inst.terminated_at + self.bench_opts.boot_time:
+                inst.state = "terminated"
+        elif inst.state == "pending" and now >= inst.launched_at + self.bench_opts.boot_time:
+            inst.state = "running"
+
+    def lookup(self, instance_ids):
+        now = self.clock.time()
+        missing = [i for i in instance_ids if i not in self.instances or
+                   now < self.instances[i].launched_at + self.bench_opts.visibility_delay]
+        if missing:
+            e = self.boto.exception.EC2ResponseError(400, "Bad Request")
+            e.error_code = "InvalidInstanceID.NotFound"
+            e.error_message = "The instance ID '{i}' does not exist".format(i=missing[0])
+            raise e
+        return [self.instances[i] for i in instance_ids]
+
+    def describe(self, instance_ids, filters):
+        if instance_ids:
+            found = self.lookup(instance_ids)
+        else:
+            found = list(self.instances.values())
+        names = set((filters or {}).get("instance.group-name", []))
+        if names:
+            found = [i for i in found if names.intersection(i.group_names)]
+        for inst in found:
+            self.refresh(inst)
+        return [inst.snapshot() for inst in found]
+
+    def group_names(self, group_ids):
+        return [self.groups[g].name for g in group_ids or [] if g in self.groups]
+
+    # Put a cluster of num_nodes instances in place without counting any call, running
+    # and through their status checks unless pending is set, as launch_cluster() leaves it
+    def populate(self, cluster_name, num_nodes, instance_type, pending=False, secondary_ips=0):
+        with self.lock:
+            launched_at = self.clock.time() - self.bench_opts.visibility_delay
+            if not pending:
+                launched_at -= self.bench_opts.boot_time + self.bench_opts.status_time
+            nodes = []
+            for role, count in (("master", 1), ("slaves", num_nodes - 1)):
+                name = "{c}-{r}".format(c=cluster_name, r=role)
+                if name not in [g.name for g in self.groups.values()]:
+                    group = FakeSecurityGroup(self, self.new_id("sg"), name)
+                    self.groups[group.id] = group
+                nodes.append(self.launch(count, instance_type, [name], launched_at))
+            for rack, inst in enumerate(nodes[0] + nodes[1]):
+                inst.tags["yarn-ec2-rack"] = str(rack)
+                for _ in range(secondary_ips):
+                    inst.interfaces[0].private_ip_addresses.append(
+                        FakePrivateIPAddress(self.new_ip(), False))
+                self.refresh(inst)
+            return ([i.snapshot() for i in nodes[0]], [i.snapshot() for i in nodes[1]])
+
+    def get_all_security_groups(self, groupnames=None, group_ids=None, filters=None):
+        self.call("DescribeSecurityGroups")
+        with self.lock:
+            return list(self.groups.values())
+
+    def create_security_group(self, name, description, vpc_id=None):
+        self.call("CreateSecurityGroup")
+        with self.lock:
+            group = FakeSecurityGroup(self, self.new_id("sg"), name)
+            self.groups[group.id] = group
+            return group
+
+    def delete_security_group(self, name=None, group_id=None):
+        self.call("DeleteSecurityGroup")
+        with self.lock:
+            del self.groups[group_id]
+            return True
+
+    def get_all_images(self, image_ids=None, owners=None, filters=None):
+        self.call("DescribeImages")
+        return [FakeImage(self, i) for i in image_ids or []]
+
+    def get_all_zones(self, zones=None, filters=None):
+        self.call("DescribeAvailabilityZones")
+        return [FakeZone(z) for z in ZONES]
+
+    def run_instances(self, image_id, min_count=1, max_count=1, instance_type="m1.small",
+                      security_group_ids=None, **kwargs):
+        self.call("RunInstances")
+        with self.lock:
+            launched = self.launch(max_count, instance_type, self.group_names(security_group_ids),
+                                   self.clock.time())
+            return FakeReservation([i.snapshot() for i in launched])
+
+    def start_instances(self, instance_ids=None):
+        self.call("StartInstances")
+        with self.lock:
+            return [i.snapshot() for i in self.lookup(instance_ids)]
+
+    def terminate_instances(self, instance_ids=None):
+        self.call("TerminateInstances")
+        with self.lock:
+            terminated = self.lookup(instance_ids)
+            for inst in terminated:
+                if inst.terminated_at is None:
+                    inst.terminated_at = self.clock.time()
+                    inst.state = "shutting-down"
+            return [i.snapshot() for i in terminated]
+
+    def get_all_reservations(self, instance_ids=None, filters=None):
+        self.call("DescribeInstances")
+        with self.lock:
+            return [FakeReservation(self.describe(instance_ids, filters))]
+
+    def get_only_instances(self, instance_ids=None, filters=None):
+        self.call("DescribeInstances")
+        with self.lock:
+            return self.describe(instance_ids, filters)
+
+    def get_all_instance_status(self, instance_ids=None):
+        self.call("DescribeInstanceStatus")
+        with self.lock:
+            ready_at = self.bench_opts.boot_time + self.bench_opts.status_time
+            statuses = []
+            for inst in self.lookup(instance_ids):
+                self.refresh(inst)
+                if inst.state == "running":
+                    statuses.append(FakeInstanceStatus(
+                        inst.id, "ok" if self.clock.time() >= inst.launched_at + ready_at
+                        else "initializing"))
+            return statuses
+
+    def create_tags(self, resource_ids, tags):
+        self.call("CreateTags")
+        with self.lock:
+            for inst in self.lookup(resource_ids):
+                inst.tags.update(tags)
+            return True
+
+    def request_spot_instances(self, price, image_id, count=1, instance_type="m1.small",
+                               security_group_ids=None, **kwargs):
+        self.call("RequestSpotInstances")
+        with self.lock:
+            requests = []
+            for _ in range(count):
+                req = FakeSpotInstanceRequest(self.new_id("sir"), instance_type,
+                                              self.group_names(security_group_ids),
+                                              self.clock.time())
+                self.spot_requests[req.id] = req
+                requests.append(req)
+            return requests
+
+    def get_all_spot_instance_requests(self, request_ids=None, filters=None):
+        self.call("DescribeSpotInstanceRequests")
+        with self.lock:
+            requests = [self.spot_requests[r] for r in request_ids or self.spot_requests]
+            for req in requests:
+                fulfilled_at = req.created_at + self.bench_opts.spot_time
+                if req.state == "open" and self.clock.time() >= fulfilled_at:
+                    inst = self.launch(1, req.instance_type, req.group_names, fulfilled_at, req.id)[0]
+                    req.state = "active"
+                    req.instance_id = inst.id
+            return [req.snapshot() for req in requests]
+
+    def cancel_spot_instance_requests(self, request_ids):
+        self.call("CancelSpotInstanceRequests")
+        with self.lock:
+            for r in request_ids:
+                if self.spot_requests[r].state == "open":
+                    self.spot_requests[r].state = "cancelled"
+            return True
+
+    def unassign_private_ip_addresses(self, network_interface_id=None, private_ip_addresses=None):
+        self.call("UnassignPrivateIpAddresses")
+        with self.lock:
+            nif = self.nifs[network_interface_id]
+            nif.private_ip_addresses = [a for a in nif.private_ip_addresses
+                                        if a.private_ip_address not in private_ip_addresses]
+            return True
+
+    def assign_private_ip_addresses(self, network_interface_id=None, private_ip_addresses=None,
+                                    secondary_private_ip_address_count=None,
+                                    allow_reassignment=False):
+        self.call("AssignPrivateIpAddresses")
+        with self.lock:
+            nif = self.nifs[network_interface_id]
+            for _ in range(secondary_private_ip_address_count or 0):
+                nif.private_ip_addresses.append(FakePrivateIPAddress(self.new_ip(), False))
+            return True
+
+    def get_all_network_interfaces(self, network_interface_ids=None, filters=None):
+        self.call("DescribeNetworkInterfaces")
+        with self.lock:
+            return [self.nifs[n].snapshot() for n in network_interface_ids or self.nifs]
+
+
+class FakePipe(object):
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(data)
+
+    def close(self):
+        pass
+
+    def getvalue(self):
+        return b"".join(self.chunks)
+
+
+class FakeProcess(object):
+    """
+    Stand-in for a subprocess.Popen running ssh, which runs its command once waited for.
+    """
+
+    def __init__(self, ssh, args, stdin, stdout):
+        self.ssh = ssh
+        self.args = args
+        self.stdin = FakePipe() if stdin == subprocess.PIPE else None
+        self.returncode = None
+        self.output = b""
+        if args[-1] == "true":
+            self.kind = "probe"
+        elif self.stdin is not None:
+            self.kind = "ssh_write"
+        else:
+            self.kind = "ssh_read"
+
+    def wait(self):
+        if self.returncode is None:
+            (self.returncode, self.output) = self.ssh.run(
+                self.kind, self.args, self.stdin.getvalue() if self.stdin is not None else None)
+        return self.returncode
+
+    def poll(self):
+        return self.returncode
+
+    def communicate(self, input=None):
+        self.wait()
+        return (self.output, None)
+
+
+class FakeSSH(object):
+    """
+    Stand-in for the subprocess module of yarn-ec2 that plays the part of ssh. Every command
+    takes --ssh-latency and, reads excepted since yarn-ec2 does not retry them, fails with
+    ssh's exit status 255 at --ssh-failure-rate. Commands are counted by the yarn-ec2 helper
+    that ran them. Files streamed to a host by tar are kept, so that what deploy_files()
+    sent before is found there again.
+    """
+
+    PIPE = subprocess.PIPE
+    STDOUT = subprocess.STDOUT
+    CalledProcessError = subprocess.CalledProcessError
+
+    def __init__(self, bench_opts):
+        self.bench_opts = bench_opts
+        self.calls = collections.Counter()
+        self.lock = threading.Lock()
+        self.random = random.Random(bench_opts.seed)
+        self.files = {}
+
+    # Run the command of an ssh command line.
+    # Returns a tuple of its exit status and output.
+    def run(self, kind, args, data=None):
+        host = args[-2].split("@", 1)[-1]
+        command = args[-1]
+        with self.lock:
+            self.calls[kind] += 1
+            failed = kind != "ssh_read" and self.random.random() < self.bench_opts.ssh_failure_rate
+            if failed:
+                self.calls["failed"] += 1
+        if self.bench_opts.ssh_latency > 0:
+            time.sleep(self.bench_opts.ssh_latency)
+        if failed:
+            return (255, b"")
+        if command.startswith("tar x -C /root") and data is not None:
+            tar = tarfile.open(fileobj=io.BytesIO(data))
+            with self.lock:
+                for member in tar.getmembers():
+                    self.files[(host, "/root/" + member.name)] = tar.extractfile(member).read()
+            tar.close()
+        elif command.startswith("cat /root/"):
+            with self.lock:
+                return (0, self.files.get((host, command.split()[1]), b""))
+        return (0, b"")
+
+    def call(self, args, **kwargs):
+        # closing the multiplexed connections at exit
+        return 0
+
+    def check_call(self, args, **kwargs):
+        status = self.run("ssh", args)[0]
+        if status != 0:
+            raise subprocess.CalledProcessError(status, args)
+        return 0
+
+    def Popen(self, args, stdin=None, stdout=None, stderr=None, **kwargs):
+        return FakeProcess(self, args, stdin, stdout)
+
+
+# The scenarios of the benchmark. Each one puts a cluster of the given size in
+# place, and returns the step of yarn-ec2 to measure on it.
+
+def prepare_launch(yarn, conn, opts, cluster_name, num_nodes):
+    opts.slaves = num_nodes - 1
+    return lambda: yarn.launch_cluster(conn, opts, cluster_name)
+
+
+def prepare_wait(yarn, conn, opts, cluster_name, num_nodes):
+    (master_nodes, slave_nodes) = conn.populate(
+        cluster_name, num_nodes, opts.instance_type, pending=True)
+    return lambda: yarn.wait_for_cluster_state(
+        conn, opts, master_nodes + slave_nodes, "ssh-ready")
+
+
+def prepare_reassign(yarn, conn, opts, cluster_name, num_nodes):
+    (master_nodes, slave_nodes) = conn.populate(cluster_name, num_nodes, opts.instance_type)
+    return lambda: yarn.reassign_cluster_ips(conn, master_nodes, slave_nodes, opts, cluster_name)
+
+
+def prepare_deploy(yarn, conn, opts, cluster_name, num_nodes):
+    (master_nodes, slave_nodes) = conn.populate(
+        cluster_name, num_nodes, opts.instance_type, secondary_ips=opts.secondary_ips)
+    root_dir = os.path.join(YARN_EC2_DIR, "deploy.generic")
+    return lambda: yarn.deploy_files(conn, root_dir, opts, cluster_name, master_nodes, slave_nodes)
+
+
+# Deploying again files that did not change
+def prepare_redeploy(yarn, conn, opts, cluster_name, num_nodes):
+    deploy = prepare_deploy(yarn, conn, opts, cluster_name, num_nodes)
+    deploy()
+    return deploy
+
+
+def prepare_destroy(yarn, conn, opts, cluster_name, num_nodes):
+    conn.populate(cluster_name, num_nodes, opts.instance_type)
+    yarn.raw_input = lambda prompt: "y"
+    return lambda: yarn.destroy_cluster(conn, opts, cluster_name)
+
+
+SCENARIOS = [
+    ("launch", prepare_launch),
+    ("wait", prepare_wait),
+    ("reassign", prepare_reassign),
+    ("deploy", prepare_deploy),
+    ("redeploy", prepare_redeploy),
+    ("destroy", prepare_destroy),
+]
+
+
+# Get the options yarn-ec2 would be run with
+def get_yarn_ec2_opts(yarn, bench_opts):
+    argv = sys.argv
+    sys.argv = ["yarn-ec2", "--key-pair", "bench", "--identity-file", os.devnull,
+                "--vpc-id", "vpc-bench", "--subnet-id", "subnet-bench",
+                "--ssh-parallelism", str(bench_opts.ssh_parallelism), "launch", "bench"]
+    try:
+        return yarn.parse_args()[0]
+    finally:
+        sys.argv = argv
+
+
+# Silence yarn-ec2, which prints to stdout and to the stderr it imported
+@contextlib.contextmanager
+def quiet(yarn, verbose):
+    if verbose:
+        yield
+        return
+    with open(os.devnull, "w") as devnull:
+        saved = (sys.stdout, yarn.stderr)
+        (sys.stdout, yarn.stderr) = (devnull, devnull)
+        try:
+            yield
+        finally:
+            (sys.stdout, yarn.stderr) = saved
+
+
+def describe_error(e):
+    lines = str(e).splitlines()
+    return "{t}: {m}".format(t=type(e).__name__, m=lines[0] if lines else "")
+
+
+# Run one scenario on a fresh EC2 and ssh stand-in.
+# Returns a dict with its results.
+def run_scenario(yarn, bench_opts, action, prepare, num_nodes):
+    clock = VirtualClock()
+    conn = FakeEC2Connection(yarn.boto, clock, bench_opts)
+    ssh = FakeSSH(bench_opts)
+    yarn.time = clock
+    yarn.subprocess = ssh
+    yarn.tracer = yarn.Tracer()
+    opts = get_yarn_ec2_opts(yarn, bench_opts)
+    cluster_name = "bench-{a}-{n}".format(a=action, n=num_nodes)
+
+    error = None
+    with quiet(yarn, bench_opts.verbose):
+        try:
+            step = prepare(yarn, conn, opts, cluster_name, num_nodes)
+        except (SystemExit, Exception) as e:
+            (step, error) = (None, "could not prepare: " + describe_error(e))
+        conn.calls.clear()
+        ssh.calls.clear()
+        (begin, virtual_begin) = (time.time(), clock.time())
+        if step is not None:
+            try:
+                step()
+            except (SystemExit, Exception) as e:
+                error = describe_error(e)
+        (end, virtual_end) = (time.time(), clock.time())
+
+    return {
+        "action": action,
+        "nodes": num_nodes,
+        "wall": end - begin,
+        "virtual": virtual_end - virtual_begin,
+        "api": dict(conn.calls),
+        "ssh": dict(ssh.calls),
+        "error": error,
+    }
+
+
+def print_result(result):
+    print("{a:<10} {n:>6} {w:>9.2f} {v:>11.1f} {api:>9} {ssh:>9}  {r}".format(
+        a=result["action"], n=result["nodes"], w=result["wall"], v=result["virtual"],
+        api=sum(result["api"].values()),
+        ssh=sum(n for kind, n in result["ssh"].items() if kind != "failed"),
+        r=result["error"] or "ok"))
+    for counts in (result["api"], result["ssh"]):
+        if counts:
+            print("{i:18}{c}".format(i="", c=", ".join(
+                "{k}={n}".format(k=k, n=counts[k]) for k in sorted(counts))))
+    sys.stdout.flush()
+
+
+def main():
+    bench_opts = parse_args()
+
+    # yarn-ec2 keeps its state under ~/.yarn-ec2, and wants aws credentials
+    home_dir = tempfile.mkdtemp(prefix="yarn-ec2-bench-")
+    os.environ["HOME"] = home_dir
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "bench")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "bench")
+    try:
+        yarn = load_yarn_ec2()
+        scenarios = dict(SCENARIOS)
+        results = []
+        print("{a:<10} {n:>6} {w:>9} {v:>11} {api:>9} {ssh:>9}  {r}".format(
+            a="action", n="nodes", w="wall(s)", v="virtual(s)", api="api calls",
+            ssh="ssh cmds", r="result"))
+        for action in bench_opts.actions:
+            for num_nodes in bench_opts.nodes:
+                result = run_scenario(yarn, bench_opts, action, scenarios[action], num_nodes)
+                print_result(result)
+                results.append(result)
+    finally:
+        shutil.rmtree(home_dir, ignore_errors=True)
+
+    if bench_opts.json:
+        with open(bench_opts.json, "w") as f:
+            json.dump({"options": dict((k, v) for k, v in vars(bench_opts).items()),
+                       "results": results}, f, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
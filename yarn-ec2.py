@@ -21,14 +21,20 @@
 
 from __future__ import division, print_function, with_statement
 
+import atexit
 import codecs
+import contextlib
 import hashlib
+import io
 import itertools
+import json
 import logging
+import math
 import os
 import os.path
 import pipes
 import random
+import re
 import shutil
 import string
 import subprocess
@@ -36,6 +42,7 @@ import sys
 import tarfile
 import tempfile
 import textwrap
+import threading
 import time
 import warnings
 from datetime import datetime
@@ -134,17 +141,35 @@ class UsageError(Exception):
     pass
 
 
+class ParallelExecutionError(UsageError):
+    """
+    Raised by run_parallel() when the work on one or more hosts failed.
+    `results` holds the hosts that succeeded and `errors` the exception raised for each host
+    that failed.
+    """
+
+    def __init__(self, results, errors):
+        self.results = results
+        self.errors = errors
+        lines = ["{n} of {t} hosts failed:".format(n=len(errors), t=len(results) + len(errors))]
+        for host in sorted(errors):
+            lines.append("  {h}: {e}".format(h=host, e=errors[host]))
+        UsageError.__init__(self, "\n".join(lines))
+
+
 # Configure and parse our command-line arguments
 def parse_args():
     parser = OptionParser(
         prog="yarn-ec2",
         version="%prog {v}".format(v=YARN_EC2_VERSION),
         usage="%prog [options] <action> <cluster_name>\n\n"
-              + "<action> can be: launch, destroy, login, get-master, stop, start")
+              + "<action> can be: launch, destroy, login, get-master, status, stop, start, plan, bake, "
+              + "add-slaves, remove-slaves, monitor")
 
     parser.add_option(
         "-s", "--slaves", type="int", default=4,
-        help="Number of slaves to launch (default: %default)")
+        help="Number of slaves to launch, or to add or remove with add-slaves and " +
+             "remove-slaves (default: %default)")
     parser.add_option(
         "-k", "--key-pair",
         help="Key pair to use on instances")
@@ -194,8 +219,8 @@ def parse_args():
              "the given local address (for use with login)")
     parser.add_option(
         "--resume", action="store_true", default=False,
-        help="Resume installation on a previously launched cluster " +
-             "(for debugging)")
+        help="Resume installation on a previously launched cluster, " +
+             "skipping the setup phases that already completed")
     parser.add_option(
         "--ebs-vol-size", metavar="SIZE", type="int", default=0,
         help="Size (in GB) of each EBS volume.")
@@ -218,6 +243,19 @@ def parse_args():
         "--spot-price", metavar="PRICE", type="float", default=1.0,
         help="If specified, launch slaves as spot instances with the given " +
              "maximum price (in dollars) (default: %default)")
+    parser.add_option(
+        "--spot-timeout", metavar="SECONDS", type="int", default=0,
+        help="Cancel spot requests that are still unfulfilled after this many seconds and " +
+             "use the fallbacks below for the missing instances; 0 waits forever " +
+             "(default: %default)")
+    parser.add_option(
+        "--spot-fallback-types", metavar="TYPES", default="",
+        help="Comma-separated instance types to request, in order, as spot instances " +
+             "for the instances still missing at --spot-timeout")
+    parser.add_option(
+        "--spot-fallback-on-demand", action="store_true", default=False,
+        help="Launch instances still missing at --spot-timeout (after all fallback types) " +
+             "as on-demand instances")
     parser.add_option(
         "-u", "--user", default="ubuntu",
         help="The SSH user you want to connect as (default: %default)")
@@ -249,6 +287,20 @@ def parse_args():
     parser.add_option(
         "--secondary-ips", type="int", default=6,
         help="Num of secondary private ip addresses to assign for each cluster node")
+    parser.add_option(
+        "--auto-topology", action="store_true", default=False,
+        help="Derive yarn-topo.txt and --secondary-ips from the instance types by packing " +
+             "as many VMs of --vm-mem and --vm-cpus as each instance can hold " +
+             "(see also the plan action)")
+    parser.add_option(
+        "--vm-mem", metavar="MB", type="int", default=8000,
+        help="Memory of each VM with --auto-topology (default: %default)")
+    parser.add_option(
+        "--vm-cpus", type="int", default=1,
+        help="Number of cpus of each VM with --auto-topology (default: %default)")
+    parser.add_option(
+        "--vcores-per-cpu", type="int", default=4,
+        help="YARN vcores advertised per VM cpu with --auto-topology (default: %default)")
     parser.add_option(
         "--private-ips", action="store_true", default=False,
         help="Use private IPs for instances rather than public if VPC/subnet " +
@@ -260,6 +312,27 @@ def parse_args():
     parser.add_option(
         "--instance-profile-name", default=None,
         help="IAM profile name to launch instances under")
+    parser.add_option(
+        "--ssh-parallelism", type="int", default=16,
+        help="Max number of cluster nodes to run SSH commands on concurrently (default: %default)")
+    parser.add_option(
+        "--cache-ttl", metavar="SECONDS", type="int", default=300,
+        help="Age after which the locally cached cluster topology used by get-master, login " +
+             "and status is refreshed in the background (default: %default)")
+    parser.add_option(
+        "--no-cache", action="store_true", default=False,
+        help="Always query EC2 for get-master, login and status instead of using the " +
+             "locally cached cluster topology")
+    parser.add_option(
+        "--no-ssh-multiplexing", action="store_true", default=False,
+        help="Open a new SSH connection for every remote command instead of reusing one " +
+             "multiplexed connection per host")
+    parser.add_option(
+        "--monitor-interval", metavar="SECONDS", type="int", default=5,
+        help="Seconds between the samples taken on every node by monitor (default: %default)")
+    parser.add_option(
+        "--monitor-duration", metavar="SECONDS", type="int", default=0,
+        help="Seconds to sample for with monitor; 0 samples until interrupted (default: %default)")
 
     (opts, args) = parser.parse_args()
     if len(args) != 2:
@@ -317,58 +390,133 @@ def get_validate_yarn_version(version, repo):
         return version
 
 
-# Source: http://aws.amazon.com/amazon-linux-ami/instance-type-matrix/
-# Last Updated: 2017-03-11
-# For easy maintainability, please keep this manually-inputted dictionary sorted by key.
-EC2_INSTANCE_TYPES = {
-    "c3.large": "hvm",
-    "c3.xlarge": "hvm",
-    "c3.2xlarge": "hvm",
-    "c3.4xlarge": "hvm",
-    "c3.8xlarge": "hvm",
-    "c4.large": "hvm",
-    "c4.xlarge": "hvm",
-    "c4.2xlarge": "hvm",
-    "c4.4xlarge": "hvm",
-    "c4.8xlarge": "hvm",
-    "m3.medium": "hvm",
-    "m3.large": "hvm",
-    "m3.xlarge": "hvm",
-    "m3.2xlarge": "hvm",
-    "m4.large": "hvm",
-    "m4.xlarge": "hvm",
-    "m4.2xlarge": "hvm",
-    "m4.4xlarge": "hvm",
-    "m4.10xlarge": "hvm",
-    "m4.16xlarge": "hvm",
-    "r3.large": "hvm",
-    "r3.xlarge": "hvm",
-    "r3.2xlarge": "hvm",
-    "r3.4xlarge": "hvm",
-    "r3.8xlarge": "hvm",
-    "r4.large": "hvm",
-    "r4.xlarge": "hvm",
-    "r4.2xlarge": "hvm",
-    "r4.4xlarge": "hvm",
-    "r4.8xlarge": "hvm",
-    "r4.16xlarge": "hvm",
-    "t2.nano": "hvm",
-    "t2.micro": "hvm",
-    "t2.small": "hvm",
-    "t2.medium": "hvm",
-    "t2.large": "hvm",
-    "t2.xlarge": "hvm",
-    "t2.2xlarge": "hvm",
-}
+# Catalog of the EC2 instance types we know about: virtualization, vCPUs,
+# memory, ip addresses per nic, local disks, and network and EBS bandwidth.
+# See ec2-instance-types.json for its sources; it is loaded on first use.
+INSTANCE_CATALOG_FILE = os.path.join(YARN_EC2_DIR, "ec2-instance-types.json")
+instance_catalog = None
+
+
+# Get the catalog entry of a given EC2 instance type, or None if it is unknown
+def get_instance_info(instance_type):
+    global instance_catalog
+    if instance_catalog is None:
+        with open(INSTANCE_CATALOG_FILE) as f:
+            instance_catalog = json.load(f)["instance_types"]
+    return instance_catalog.get(instance_type)
+
+
+STOCK_AMI = 'ami-f4cc1de2'  # Ubuntu 16.04
 
+# Files (relative to YARN_EC2_DIR) whose content determines a baked image;
+# directories stand for every file below them
+BAKE_INPUTS = ["bake.sh", "packages.txt", "artifacts.txt", "fetch-artifacts.sh", "trace.sh",
+               "install-layers.sh", "lxc"]
+# Tag recording the bake hash of an image
+BAKE_HASH_TAG = "yarn-ec2-bake-hash"
 
-# Attempt to resolve an appropriate AMI given the architecture and region of the request.
-def get_yarn_ami(opts):
-    ami = 'ami-f4cc1de2'  # Ubuntu 16.04
-    print("AMI: " + ami)
+
+# Get the BAKE_INPUTS files as a dict mapping their paths to their content
+def get_bake_files():
+    files = {}
+    for name in BAKE_INPUTS:
+        path = os.path.join(YARN_EC2_DIR, name)
+        if os.path.isdir(path):
+            paths = [os.path.join(d, f) for d, _, fs in os.walk(path) for f in fs]
+        else:
+            paths = [path]
+        for p in paths:
+            with open(p, "rb") as f:
+                files[os.path.relpath(p, YARN_EC2_DIR)] = f.read()
+    return files
+
+
+# Get the sha256 of the inputs of a baked image
+def get_bake_hash():
+    digest = hashlib.sha256()
+    for (path, data) in sorted(get_bake_files().items()):
+        digest.update(path.encode("utf-8") + b"\0" + data)
+    return digest.hexdigest()
+
+
+# Attempt to resolve an appropriate AMI given the architecture and region of the request:
+# the latest image baked from the current BAKE_INPUTS, or the stock Ubuntu image.
+def get_yarn_ami(conn, opts):
+    images = conn.get_all_images(
+        owners=["self"],
+        filters={"tag:" + BAKE_HASH_TAG: get_bake_hash(), "state": "available"})
+    if images:
+        ami = max(images, key=lambda i: i.creationDate).id
+        print("AMI: " + ami + " (baked)")
+    else:
+        ami = STOCK_AMI
+        print("AMI: " + ami)
     return ami
 
 
+# Build a node image with the packages, tarballs and lxc base rootfs that
+# setup-slave.sh would otherwise install on every launch. A single instance
+# is launched from the stock image, provisioned by bake.sh and imaged; the
+# image is tagged with the bake hash so that launch picks it up.
+def bake_image(conn, opts, image_name):
+    bake_hash = get_bake_hash()
+    # Like get_yarn_ami(), only available images count: a failed one is baked again
+    existing = conn.get_all_images(
+        owners=["self"], filters={"tag:" + BAKE_HASH_TAG: bake_hash, "state": "available"})
+    if existing:
+        print("Image {i} is already baked from the current inputs".format(i=existing[0].id))
+        return existing[0].id
+
+    group = get_or_make_group(conn, image_name + "-bake", opts.vpc_id)
+    if group.rules == []:  # Group was just now created
+        init_security_group(group, opts.authorized_address)
+    print("Launching bake instance...")
+    instance = conn.get_all_images(image_ids=[STOCK_AMI])[0].run(
+        key_name=opts.key_pair,
+        security_group_ids=[group.id],
+        instance_type=opts.instance_type,
+        placement=None if opts.zone == "all" else opts.zone,
+        subnet_id=opts.subnet_id,
+        instance_profile_name=opts.instance_profile_name).instances[0]
+    try:
+        wait_for_cluster_state(
+            conn=conn,
+            opts=opts,
+            cluster_instances=[instance],
+            cluster_state='ssh-ready'
+        )
+        host = get_dns_name(instance, opts.private_ips)
+        ssh_write(host, opts, "mkdir -p {d} && tar x -C {d}".format(d=BAKE_DIR),
+                  make_tar(get_bake_files()), force_root=True)
+        ssh(host, opts, "cd {d} && bash bake.sh {h}".format(d=BAKE_DIR, h=bake_hash),
+            force_root=True)
+        record_artifact_pins(host, opts)
+
+        print("Creating image...")
+        image_id = instance.create_image(
+            "{n}-{h}".format(n=image_name, h=bake_hash[:12]),
+            description="yarn-ec2 node image baked from " + bake_hash)
+        tries = 0
+        while True:
+            state = conn.get_all_images(image_ids=[image_id])[0].state
+            if state == "available":
+                break
+            if state == "failed":
+                raise UsageError("Image {i} failed to build".format(i=image_id))
+            time.sleep(get_backoff_delay(tries, base=5.0, cap=60.0))
+            tries += 1
+        conn.create_tags([image_id], {"Name": image_name, BAKE_HASH_TAG: bake_hash})
+        print("Baked image {i}".format(i=image_id))
+        return image_id
+    finally:
+        print("Terminating bake instance...")
+        instance.terminate()
+
+
+# Where bake_image() unpacks BAKE_INPUTS on the bake instance
+BAKE_DIR = "/root/share/yarn-ec2-bake"
+
+
 # Init a new security group
 def init_security_group(sg, cidr):
     sg.authorize(ip_protocol='icmp', from_port=-1, to_port=-1, cidr_ip=cidr)
@@ -377,11 +525,13 @@ def init_security_group(sg, cidr):
     sg.authorize('udp', 0, 65535, cidr)
 
 
-# Launch a cluster of the given name, by setting up its security groups,
-# and then starting new instances in them.
-# Returns a tuple of EC2 reservation objects for the master and slaves
-# Fails if there already instances running in the cluster's groups.
-def launch_cluster(conn, opts, cluster_name):
+# Launch a cluster of the given name, by setting up its security groups and
+# then starting new instances in them. Without add_slaves, fails if there are
+# already instances running in the cluster's groups (but for the master,
+# with --use-existing-master); with it, launches opts.slaves more slaves for
+# the running master of the existing cluster.
+# Returns the masters and the newly launched slaves.
+def launch_cluster(conn, opts, cluster_name, add_slaves=False):
     if opts.identity_file is None:
         print("ERROR: must provide an identity file (-i) for ssh connections", file=stderr)
         sys.exit(1)
@@ -401,6 +551,12 @@ def launch_cluster(conn, opts, cluster_name):
                 c=opts.secondary_ips, t=opts.master_instance_type))
             sys.exit(1)
 
+    for fallback_type in [t.strip() for t in opts.spot_fallback_types.split(",") if t.strip()]:
+        if opts.secondary_ips + 1 > get_nic_width(fallback_type):
+            print("ERROR: unable to allocate {c} secondary ip addresses for spot-fallback-type: {t}".format(
+                c=opts.secondary_ips, t=fallback_type))
+            sys.exit(1)
+
     if opts.vpc_id is None:
         print("ERROR: must specify a vpc to launch instances", file=stderr)
         sys.exit(1)
@@ -418,6 +574,12 @@ def launch_cluster(conn, opts, cluster_name):
         response = raw_input("Do you want to continue? (y/N)")
         if response != 'y':
             sys.exit(1)
+        for instance_type in set([opts.instance_type, opts.master_instance_type or opts.instance_type]):
+            info = get_instance_info(instance_type)
+            if info is not None and info["ebs_mbit"] == 0:
+                print("WARNING: {t} is not EBS-optimized; EBS volumes will share its "
+                      "{n} Mbit/s of network bandwidth".format(
+                          t=instance_type, n=info["network_mbit"]), file=stderr)
 
     if opts.spot_price <= 0:
         opts.spot_price = None
@@ -427,7 +589,7 @@ def launch_cluster(conn, opts, cluster_name):
         if response != 'y':
             sys.exit(1)
 
-    if opts.instance_type != "r4.4xlarge":
+    if opts.instance_type != "r4.4xlarge" and not opts.auto_topology:
         print("WARNING: not using r4.4xlarge... performance may differ", file=stderr)
         response = raw_input("Do you want to continue? (y/N)")
         if response != 'y':
@@ -450,14 +612,19 @@ def launch_cluster(conn, opts, cluster_name):
     # Check if instances are already running in our groups
     existing_masters, existing_slaves = get_existing_cluster(
         conn, opts, cluster_name, die_on_error=False)
-    if existing_slaves or (existing_masters and not opts.use_existing_master):
+    if add_slaves:
+        if not existing_masters:
+            print("ERROR: Could not find a master to add slaves to in group %s" %
+                  master_group.name, file=stderr)
+            sys.exit(1)
+    elif existing_slaves or (existing_masters and not opts.use_existing_master):
         print("ERROR: There are already instances running in group %s or %s" %
               (master_group.name, slave_group.name), file=stderr)
         sys.exit(1)
 
     # Figure out AMI
     if opts.ami is None:
-        opts.ami = get_yarn_ami(opts)
+        opts.ami = get_yarn_ami(conn, opts)
 
     # Use group ids to work around https://github.com/boto/boto/issues/350
     additional_group_ids = []
@@ -484,8 +651,10 @@ def launch_cluster(conn, opts, cluster_name):
             device.delete_on_termination = True
             block_map["/dev/sd" + chr(ord('s') + i)] = device
 
-    # AMI-specified block device mapping for C3 instances
-    if opts.instance_type.startswith('c3.'):
+    # AMI-specified block device mapping for instance store volumes. NVMe
+    # instance stores are attached by EC2 itself and need no mapping.
+    info = get_instance_info(opts.instance_type)
+    if info is not None and info["local_disk_type"] != "nvme":
         for i in range(get_num_disks(opts.instance_type)):
             dev = BlockDeviceType()
             dev.ephemeral_name = 'ephemeral%d' % i
@@ -493,190 +662,131 @@ def launch_cluster(conn, opts, cluster_name):
             name = '/dev/sd' + string.ascii_letters[i + 1]
             block_map[name] = dev
 
+    master_type = opts.master_instance_type
+    if master_type == "":
+        master_type = opts.instance_type
+    master_zone = opts.zone
+    if master_zone == 'all':
+        master_zone = random.choice(conn.get_all_zones()).name
+    instance_types = {"master": master_type, "slave": opts.instance_type}
+    group_ids = {"master": [master_group.id] + additional_group_ids,
+                 "slave": [slave_group.id] + additional_group_ids}
+
+    def request_spot(role, zone, instance_type, count, launch_group):
+        reqs = conn.request_spot_instances(
+            price=opts.spot_price,
+            image_id=opts.ami,
+            launch_group=launch_group,
+            placement=zone,
+            count=count,
+            key_name=opts.key_pair,
+            security_group_ids=group_ids[role],
+            instance_type=instance_type,
+            block_device_map=block_map,
+            subnet_id=opts.subnet_id,
+            placement_group=opts.placement_group,
+            user_data=user_data_content,
+            instance_profile_name=opts.instance_profile_name)
+        return {"role": role, "zone": zone, "instance_type": instance_type,
+                "req_ids": [req.id for req in reqs]}
+
+    def run_on_demand(role, zone, instance_type, count):
+        res = image.run(
+            key_name=opts.key_pair,
+            security_group_ids=group_ids[role],
+            instance_type=instance_type,
+            placement=zone,
+            min_count=count,
+            max_count=count,
+            block_device_map=block_map,
+            subnet_id=opts.subnet_id,
+            placement_group=opts.placement_group,
+            user_data=user_data_content,
+            instance_initiated_shutdown_behavior=opts.instance_initiated_shutdown_behavior,
+            instance_profile_name=opts.instance_profile_name)
+        print("Launched {n} {r}{plural_s} in {z}".format(
+            n=count, r=role, plural_s=('' if count == 1 else 's'), z=zone))
+        return res.instances
+
+    # Spot requests of the master and the slaves are submitted together and
+    # then waited for in a single loop, so that both are fulfilled in parallel
+    launch_group = "yarn-launch-group-%s" % cluster_name
+    spot_orders = []
+    nodes = {"master": [], "slave": []}
+
     # Launch slaves
+    zones = get_zones(conn, opts)
+    num_zones = len(zones)
     if opts.slaves != 0 and opts.spot_price is not None:
         # Launch spot instances with the requested price
         print("Requesting %d slaves at $%.3f per hour" %
               (opts.slaves, opts.spot_price))
-        zones = get_zones(conn, opts)
-        num_zones = len(zones)
-        i = 0
-        slave_req_ids = []
-        for zone in zones:
+        for i, zone in enumerate(zones):
             num_slaves_this_zone = get_partition(opts.slaves, num_zones, i)
-            slave_reqs = conn.request_spot_instances(
-                price=opts.spot_price,
-                image_id=opts.ami,
-                launch_group="yarn-launch-group-%s" % cluster_name,
-                placement=zone,
-                count=num_slaves_this_zone,
-                key_name=opts.key_pair,
-                security_group_ids=[slave_group.id] + additional_group_ids,
-                instance_type=opts.instance_type,
-                block_device_map=block_map,
-                subnet_id=opts.subnet_id,
-                placement_group=opts.placement_group,
-                user_data=user_data_content,
-                instance_profile_name=opts.instance_profile_name)
-            slave_req_ids += [req.id for req in slave_reqs]
-            i += 1
-
-        print("Waiting...")
-        try:
-            while True:
-                time.sleep(10)
-                reqs = conn.get_all_spot_instance_requests()
-                id_to_req = {}
-                for r in reqs:
-                    id_to_req[r.id] = r
-                slave_instance_ids = []
-                for i in slave_req_ids:
-                    if i in id_to_req and id_to_req[i].state == "active":
-                        slave_instance_ids.append(id_to_req[i].instance_id)
-                if len(slave_instance_ids) == opts.slaves:
-                    print("%d slaves granted" % opts.slaves)
-                    reservations = conn.get_all_reservations(slave_instance_ids)
-                    slave_nodes = []
-                    for r in reservations:
-                        slave_nodes += r.instances
-                    break
-                else:
-                    print("%d of %d slaves granted, waiting longer" % (
-                        len(slave_instance_ids), opts.slaves))
-        except:
-            print("Canceling spot instance requests")
-            conn.cancel_spot_instance_requests(slave_req_ids)
-            # Log a warning if any of these requests actually launched instances:
-            (master_nodes, slave_nodes) = get_existing_cluster(
-                conn, opts, cluster_name, die_on_error=False)
-            running = len(master_nodes) + len(slave_nodes)
-            if running:
-                print(("WARNING: %d instances are still running" % running), file=stderr)
-            sys.exit(0)
+            if num_slaves_this_zone > 0:
+                spot_orders.append(request_spot(
+                    "slave", zone, opts.instance_type, num_slaves_this_zone, launch_group))
     else:
         # Launch non-spot instances
-        zones = get_zones(conn, opts)
-        num_zones = len(zones)
-        i = 0
-        slave_nodes = []
-        for zone in zones:
+        for i, zone in enumerate(zones):
             num_slaves_this_zone = get_partition(opts.slaves, num_zones, i)
             if num_slaves_this_zone > 0:
-                slave_res = image.run(
-                    key_name=opts.key_pair,
-                    security_group_ids=[slave_group.id] + additional_group_ids,
-                    instance_type=opts.instance_type,
-                    placement=zone,
-                    min_count=num_slaves_this_zone,
-                    max_count=num_slaves_this_zone,
-                    block_device_map=block_map,
-                    subnet_id=opts.subnet_id,
-                    placement_group=opts.placement_group,
-                    user_data=user_data_content,
-                    instance_initiated_shutdown_behavior=opts.instance_initiated_shutdown_behavior,
-                    instance_profile_name=opts.instance_profile_name)
-                slave_nodes += slave_res.instances
-                print("Launched {s} slave{plural_s} in {z}".format(
-                    s=num_slaves_this_zone,
-                    plural_s=('' if num_slaves_this_zone == 1 else 's'),
-                    z=zone))
-            i += 1
+                nodes["slave"] += run_on_demand("slave", zone, opts.instance_type,
+                                                num_slaves_this_zone)
 
     # Launch or resume masters
-    if existing_masters:
+    if add_slaves:
+        nodes["master"] = existing_masters
+    elif existing_masters:
         print("Starting master...")
         for inst in existing_masters:
             if inst.state not in ["shutting-down", "terminated"]:
                 inst.start()
-        master_nodes = existing_masters
+        nodes["master"] = existing_masters
+    elif opts.spot_price is not None:
+        # Launch spot instances with the requested price
+        print("Requesting 1 master at $%.3f per hour" % opts.spot_price)
+        spot_orders.append(request_spot("master", master_zone, master_type, 1, launch_group))
     else:
-        if opts.spot_price is not None:
-            # Launch spot instances with the requested price
-            print("Requesting 1 master at $%.3f per hour" % opts.spot_price)
-            master_type = opts.master_instance_type
-            if master_type == "":
-                master_type = opts.instance_type
-            master_zone = opts.zone
-            if master_zone == 'all':
-                master_zone = random.choice(conn.get_all_zones()).name
-            master_req_ids = []
-            master_req = conn.request_spot_instances(
-                price=opts.spot_price,
-                image_id=opts.ami,
-                launch_group="yarn-launch-group-%s" % cluster_name,
-                placement=master_zone,
-                count=1,
-                key_name=opts.key_pair,
-                security_group_ids=[master_group.id] + additional_group_ids,
-                instance_type=master_type,
-                block_device_map=block_map,
-                subnet_id=opts.subnet_id,
-                placement_group=opts.placement_group,
-                user_data=user_data_content,
-                instance_profile_name=opts.instance_profile_name)
-            master_req_ids += [req.id for req in master_req]
-
-            print("Waiting...")
-            try:
-                while True:
-                    time.sleep(10)
-                    reqs = conn.get_all_spot_instance_requests()
-                    id_to_req = {}
-                    for r in reqs:
-                        id_to_req[r.id] = r
-                    master_instance_ids = []
-                    for i in master_req_ids:
-                        if i in id_to_req and id_to_req[i].state == "active":
-                            master_instance_ids.append(id_to_req[i].instance_id)
-                    if len(master_instance_ids) == 1:
-                        print("1 master granted")
-                        reservations = conn.get_all_reservations(master_instance_ids)
-                        master_nodes = []
-                        for r in reservations:
-                            master_nodes += r.instances
-                        break
-                    else:
-                        print("%d of %d master granted, waiting longer" % (
-                            len(master_instance_ids), 1))
-            except:
-                print("Canceling spot instance requests")
-                conn.cancel_spot_instance_requests(master_req_ids)
-                # Log a warning if any of these requests actually launched instances:
-                (master_nodes, slave_nodes) = get_existing_cluster(
-                    conn, opts, cluster_name, die_on_error=False)
-                running = len(master_nodes) + len(slave_nodes)
-                if running:
-                    print(("WARNING: %d instances are still running" % running), file=stderr)
-                sys.exit(0)
+        # Launch non-spot instances
+        nodes["master"] += run_on_demand("master", master_zone, master_type, 1)
+
+    # Wait for the spot requests. Whatever is still missing at the deadline is
+    # requested again per zone with the next fallback instance type, or launched
+    # on-demand with the original instance type if so configured.
+    fallback_types = [t.strip() for t in opts.spot_fallback_types.split(",") if t.strip()]
+    attempt = 0
+    while spot_orders:
+        granted, missing = wait_for_spot_requests(conn, opts, cluster_name, spot_orders)
+        for role in granted:
+            nodes[role] += granted[role]
+        spot_orders = []
+        if not missing:
+            break
+        attempt += 1
+        if fallback_types:
+            instance_type = fallback_types.pop(0)
+            for order in missing:
+                print("Requesting {n} {r}{plural_s} in {z} as {t} spot instances instead".format(
+                    n=order["count"], r=order["role"], plural_s=('' if order["count"] == 1 else 's'),
+                    z=order["zone"], t=instance_type))
+                spot_orders.append(request_spot(
+                    order["role"], order["zone"], instance_type, order["count"],
+                    "%s-%d" % (launch_group, attempt)))
+        elif opts.spot_fallback_on_demand:
+            for order in missing:
+                nodes[order["role"]] += run_on_demand(
+                    order["role"], order["zone"], instance_types[order["role"]], order["count"])
         else:
-            # Launch non-spot instances
-            master_type = opts.master_instance_type
-            if master_type == "":
-                master_type = opts.instance_type
-            master_zone = opts.zone
-            if master_zone == 'all':
-                master_zone = random.choice(conn.get_all_zones()).name
-            master_nodes = []
-            master_res = image.run(
-                key_name=opts.key_pair,
-                security_group_ids=[master_group.id] + additional_group_ids,
-                instance_type=master_type,
-                placement=master_zone,
-                min_count=1,
-                max_count=1,
-                block_device_map=block_map,
-                subnet_id=opts.subnet_id,
-                placement_group=opts.placement_group,
-                user_data=user_data_content,
-                instance_initiated_shutdown_behavior=opts.instance_initiated_shutdown_behavior,
-                instance_profile_name=opts.instance_profile_name)
-            master_nodes += master_res.instances
-            print("Launched 1 master in {z}".format(z=master_zone))
-
-    # Timed wait
-    print("Waiting for aws to propagate instance metadata...")
-    time.sleep(15)
-    print("OK")
+            print("ERROR: spot requests were not fulfilled within {t} seconds".format(
+                t=opts.spot_timeout), file=stderr)
+            running = len(nodes["master"]) + len(nodes["slave"])
+            if running:
+                print(("WARNING: %d instances are still running" % running), file=stderr)
+            sys.exit(1)
+
+    master_nodes = nodes["master"]
+    slave_nodes = nodes["slave"]
 
     # Give the instances descriptive names and set additional tags
     additional_tags = {}
@@ -685,43 +795,173 @@ def launch_cluster(conn, opts, cluster_name):
             map(str.strip, tag.split(':', 1)) for tag in opts.additional_tags.split(',')
         )
 
-    for master in master_nodes:
-        master.add_tags(
-            dict(additional_tags, Name='{cn}-master-{iid}'.format(cn=cluster_name, iid=master.id))
-        )
-
-    for slave in slave_nodes:
-        slave.add_tags(
-            dict(additional_tags, Name='{cn}-slave-{iid}'.format(cn=cluster_name, iid=slave.id))
-        )
+    # Each instance gets its own Name, so the instances are tagged one
+    # CreateTags call each, run concurrently. Freshly launched instances may
+    # take a few seconds to become visible to the tagging API;
+    # retry_until_visible() waits for that instead of a fixed sleep
+    roles = dict([(inst.id, "master") for inst in master_nodes] +
+                 [(inst.id, "slave") for inst in slave_nodes])
+    run_parallel(
+        list(roles),
+        lambda iid: retry_until_visible(
+            conn.create_tags,
+            [iid],
+            dict(additional_tags,
+                 Name='{cn}-{r}-{iid}'.format(cn=cluster_name, r=roles[iid], iid=iid))
+        ),
+        opts.ssh_parallelism)
 
     # Return all the instances
     return (master_nodes, slave_nodes)
 
 
+# Wait until the spot requests of a launch are active, polling all of them
+# in a single loop. Each order is a dict with the "role" ("master" or "slave"),
+# "zone", "instance_type" and "req_ids" of one request_spot_instances() call.
+# Only the requests of this cluster are described. If --spot-timeout is set,
+# requests still open at the deadline are cancelled.
+# Returns a dict mapping each role to its granted instances, and a list of
+# dicts giving the role, zone, instance_type and count of missing instances.
+# On any error (including Ctrl-C) all requests are cancelled and we exit.
+def wait_for_spot_requests(conn, opts, cluster_name, orders):
+    all_req_ids = list(itertools.chain.from_iterable(o["req_ids"] for o in orders))
+    deadline = time.time() + opts.spot_timeout if opts.spot_timeout > 0 else None
+    id_to_req = {}
+
+    def describe(req_ids):
+        try:
+            for r in conn.get_all_spot_instance_requests(request_ids=req_ids):
+                id_to_req[r.id] = r
+        except boto.exception.EC2ResponseError as e:
+            # fresh requests may not be visible yet
+            if e.error_code != "InvalidSpotInstanceRequestID.NotFound":
+                raise
+
+    def active_instance_ids(order):
+        return [id_to_req[i].instance_id for i in order["req_ids"]
+                if i in id_to_req and id_to_req[i].instance_id and
+                id_to_req[i].state in ("active", "closed", "cancelled")]
+
+    print("Waiting...")
+    try:
+        num_attempts = 0
+        done = set()
+        announced = set()
+        while len(done) < len(orders):
+            if deadline is not None and time.time() >= deadline:
+                break
+            time.sleep(get_backoff_delay(num_attempts, base=2.0, cap=10.0))
+            num_attempts += 1
+            describe([i for n, o in enumerate(orders) if n not in done for i in o["req_ids"]])
+            progress = {}
+            for n, order in enumerate(orders):
+                if n in done:
+                    continue
+                num_active = len(active_instance_ids(order))
+                if num_active == len(order["req_ids"]):
+                    done.add(n)
+                else:
+                    have, want = progress.get(order["role"], (0, 0))
+                    progress[order["role"]] = (have + num_active, want + len(order["req_ids"]))
+            for role in sorted(set(o["role"] for o in orders) - set(progress) - announced):
+                want = sum(len(o["req_ids"]) for o in orders if o["role"] == role)
+                print("%d %s%s granted" % (want, role, '' if want == 1 else 's'))
+                announced.add(role)
+            if progress:
+                print("%s granted, waiting longer" % ", ".join(
+                    "%d of %d %ss" % (progress[r][0], progress[r][1], r) for r in sorted(progress)))
+
+        open_orders = [o for n, o in enumerate(orders) if n not in done]
+        if open_orders:
+            open_req_ids = list(itertools.chain.from_iterable(o["req_ids"] for o in open_orders))
+            print("Canceling %d unfulfilled spot instance requests" % len(open_req_ids))
+            conn.cancel_spot_instance_requests(open_req_ids)
+            # Requests fulfilled while we were cancelling still count
+            describe(open_req_ids)
+    except:
+        print("Canceling spot instance requests")
+        conn.cancel_spot_instance_requests(all_req_ids)
+        # Log a warning if any of these requests actually launched instances:
+        (master_nodes, slave_nodes) = get_existing_cluster(
+            conn, opts, cluster_name, die_on_error=False)
+        running = len(master_nodes) + len(slave_nodes)
+        if running:
+            print(("WARNING: %d instances are still running" % running), file=stderr)
+        sys.exit(0)
+
+    role_by_instance_id = {}
+    missing = []
+    for order in orders:
+        instance_ids = active_instance_ids(order)
+        for i in instance_ids:
+            role_by_instance_id[i] = order["role"]
+        if len(instance_ids) < len(order["req_ids"]):
+            missing.append({"role": order["role"], "zone": order["zone"],
+                            "instance_type": order["instance_type"],
+                            "count": len(order["req_ids"]) - len(instance_ids)})
+
+    granted = {}
+    if role_by_instance_id:
+        reservations = retry_until_visible(conn.get_all_reservations, list(role_by_instance_id))
+        for inst in itertools.chain.from_iterable(r.instances for r in reservations):
+            granted.setdefault(role_by_instance_id[inst.id], []).append(inst)
+    return (granted, missing)
+
+
+# Call fn(*args, **kwargs), retrying with backoff while EC2 has not yet
+# propagated the metadata of freshly launched instances.
+def retry_until_visible(fn, *args, **kwargs):
+    tries = 0
+    while True:
+        try:
+            return fn(*args, **kwargs)
+        except boto.exception.EC2ResponseError as e:
+            if e.error_code != "InvalidInstanceID.NotFound" or tries > 6:
+                raise
+            time.sleep(get_backoff_delay(tries))
+            tries += 1
+
+
 # Reset 2nd ip addresses
 def reassign_cluster_ips(conn, master_nodes, slave_nodes, opts, cluster_name):
     ''' reset cluster ip addresses '''
     print("Reassigning secondary ip addresses...")
 
+    nifs = {}
     for inst in master_nodes + slave_nodes:
         if inst.state != "terminated" and len(inst.interfaces) != 0:
             nif = inst.interfaces[0]
             if len(nif.private_ip_addresses) != opts.secondary_ips + 1:
-                succ = True
-                for addr in nif.private_ip_addresses:
-                    if not addr.primary:
-                        succ = conn.unassign_private_ip_addresses(nif.id, addr.private_ip_address)
-                        if not succ:
-                            break
-                succ = conn.assign_private_ip_addresses(
-                    nif.id, secondary_private_ip_address_count=opts.secondary_ips,
-                    allow_reassignment=False) if succ else False
-                if not succ:
-                    print("Could not reassign secondary ip addresses", file=stderr)
-                    sys.exit(1)
-                else:
-                    nif.update(conn)
+                nifs[nif.id] = nif
+
+    def reassign(nif_id):
+        nif = nifs[nif_id]
+        addrs = [addr.private_ip_address for addr in nif.private_ip_addresses if not addr.primary]
+        succ = True
+        if addrs:
+            succ = conn.unassign_private_ip_addresses(nif.id, addrs)
+        succ = conn.assign_private_ip_addresses(
+            nif.id, secondary_private_ip_address_count=opts.secondary_ips,
+            allow_reassignment=False) if succ else False
+        if not succ:
+            raise UsageError("Could not reassign secondary ip addresses of " + nif.id)
+
+    # One concurrent unassign/assign pair per nic, then a single bulk describe
+    # (retried while EC2 catches up) to verify them all
+    run_parallel(list(nifs), reassign, opts.ssh_parallelism)
+    tries = 0
+    while nifs:
+        for updated in conn.get_all_network_interfaces(network_interface_ids=list(nifs)):
+            nif = nifs[updated.id]
+            nif.private_ip_addresses = updated.private_ip_addresses
+            if len(nif.private_ip_addresses) == opts.secondary_ips + 1:
+                del nifs[nif.id]
+        if nifs:
+            if tries > 5:
+                print("Could not reassign secondary ip addresses", file=stderr)
+                sys.exit(1)
+            time.sleep(get_backoff_delay(tries))
+            tries += 1
 
     print("OK")
 
@@ -747,8 +987,9 @@ def get_existing_cluster(conn, opts, cluster_name, die_on_error=True):
         instances = itertools.chain.from_iterable(r.instances for r in reservations)
         return [i for i in instances if i.state not in ["shutting-down", "terminated"]]
 
-    master_instances = get_instances([cluster_name + "-master"])
-    slave_instances = get_instances([cluster_name + "-slaves"])
+    with tracer.span("describe-instances"):
+        master_instances = sort_by_rack(get_instances([cluster_name + "-master"]))
+        slave_instances = sort_by_rack(get_instances([cluster_name + "-slaves"]))
 
     if any((master_instances, slave_instances)):
         print("Found {m} master{plural_m}, {s} slave{plural_s}.".format(
@@ -757,6 +998,8 @@ def get_existing_cluster(conn, opts, cluster_name, die_on_error=True):
             s=len(slave_instances),
             plural_s=('' if len(slave_instances) == 1 else 's')))
 
+    save_cluster_cache(opts, cluster_name, master_instances, slave_instances)
+
     if not master_instances and die_on_error:
         print("ERROR: Could not find a master for cluster {c} in region {r}.".format(
             c=cluster_name, r=opts.region), file=sys.stderr)
@@ -765,32 +1008,399 @@ def get_existing_cluster(conn, opts, cluster_name, die_on_error=True):
     return (master_instances, slave_instances)
 
 
+# Tag holding the rack id of a cluster node. Nodes get the lowest free rack
+# ids in the order they joined the cluster, the master first, and the
+# topology is keyed by this tag, so that every running node keeps its rack
+# as slaves are added, removed or lost.
+RACK_TAG = "yarn-ec2-rack"
+
+
+def get_rack_id(instance):
+    try:
+        return int((instance.tags or {})[RACK_TAG])
+    except (KeyError, ValueError):
+        return None
+
+
+# Order instances by rack id; instances without one come last, in launch order
+def sort_by_rack(instances):
+    def key(instance):
+        rack = get_rack_id(instance)
+        return (rack is None, rack or 0, instance.launch_time, instance.ami_launch_index,
+                instance.id)
+    return sorted(instances, key=key)
+
+
+# Get the rack of every cluster node, in the order given: its RACK_TAG, or
+# its position if not every node is tagged yet
+def get_cluster_racks(nodes):
+    racks = [get_rack_id(i) for i in nodes]
+    if None in racks:
+        return list(range(len(nodes)))
+    return racks
+
+
+# Give the nodes that have no rack id yet the lowest free ones, in the order given
+def assign_cluster_racks(conn, nodes, opts):
+    racks = {}
+    taken = set(get_rack_id(i) for i in nodes)
+    free_racks = (rack for rack in itertools.count() if rack not in taken)
+    for inst in nodes:
+        if get_rack_id(inst) is None:
+            racks[inst.id] = next(free_racks)
+    if racks:
+        instances = dict((i.id, i) for i in nodes)
+        run_parallel(
+            list(racks),
+            lambda i: retry_until_visible(instances[i].add_tag, RACK_TAG, str(racks[i])),
+            opts.ssh_parallelism)
+
+
+# Get (creating it if needed) the local directory holding yarn-ec2's state
+# for a cluster: ~/.yarn-ec2/<region>/<cluster_name>
+def get_state_dir(opts, cluster_name):
+    state_dir = os.path.join(os.path.expanduser("~"), ".yarn-ec2", opts.region, cluster_name)
+    if not os.path.isdir(state_dir):
+        os.makedirs(state_dir)
+    return state_dir
+
+
+# Instance attributes kept in the local cluster cache
+CACHED_INSTANCE_FIELDS = [
+    "id",
+    "state",
+    "instance_type",
+    "public_dns_name",
+    "ip_address",
+    "private_ip_address",
+    "spot_instance_request_id",
+    "launch_time",
+    "ami_launch_index",
+    "tags",
+]
+
+
+class CachedInstance(object):
+    """
+    Read-only stand-in for a boto.ec2.instance.Instance restored from the local cluster cache.
+    """
+
+    def __init__(self, fields):
+        for name in CACHED_INSTANCE_FIELDS:
+            setattr(self, name, fields.get(name))
+        self.interfaces = []
+
+
+def get_cluster_cache_file(opts, cluster_name):
+    return os.path.join(get_state_dir(opts, cluster_name), "cluster.json")
+
+
+# Record the instances of a cluster in the local cache
+def save_cluster_cache(opts, cluster_name, master_nodes, slave_nodes):
+    def dump(instances):
+        return [dict((name, getattr(i, name, None)) for name in CACHED_INSTANCE_FIELDS)
+                for i in instances]
+
+    cache_file = get_cluster_cache_file(opts, cluster_name)
+    with open(cache_file + ".tmp", "w") as f:
+        json.dump({"updated": time.time(),
+                   "masters": dump(master_nodes),
+                   "slaves": dump(slave_nodes)}, f, indent=2)
+    os.rename(cache_file + ".tmp", cache_file)
+
+
+def invalidate_cluster_cache(opts, cluster_name):
+    cache_file = get_cluster_cache_file(opts, cluster_name)
+    if os.path.exists(cache_file):
+        os.remove(cache_file)
+
+
+# Load the cached instances of a cluster.
+# Returns a tuple (master_nodes, slave_nodes, age in seconds), or None if
+# nothing usable is cached.
+def load_cluster_cache(opts, cluster_name):
+    try:
+        with open(get_cluster_cache_file(opts, cluster_name)) as f:
+            data = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    if not data.get("masters"):
+        return None
+    return ([CachedInstance(i) for i in data["masters"]],
+            [CachedInstance(i) for i in data["slaves"]],
+            time.time() - data["updated"])
+
+
+# Get a cluster's instances from the local cache. If the cache is older than
+# --cache-ttl, a detached yarn-ec2 process is started to refresh it for next
+# time. Returns None if nothing is cached.
+def get_cached_cluster(opts, cluster_name):
+    cached = load_cluster_cache(opts, cluster_name)
+    if cached is None:
+        return None
+    (master_nodes, slave_nodes, age) = cached
+    if age > opts.cache_ttl:
+        command = [sys.executable, os.path.realpath(__file__), "--region", opts.region]
+        if opts.profile is not None:
+            command += ["--profile", opts.profile]
+        with open(os.devnull, "r+b") as devnull:
+            subprocess.Popen(
+                command + ["refresh-cache", cluster_name],
+                stdin=devnull, stdout=devnull, stderr=devnull,
+                close_fds=True, preexec_fn=os.setsid)
+    return (master_nodes, slave_nodes)
+
+
+class Tracer(object):
+    """
+    Spans of a yarn-ec2 run, as Chrome trace events (chrome://tracing, ui.perfetto.dev).
+    Spans of the launcher go to process 0. The node scripts log their own spans on each host
+    (see trace.sh), which are merged in under one process per rack by node_events().
+    """
+
+    def __init__(self):
+        self.start = time.time()
+        self.events = []
+        self.tids = {}
+        self.racks = {}
+        self.lock = threading.Lock()
+
+    # Record a span from begin to end (in seconds since the epoch) on the calling thread.
+    # Spans about a cluster node carry its host, and its rack once known.
+    def add(self, name, begin, end, host=None, **args):
+        if host is not None:
+            args["host"] = host
+            if host in self.racks:
+                args["rack"] = self.racks[host]
+        with self.lock:
+            tid = self.tids.setdefault(threading.current_thread().ident, len(self.tids))
+            self.events.append({"name": name, "ph": "X", "pid": 0, "tid": tid,
+                                "ts": int(begin * 1e6), "dur": int((end - begin) * 1e6),
+                                "args": args})
+
+    @contextlib.contextmanager
+    def span(self, name, host=None, **args):
+        begin = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, begin, time.time(), host=host, **args)
+
+    # Get the events a node logged since this run started, given the content of its
+    # NODE_TRACE, as the events of a process of their own
+    def node_events(self, text, host, rack):
+        events = [{"name": "process_name", "ph": "M", "pid": rack + 1,
+                   "args": {"name": "r{r} {h}".format(r=rack, h=host)}}]
+        for line in text.splitlines():
+            try:
+                event = json.loads(line)
+            except ValueError:
+                continue  # cut short by a failed node script
+            if event.get("ts", 0) >= self.start * 1e6:
+                event["pid"] = rack + 1
+                event.setdefault("args", {}).update(host=host, rack=rack)
+                events.append(event)
+        return events
+
+
+tracer = Tracer()
+
+# Chrome trace events logged by the node scripts on each cluster node
+NODE_TRACE = "var/yarn-ec2-trace.jsonl"
+
+
+# Remember the rack of every cluster node, for the spans of the commands run on it
+def trace_cluster_racks(nodes, opts):
+    for rack, inst in zip(get_cluster_racks(nodes), nodes):
+        tracer.racks[get_dns_name(inst, opts.private_ips)] = rack
+
+
+# Write the trace of this run to the cluster's state directory, merging in the spans logged
+# since it started by the node scripts on each of nodes. Nodes that cannot be reached only
+# miss from the trace. Never raises: it runs in the finally blocks of the setup actions,
+# whose own error must not be replaced by one writing the trace.
+def save_trace(opts, cluster_name, nodes):
+    try:
+        trace_file = write_trace(opts, cluster_name, nodes)
+    except Exception as e:
+        print("WARNING: could not write the trace: {e}".format(e=e), file=stderr)
+        return
+    print("Trace written to {f} (open it in chrome://tracing or ui.perfetto.dev)".format(
+        f=trace_file))
+
+
+def write_trace(opts, cluster_name, nodes):
+    hosts = [get_dns_name(i, opts.private_ips) for i in nodes]
+    try:
+        traces = parallel_ssh_read(hosts, opts, "sudo cat /root/%s 2>/dev/null || :" % NODE_TRACE)
+    except ParallelExecutionError as e:
+        print("WARNING: could not collect the traces of {n} nodes".format(n=len(e.errors)),
+              file=stderr)
+        traces = e.results
+    events = [{"name": "process_name", "ph": "M", "pid": 0, "args": {"name": "yarn-ec2"}}]
+    with tracer.lock:
+        events += tracer.events
+    for rack, host in zip(get_cluster_racks(nodes), hosts):
+        if host in traces:
+            events += tracer.node_events(traces[host].decode("utf-8"), host, rack)
+    trace_file = os.path.join(get_state_dir(opts, cluster_name), "trace.json")
+    with open(trace_file, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+    return trace_file
+
+
+# Where setup_cluster() keeps a copy of the phase journal on the master
+PHASE_JOURNAL = "var/yarn-ec2-journal.json"
+
+
+class PhaseJournal(object):
+    """
+    Record of the setup phases completed on a cluster, kept in the local state directory and
+    on the master. Each phase is recorded with a digest of its inputs chained with the digest
+    of the phase before it, so a phase is redone when it never completed, when its inputs
+    changed, or when an earlier phase was redone.
+    """
+
+    def __init__(self, opts, cluster_name, master):
+        self.opts = opts
+        self.master = master
+        self.journal_file = os.path.join(get_state_dir(opts, cluster_name), "journal.json")
+        self.digest = ""
+        try:
+            with open(self.journal_file) as f:
+                self.phases = json.load(f)["phases"]
+        except (IOError, OSError, ValueError, KeyError):
+            self.phases = self.load_from_master()
+
+    def load_from_master(self):
+        try:
+            data = ssh_read(self.master, self.opts, "cat /root/%s 2>/dev/null || :" % PHASE_JOURNAL,
+                            force_root=True)
+            return json.loads(data.decode("utf-8"))["phases"]
+        except (subprocess.CalledProcessError, ValueError, KeyError):
+            return {}
+
+    def save(self):
+        data = json.dumps({"updated": time.time(), "phases": self.phases}, indent=2)
+        with open(self.journal_file + ".tmp", "w") as f:
+            f.write(data)
+        os.rename(self.journal_file + ".tmp", self.journal_file)
+        ssh_write(self.master, self.opts,
+                  "mkdir -p /root/var && cat > /root/%s" % PHASE_JOURNAL, data.encode("utf-8"),
+                  force_root=True)
+
+    # Run fn(*args, **kwargs) unless the phase already completed with the same inputs
+    def run(self, phase, inputs, fn, *args, **kwargs):
+        self.digest = hashlib.sha1(json.dumps(
+            [self.digest, phase, inputs], sort_keys=True).encode("utf-8")).hexdigest()
+        if self.phases.get(phase) == self.digest:
+            print("Skipping {p}: already done".format(p=phase))
+            return
+        with tracer.span(phase):
+            fn(*args, **kwargs)
+        self.phases[phase] = self.digest
+        self.save()
+
+
+def invalidate_phase_journal(opts, cluster_name):
+    journal_file = os.path.join(get_state_dir(opts, cluster_name), "journal.json")
+    if os.path.exists(journal_file):
+        os.remove(journal_file)
+
+
 # Deploy configuration files and run setup scripts on a newly launched or started cluster.
-def setup_cluster(conn, master_nodes, slave_nodes, opts, deploy_ssh_key):
+# Setup runs as a sequence of phases recorded in the cluster's PhaseJournal,
+# so that resuming or retrying a launch only redoes the phases that failed or
+# whose inputs changed.
+def setup_cluster(conn, master_nodes, slave_nodes, opts, cluster_name, deploy_ssh_key):
     master = get_dns_name(master_nodes[0], opts.private_ips)
+    nodes = master_nodes + slave_nodes
+    journal = PhaseJournal(opts, cluster_name, master)
+    assign_cluster_racks(conn, nodes, opts)
+    trace_cluster_racks(nodes, opts)
+
+    journal.run("reassign-ips", [sorted(i.id for i in nodes), opts.secondary_ips],
+                reassign_cluster_ips, conn, master_nodes, slave_nodes, opts, cluster_name)
+
     if deploy_ssh_key:
-        print("Generating cluster's SSH key on master...")
-        key_setup = """
-          [ -f ~/.ssh/id_rsa ] ||
-            (ssh-keygen -q -t rsa -N '' -f ~/.ssh/id_rsa -C ibuki &&
-             cat ~/.ssh/id_rsa.pub >> ~/.ssh/authorized_keys)
-        """
-        ssh(master, opts, key_setup)
-        dot_ssh_tar = ssh_read(master, opts, ['tar', 'c', '.ssh'])
-        print("Transferring cluster's SSH key to slaves...")
-        for slave in slave_nodes:
-            slave_address = get_dns_name(slave, opts.private_ips)
-            print(slave_address)
-            ssh_write(
-                host=slave_address,
+        journal.run("ssh-keys", [], deploy_cluster_ssh_key, master_nodes, slave_nodes, opts)
+
+    journal.run("clone", [opts.yarn_ec2_git_repo, opts.yarn_ec2_git_branch,
+                          get_yarn_ec2_head(master, opts)],
+                clone_yarn_ec2, master, opts)
+
+    root_dir = YARN_EC2_DIR + "/" + "deploy.generic"
+    rendered = render_deploy_files(root_dir, opts, cluster_name, master_nodes, slave_nodes)
+    manifest = get_deploy_manifest(rendered)
+    journal.run("deploy", manifest, deploy_files,
+                conn=conn,
+                root_dir=root_dir,
                 opts=opts,
-                command=['tar', 'x'],
-                arguments=dot_ssh_tar
-            )
-        print("Passing SSH keys to root...")
-        for node in master_nodes + slave_nodes:
-            ssh(get_dns_name(node, opts.private_ips), opts, "sudo cp -r ~/.ssh /root/")
+                cluster_name=cluster_name,
+                master_nodes=master_nodes,
+                slave_nodes=slave_nodes,
+                rendered=rendered)
+
+    # Network rules and services do not survive a reboot. Installs and
+    # containers do, as long as /mnt does and nothing was deployed since:
+    # setup.sh then leaves PROVISIONED_MARKER on every node, and restarting
+    # the cluster is enough.
+    node_states = parallel_ssh_read(
+        hosts=[get_dns_name(i, opts.private_ips) for i in nodes],
+        opts=opts,
+        command="cat /proc/sys/kernel/random/boot_id && "
+                "(cat {m} 2>/dev/null || :)".format(m=PROVISIONED_MARKER))
+    node_states = [state.decode("utf-8").split() for state in node_states.values()]
+    provision_id = hashlib.sha1(manifest.encode("utf-8")).hexdigest()
+    if all(state[1:] == [provision_id] for state in node_states):
+        journal.run("setup", sorted(state[0] for state in node_states),
+                    restart_spark_cluster, master, opts)
+    else:
+        journal.run("setup", sorted(state[0] for state in node_states),
+                    setup_spark_cluster, master, opts)
+    journal.run("start-services", [], start_spark_services, master, opts)
+    record_artifact_pins(master, opts)
+
+    ssh(master, opts, "yls", force_root=True)
+    print(">> Hadoop HDFS is available at r0:50070")
+    print(">> Hadoop YARN is available at r0:8088")
+    print("Done!")
+
+
+def deploy_cluster_ssh_key(master_nodes, slave_nodes, opts):
+    master = get_dns_name(master_nodes[0], opts.private_ips)
+    print("Generating cluster's SSH key on master...")
+    key_setup = """
+      [ -f ~/.ssh/id_rsa ] ||
+        (ssh-keygen -q -t rsa -N '' -f ~/.ssh/id_rsa -C ibuki &&
+         cat ~/.ssh/id_rsa.pub >> ~/.ssh/authorized_keys)
+    """
+    ssh(master, opts, key_setup)
+    dot_ssh_tar = ssh_read(master, opts, ['tar', 'c', '.ssh'])
+    print("Transferring cluster's SSH key to slaves...")
+    parallel_ssh_write(
+        hosts=[get_dns_name(slave, opts.private_ips) for slave in slave_nodes],
+        opts=opts,
+        command=['tar', 'x'],
+        arguments=dot_ssh_tar
+    )
+    print("Passing SSH keys to root...")
+    parallel_ssh(
+        hosts=[get_dns_name(node, opts.private_ips) for node in master_nodes + slave_nodes],
+        opts=opts,
+        command="sudo cp -r ~/.ssh /root/"
+    )
 
+
+# Get the commit the yarn-ec2 branch points to, as seen from the master, so
+# that a fix pushed to the branch is cloned again on resume
+def get_yarn_ec2_head(master, opts):
+    refs = ssh_read(master, opts, "git ls-remote {r} {b}".format(
+        r=opts.yarn_ec2_git_repo, b=opts.yarn_ec2_git_branch)).decode("utf-8").split()
+    return refs[0] if refs else None
+
+
+def clone_yarn_ec2(master, opts):
     print("Cloning yarn-ec2 scripts from {r}/tree/{b} on master...".format(
         r=opts.yarn_ec2_git_repo, b=opts.yarn_ec2_git_branch))
     ssh(
@@ -804,31 +1414,178 @@ def setup_cluster(conn, master_nodes, slave_nodes, opts, deploy_ssh_key):
         )
     )
 
-    print("Deploying files to master...")
-    deploy_files(
-        conn=conn,
-        root_dir=YARN_EC2_DIR + "/" + "deploy.generic",
-        opts=opts,
-        master_nodes=master_nodes,
-        slave_nodes=slave_nodes
-    )
-
-    print("Running setup on master...")
-    setup_spark_cluster(master, opts)
-    print("Done!")
-
 
 def setup_spark_cluster(master, opts):
+    print("Running setup on master...")
     ssh(master, opts, "chmod u+x /root/share/yarn-ec2/setup.sh", force_root=True)
     ssh(master, opts, "/root/share/yarn-ec2/setup.sh", force_root=True)
+
+
+# Bring up the network state and the containers of an already provisioned cluster
+def restart_spark_cluster(master, opts):
+    print("Cluster is already provisioned, restarting it...")
+    ssh(master, opts, "chmod u+x /root/share/yarn-ec2/*.sh", force_root=True)
+    ssh(master, opts, "/root/share/yarn-ec2/start.sh", force_root=True)
+
+
+# Written on every node by setup.sh once the whole cluster is set up, holding
+# the sha1 of the deploy manifest it was set up from
+PROVISIONED_MARKER = "/mnt/yarn-ec2-provisioned"
+
+
+def start_spark_services(master, opts):
     ssh(master, opts, "hdup", force_root=True)
     ssh(master, opts, "yup", force_root=True)
 
     time.sleep(5)
 
-    ssh(master, opts, "yls", force_root=True)
-    print(">> Hadoop HDFS is available at r0:50070")
-    print(">> Hadoop YARN is available at r0:8088")
+
+# Extend a running cluster to new_slaves, which were just launched and
+# appended to slave_nodes: only the new nodes are set up and started, while
+# the others are updated in place by resize.sh.
+def add_cluster_slaves(conn, master_nodes, slave_nodes, new_slaves, opts, cluster_name):
+    master = get_dns_name(master_nodes[0], opts.private_ips)
+    assign_cluster_racks(conn, master_nodes + slave_nodes, opts)
+    trace_cluster_racks(master_nodes + slave_nodes, opts)
+    reassign_cluster_ips(conn, [], new_slaves, opts, cluster_name)
+    deploy_cluster_ssh_key(master_nodes, new_slaves, opts)
+    deploy_files(conn, YARN_EC2_DIR + "/" + "deploy.generic", opts, cluster_name,
+                 master_nodes, slave_nodes)
+    print("Adding {n} slave{plural_s} on master...".format(
+        n=len(new_slaves), plural_s=('' if len(new_slaves) == 1 else 's')))
+    ssh(master, opts, "chmod u+x /root/share/yarn-ec2/*.sh", force_root=True)
+    ssh(master, opts, ["/root/share/yarn-ec2/resize.sh"] +
+        [get_dns_name(i, True) for i in new_slaves], force_root=True)
+
+
+# Shrink a running cluster by its last opts.slaves slaves: they are
+# decommissioned from YARN and HDFS before being terminated, and the
+# remaining nodes are then updated in place by resize.sh.
+# Returns the slaves left in the cluster.
+def remove_cluster_slaves(conn, master_nodes, slave_nodes, opts, cluster_name):
+    if opts.slaves <= 0 or opts.slaves > len(slave_nodes):
+        raise UsageError("Can only remove 1 to {n} slaves from cluster {c}".format(
+            n=len(slave_nodes), c=cluster_name))
+    master = get_dns_name(master_nodes[0], opts.private_ips)
+    assign_cluster_racks(conn, master_nodes + slave_nodes, opts)
+    trace_cluster_racks(master_nodes + slave_nodes, opts)
+    remaining = slave_nodes[:len(slave_nodes) - opts.slaves]
+    leaving = slave_nodes[len(remaining):]
+
+    print("The following instances will be decommissioned and terminated:")
+    for inst in leaving:
+        print("> %s" % get_dns_name(inst, opts.private_ips))
+    msg = "Are you sure you want to remove {n} slave{plural_s} from the cluster {c}? (y/N) ".format(
+        n=len(leaving), plural_s=('' if len(leaving) == 1 else 's'), c=cluster_name)
+    response = raw_input(msg)
+    if response != "y":
+        return slave_nodes
+
+    print("Decommissioning slaves on master...")
+    ssh(master, opts, "chmod u+x /root/share/yarn-ec2/*.sh", force_root=True)
+    ssh(master, opts, ["/root/share/yarn-ec2/decommission.sh"] +
+        [str(get_rack_id(inst)) for inst in leaving], force_root=True)
+    print("Terminating slaves...")
+    for inst in leaving:
+        inst.terminate()
+    print("{s} instances terminated".format(s=len(leaving)))
+    save_cluster_cache(opts, cluster_name, master_nodes, remaining)
+
+    deploy_files(conn, YARN_EC2_DIR + "/" + "deploy.generic", opts, cluster_name,
+                 master_nodes, remaining)
+    print("Shrinking cluster on master...")
+    ssh(master, opts, "/root/share/yarn-ec2/resize.sh", force_root=True)
+    return remaining
+
+
+# Terminate the instances of a cluster, after asking for confirmation, and
+# with --delete-groups delete its security groups once they are gone
+def destroy_cluster(conn, opts, cluster_name):
+    (master_nodes, slave_nodes) = get_existing_cluster(
+        conn, opts, cluster_name, die_on_error=False)
+
+    if any(master_nodes + slave_nodes):
+        print("The following instances will be terminated:")
+        for inst in master_nodes + slave_nodes:
+            print("> %s" % get_dns_name(inst, opts.private_ips))
+
+        print("ALL DATA ON ALL INSTANCES WILL BE LOST!!")
+
+        msg = "Are you sure you want to destroy the cluster {c}? (y/N) ".format(c=cluster_name)
+        response = raw_input(msg)
+        if response == "y":
+            if len(master_nodes) != 0:
+                print("Terminating master...")
+                for inst in master_nodes:
+                    inst.terminate()
+                print("{m} instances terminated".format(m=len(master_nodes)))
+            if len(slave_nodes) != 0:
+                print("Terminating slaves...")
+                for inst in slave_nodes:
+                    inst.terminate()
+                print("{s} instances terminated".format(s=len(slave_nodes)))
+            invalidate_cluster_cache(opts, cluster_name)
+            invalidate_phase_journal(opts, cluster_name)
+
+            # Delete security groups as well
+            if opts.delete_groups:
+                group_names = [cluster_name + "-master", cluster_name + "-slaves"]
+                wait_for_cluster_state(
+                    conn=conn,
+                    opts=opts,
+                    cluster_instances=(master_nodes + slave_nodes),
+                    cluster_state='terminated'
+                )
+                print("Deleting security groups (this may take some time)...")
+                attempt = 1
+                while attempt <= 3:
+                    print("Attempt %d" % attempt)
+                    groups = [g for g in conn.get_all_security_groups() if g.name in group_names]
+                    success = True
+                    # Delete individual rules in all groups before deleting groups to
+                    # remove dependencies between them
+                    for group in groups:
+                        print("Deleting rules in security group " + group.name)
+                        for rule in group.rules:
+                            for grant in rule.grants:
+                                success &= group.revoke(ip_protocol=rule.ip_protocol,
+                                                        from_port=rule.from_port,
+                                                        to_port=rule.to_port,
+                                                        src_group=grant)
+
+                    # Sleep for AWS eventual-consistency to catch up, and for instances
+                    # to terminate
+                    time.sleep(30)  # Yes, it does have to be this long :-(
+                    for group in groups:
+                        try:
+                            # It is needed to use group_id to make it work with VPC
+                            conn.delete_security_group(group_id=group.id)
+                            print("Deleted security group %s" % group.name)
+                        except boto.exception.EC2ResponseError:
+                            success = False
+                            print("Failed to delete security group %s" % group.name)
+
+                    # Unfortunately, group.revoke() returns True even if a rule was not
+                    # deleted, so this needs to be rerun if something fails
+                    if success:
+                        break
+
+                    attempt += 1
+
+                if not success:
+                    print("Failed to delete all security groups after 3 tries.")
+                    print("Try re-running in a few minutes.")
+    else:
+        print("ERROR: cannot find any running instances, did you misspell '{c}'?".format(c=cluster_name))
+
+    print("")
+    print("!! To avoid unnecessary EC2 cost:")
+    print("-------------------------")
+    print("!! Please double-check AWS web console to")
+    print("!! ascertain the temination of all your instances")
+    print("!! at possibly many AWS regional data centers.")
+    print("")
+    print("Thanks.")
 
 
 def is_ssh_available(host, opts, print_ssh_output=True):
@@ -859,16 +1616,26 @@ def is_ssh_available(host, opts, print_ssh_output=True):
     return s.returncode == 0
 
 
-def is_cluster_ssh_available(cluster_instances, opts):
+def is_cluster_ssh_available(cluster_instances, opts, ready=None):
     """
     Check if SSH is available on all the instances in a cluster.
+
+    Hosts are probed concurrently. `ready` is an optional set of instance ids that are
+    already known to accept SSH connections; those are not probed again, and the set is
+    updated in place with the instances found reachable by this call.
     """
-    for i in cluster_instances:
-        dns_name = get_dns_name(i, opts.private_ips)
-        if not is_ssh_available(host=dns_name, opts=opts):
-            return False
-    else:
-        return True
+    if ready is None:
+        ready = set()
+    pending = dict((get_dns_name(i, opts.private_ips), i)
+                   for i in cluster_instances if i.id not in ready)
+    results = run_parallel(
+        list(pending),
+        lambda host: is_ssh_available(host=host, opts=opts),
+        opts.ssh_parallelism)
+    for host, available in results.items():
+        if available:
+            ready.add(pending[host].id)
+    return all(i.id in ready for i in cluster_instances)
 
 
 def wait_for_cluster_state(conn, opts, cluster_instances, cluster_state):
@@ -880,6 +1647,10 @@ def wait_for_cluster_state(conn, opts, cluster_instances, cluster_state):
            value can be 'ssh-ready' or a valid value from boto.ec2.instance.InstanceState such as
            'running', 'terminated', etc.
            (would be nice to replace this with a proper enum: http://stackoverflow.com/a/1695250)
+
+    Each round refreshes the instances that are not ready yet with one batched describe call
+    (and, for 'ssh-ready', one batched status call plus concurrent SSH probes). Instances that
+    reached the state are not looked at again. Rounds are spaced by capped exponential backoff.
     """
     sys.stdout.write(
         "Waiting for cluster to enter '{s}' state...".format(s=cluster_state)
@@ -887,29 +1658,35 @@ def wait_for_cluster_state(conn, opts, cluster_instances, cluster_state):
     sys.stdout.flush()
 
     start_time = datetime.now()
+    begin = time.time()
     num_attempts = 0
+    max_batch = 100
+    instances_by_id = dict((i.id, i) for i in cluster_instances)
+    ready = set()
 
     while True:
-        time.sleep(5 * num_attempts)  # seconds
-
-        for i in cluster_instances:
-            i.update()
+        if num_attempts > 0:
+            time.sleep(get_backoff_delay(num_attempts - 1, base=2.0, cap=20.0))  # seconds
 
-        max_batch = 100
-        statuses = []
-        for j in xrange(0, len(cluster_instances), max_batch):
-            batch = [i.id for i in cluster_instances[j:j + max_batch]]
-            statuses.extend(conn.get_all_instance_status(instance_ids=batch))
+        pending_ids = [i.id for i in cluster_instances if i.id not in ready]
+        for j in xrange(0, len(pending_ids), max_batch):
+            for inst in conn.get_only_instances(instance_ids=pending_ids[j:j + max_batch]):
+                instances_by_id[inst.id]._update(inst)
 
         if cluster_state == 'ssh-ready':
-            if all(i.state == 'running' for i in cluster_instances) and \
-                    all(s.system_status.status == 'ok' for s in statuses) and \
-                    all(s.instance_status.status == 'ok' for s in statuses) and \
-                    is_cluster_ssh_available(cluster_instances, opts):
-                break
+            running_ids = [i for i in pending_ids if instances_by_id[i].state == 'running']
+            status_ok = set()
+            for j in xrange(0, len(running_ids), max_batch):
+                for s in conn.get_all_instance_status(instance_ids=running_ids[j:j + max_batch]):
+                    if s.system_status.status == 'ok' and s.instance_status.status == 'ok':
+                        status_ok.add(s.id)
+            is_cluster_ssh_available(
+                [instances_by_id[i] for i in running_ids if i in status_ok], opts, ready)
         else:
-            if all(i.state == cluster_state for i in cluster_instances):
-                break
+            ready.update(i for i in pending_ids if instances_by_id[i].state == cluster_state)
+
+        if len(ready) == len(instances_by_id):
+            break
 
         num_attempts += 1
 
@@ -919,6 +1696,7 @@ def wait_for_cluster_state(conn, opts, cluster_instances, cluster_state):
     sys.stdout.write("\n")
 
     end_time = datetime.now()
+    tracer.add("wait-for-" + cluster_state, begin, time.time(), instances=len(cluster_instances))
     print("Cluster is now in '{s}' state\nWaited {t} seconds".format(
         s=cluster_state,
         t=(end_time - start_time).seconds
@@ -927,51 +1705,9 @@ def wait_for_cluster_state(conn, opts, cluster_instances, cluster_state):
 
 # Get number of ip addresses available per nic for a given EC2 instance type.
 def get_nic_width(instance_type):
-    # Source: http://docs.aws.amazon.com/AWSEC2/latest/UserGuide/using-eni.html
-    # Last Updated: 2017-03-11
-    # For easy maintainability, please keep this manually-inputted dictionary sorted by key.
-    nic_ips_by_instance = {
-        "c3.large": "10",
-        "c3.xlarge": "15",
-        "c3.2xlarge": "15",
-        "c3.4xlarge": "30",
-        "c3.8xlarge": "30",
-        "c4.large": "10",
-        "c4.xlarge": "15",
-        "c4.2xlarge": "15",
-        "c4.4xlarge": "30",
-        "c4.8xlarge": "30",
-        "m3.medium": "6",
-        "m3.large": "10",
-        "m3.xlarge": "15",
-        "m3.2xlarge": "30",
-        "m4.large": "10",
-        "m4.xlarge": "15",
-        "m4.2xlarge": "15",
-        "m4.4xlarge": "30",
-        "m4.10xlarge": "30",
-        "m4.16xlarge": "30",
-        "r3.large": "10",
-        "r3.xlarge": "15",
-        "r3.2xlarge": "15",
-        "r3.4xlarge": "30",
-        "r3.8xlarge": "30",
-        "r4.large": "10",
-        "r4.xlarge": "15",
-        "r4.2xlarge": "15",
-        "r4.4xlarge": "30",
-        "r4.8xlarge": "30",
-        "r4.16xlarge": "50",
-        "t2.nano": "2",
-        "t2.micro": "2",
-        "t2.small": "4",
-        "t2.medium": "6",
-        "t2.large": "12",
-        "t2.xlarge": "15",
-        "t2.2xlarge": "15",
-    }
-    if instance_type in nic_ips_by_instance:
-        return int(nic_ips_by_instance[instance_type])
+    info = get_instance_info(instance_type)
+    if info is not None:
+        return info["nic_ips"]
     else:
         print("WARNING: Don't know the max number of ips per nic on instance type %s; assuming 2"
               % instance_type, file=stderr)
@@ -980,114 +1716,546 @@ def get_nic_width(instance_type):
 
 # Get number of local disks available for a given EC2 instance type.
 def get_num_disks(instance_type):
-    # Source: http://docs.aws.amazon.com/AWSEC2/latest/UserGuide/InstanceStorage.html
-    # Last Updated: 2017-03-11
-    # For easy maintainability, please keep this manually-inputted dictionary sorted by key.
-    disks_by_instance = {
-        "c3.large": "2",
-        "c3.xlarge": "2",
-        "c3.2xlarge": "2",
-        "c3.4xlarge": "2",
-        "c3.8xlarge": "2",
-        "c4.large": "0",
-        "c4.xlarge": "0",
-        "c4.2xlarge": "0",
-        "c4.4xlarge": "0",
-        "c4.8xlarge": "0",
-        "m3.medium": "1",
-        "m3.large": "1",
-        "m3.xlarge": "2",
-        "m3.2xlarge": "2",
-        "m4.large": "0",
-        "m4.xlarge": "0",
-        "m4.2xlarge": "0",
-        "m4.4xlarge": "0",
-        "m4.10xlarge": "0",
-        "m4.16xlarge": "0",
-        "r3.large": "1",
-        "r3.xlarge": "1",
-        "r3.2xlarge": "1",
-        "r3.4xlarge": "1",
-        "r3.8xlarge": "2",
-        "r4.large": "0",
-        "r4.xlarge": "0",
-        "r4.2xlarge": "0",
-        "r4.4xlarge": "0",
-        "r4.8xlarge": "0",
-        "r4.16xlarge": "0",
-        "t2.nano": "0",
-        "t2.micro": "0",
-        "t2.small": "0",
-        "t2.medium": "0",
-        "t2.large": "0",
-        "t2.xlarge": "0",
-        "t2.2xlarge": "0",
-    }
-    if instance_type in disks_by_instance:
-        return int(disks_by_instance[instance_type])
+    info = get_instance_info(instance_type)
+    if info is not None:
+        return info["local_disks"]
     else:
         print("WARNING: Don't know the number of disks on instance type %s; assuming 0"
               % instance_type, file=stderr)
         return 0
 
 
-# Deploy the configuration file templates in a given local directory to
-# a cluster, filling in any template parameters with information about the
-# cluster (e.g. lists of masters and slaves). Files are only deployed to
-# the first master instance in the cluster, and we expect the setup
-# script to be run on that instance to copy them to other nodes.
-#
-# root_dir should be an absolute path to the directory with the files we want to deploy.
-def deploy_files(conn, root_dir, opts, master_nodes, slave_nodes):
-    active_master = get_dns_name(master_nodes[0], opts.private_ips)
+# Get the number of vCPUs and the memory (in MB) of a given EC2 instance type.
+def get_instance_resources(instance_type):
+    info = get_instance_info(instance_type)
+    if info is not None:
+        return (info["vcpus"], info["memory_mb"])
+    else:
+        print("WARNING: Don't know the vCPUs and memory of instance type %s" % instance_type,
+              file=stderr)
+        return None
 
+
+# Get the network bandwidth (in Mbit/s) of a given EC2 instance type, or
+# None if it is unknown
+def get_network_bandwidth(instance_type):
+    info = get_instance_info(instance_type)
+    if info is not None:
+        return info["network_mbit"]
+    else:
+        print("WARNING: Don't know the network bandwidth of instance type %s" % instance_type,
+              file=stderr)
+        return None
+
+
+# Parse the per-rack VM shapes of a yarn-topo.txt file. Each line reads
+#   rack-<id> <max vms> <vm mem (MB)> <vm cpus> <yarn mem (MB)> <yarn vcores>
+# and "rack-default" applies to every rack without a line of its own.
+# Returns a dict mapping "<id>" or "default" to the five numbers.
+def parse_vm_topology(text):
+    vm_topology = {}
+    for line in text.splitlines():
+        fields = line.split()
+        if len(fields) == 6 and fields[0].startswith("rack-"):
+            vm_topology[fields[0][len("rack-"):]] = [int(x) for x in fields[1:]]
+    return vm_topology
+
+
+# Resources left to each host itself (DataNode, lxc, sshd...) and, on the
+# master, to the NameNode and the ResourceManager as well
+HOST_RESERVED_CPUS = 1
+HOST_RESERVED_MEM = 2048
+MASTER_RESERVED_CPUS = 2
+MASTER_RESERVED_MEM = 6144
+# Memory of each VM that --auto-topology leaves out of yarn for the
+# NodeManager itself, at most a quarter of the VM
+NM_RESERVED_MEM = 1536
+
+
+# Get how many VMs of opts.vm_mem MB and opts.vm_cpus cpus fit on an
+# instance type, given its vCPUs, memory and the ip addresses of its nic
+def get_vm_capacity(instance_type, opts, reserved_cpus, reserved_mem):
+    resources = get_instance_resources(instance_type)
+    if resources is None:
+        raise UsageError("Cannot plan VMs for unknown instance type " + instance_type)
+    (vcpus, mem) = resources
+    return max(0, min((vcpus - reserved_cpus) // opts.vm_cpus,
+                      (mem - reserved_mem) // opts.vm_mem,
+                      get_nic_width(instance_type) - 1,
+                      MAX_VMS_PER_RACK))
+
+
+# Bin-pack VMs of the shape given by --vm-mem, --vm-cpus and --vcores-per-cpu
+# onto the master and slave instance types.
+# Returns the content of a yarn-topo.txt file and the number of secondary ip
+# addresses each node needs.
+def plan_vm_topology(opts):
+    master_type = opts.master_instance_type or opts.instance_type
+    slave_capacity = get_vm_capacity(
+        opts.instance_type, opts, HOST_RESERVED_CPUS, HOST_RESERVED_MEM)
+    master_capacity = min(1, get_vm_capacity(
+        master_type, opts, MASTER_RESERVED_CPUS, MASTER_RESERVED_MEM))
+    if master_capacity == 0 or (opts.slaves > 0 and slave_capacity == 0):
+        raise UsageError("VMs of {m} MB and {c} cpus do not fit on {t}".format(
+            m=opts.vm_mem, c=opts.vm_cpus,
+            t=master_type if master_capacity == 0 else opts.instance_type))
+    shape = "{m} {c} {ym} {v}".format(
+        m=opts.vm_mem, c=opts.vm_cpus, ym=opts.vm_mem - min(NM_RESERVED_MEM, opts.vm_mem // 4),
+        v=opts.vm_cpus * opts.vcores_per_cpu)
+    # The master hosts a single VM, for the application masters
+    text = "rack-0 {n} {s}\nrack-default {d} {s}\n".format(
+        n=master_capacity, d=slave_capacity, s=shape)
+    return (text, max(master_capacity, slave_capacity if opts.slaves > 0 else 0))
+
+
+# Get the yarn-topo.txt content to deploy: planned from the instance types
+# with --auto-topology, read from the deploy tree otherwise. The net lines
+# of the deploy tree's file are kept either way.
+def get_vm_topology_text(opts, root_dir):
+    with open(os.path.join(root_dir, "etc", "yarn-topo.txt")) as f:
+        text = f.read()
+    if opts.auto_topology:
+        net_lines = [line for line in text.splitlines() if line.split()[:1] == ["net"]]
+        return plan_vm_topology(opts)[0] + "".join(line + "\n" for line in net_lines)
+    return text
+
+
+# Keys of the network model lines of a yarn-topo.txt file, which read
+#   net rack-<id> <key> <value>
+# with "rack-default" applying to every rack without a line of its own for
+# that key. Rates are in Mbit/s and apply to the traffic leaving a rack:
+#   vm-rate           rate guaranteed to each VM
+#   vm-ceil           rate each VM may borrow up to (default: vm-rate)
+#   vm-link           rate of each VM's own interface, rack-local traffic included
+#   uplink            rate shared by all the VMs of the rack
+#   oversubscription  sets uplink to the sum of the vm-rates over this ratio
+#   delay, jitter     netem delay (ms) added to each VM's traffic
+#   loss              netem loss (%) applied to each VM's traffic
+# vm-rate and vm-link default to a share of the instance's bandwidth (see
+# get_vm_rates()), and uplink to the sum of the vm-ceils.
+NET_MODEL_KEYS = ["vm-rate", "vm-ceil", "vm-link", "uplink", "oversubscription",
+                  "delay", "jitter", "loss"]
+
+
+# Parse the network model lines of a yarn-topo.txt file.
+# Returns a dict mapping "<id>" or "default" to a dict of key values.
+def parse_net_model(text):
+    net_model = {}
+    for line in text.splitlines():
+        fields = line.split()
+        if fields[:1] != ["net"]:
+            continue
+        if len(fields) != 4 or not fields[1].startswith("rack-") or \
+                fields[2] not in NET_MODEL_KEYS:
+            raise UsageError("Bad net line in yarn-topo.txt: " + line.strip())
+        try:
+            value = float(fields[3])
+        except ValueError:
+            raise UsageError("Bad net line in yarn-topo.txt: " + line.strip())
+        net_model.setdefault(fields[1][len("rack-"):], {})[fields[2]] = value
+    return net_model
+
+
+# Get the network model of a rack: its own net lines over rack-default's.
+# uplink and oversubscription both size the uplink, so a rack setting either
+# overrides both defaults.
+def get_rack_net_model(net_model, rack):
+    model = dict(net_model.get("default", {}))
+    own = net_model.get(str(rack), {})
+    if "uplink" in own or "oversubscription" in own:
+        model.pop("uplink", None)
+        model.pop("oversubscription", None)
+    model.update(own)
+    return model
+
+
+# Compile the network model of a rack into a tc batch and an iptables-restore
+# mangle payload for its host. Every VM gets an htb class below the rack's
+# uplink class, with a netem qdisc if delay or loss is modelled, and its
+# traffic is steered there by a firewall mark. The host's nic is left as
+# "nic.value" for start-slave.sh to fill in.
+def compile_rack_net_model(rack, vms, vm_rate, model):
+    vm_ceil = int(model.get("vm-ceil", vm_rate))
+    if "uplink" in model:
+        uplink = int(model["uplink"])
+    elif "oversubscription" in model:
+        uplink = int(vm_rate * vms / model["oversubscription"])
+    else:
+        uplink = vm_ceil * vms
+    uplink = max(1, uplink)
+    netem = []
+    if "delay" in model or "jitter" in model:
+        netem += ["delay", "%gms" % model.get("delay", 0)]
+        if "jitter" in model:
+            netem.append("%gms" % model["jitter"])
+    if "loss" in model:
+        netem += ["loss", "%g%%" % model["loss"]]
+
+    tc = ["qdisc add dev nic.value root handle 1: htb",
+          "class add dev nic.value parent 1: classid 1:1 htb rate {u}mbit ceil {u}mbit".format(
+              u=uplink)]
+    mangle = ["*mangle",
+              ":PREROUTING ACCEPT [0:0]",
+              ":INPUT ACCEPT [0:0]",
+              ":FORWARD ACCEPT [0:0]",
+              ":OUTPUT ACCEPT [0:0]",
+              ":POSTROUTING ACCEPT [0:0]"]
+    for host in xrange(vms):
+        # htb class ids and fw marks are hex
+        c = "%x" % (host + 10)
+        tc.append("class add dev nic.value parent 1:1 classid 1:{c} htb rate {r}mbit "
+                  "ceil {l}mbit".format(c=c, r=min(vm_rate, uplink), l=min(vm_ceil, uplink)))
+        if netem:
+            tc.append("qdisc add dev nic.value parent 1:{c} handle {c}: netem {n}".format(
+                c=c, n=" ".join(netem)))
+        tc.append("filter add dev nic.value parent 1: protocol ip prio 1 handle 0x{c} fw "
+                  "flowid 1:{c}".format(c=c))
+        mangle.append("-A POSTROUTING -s {a} -j MARK --set-mark 0x{c}".format(
+            a=get_container_ip(rack, host), c=c))
+    mangle.append("COMMIT")
+    return ("\n".join(tc) + "\n", "\n".join(mangle) + "\n")
+
+
+# Compile the network model of every rack of a topology manifest.
+# Returns a dict mapping deployed paths (relative to /root) to their content.
+def compile_net_model(topology, net_model):
+    files = {}
+    for line in topology.splitlines():
+        fields = line.split()
+        if fields[0] == "rack":
+            rack = int(fields[1])
+            (tc, mangle) = compile_rack_net_model(
+                rack, int(fields[4]), int(fields[9]), get_rack_net_model(net_model, rack))
+            files["etc/yarn-net/rack-%d.tc" % rack] = tc
+            files["etc/yarn-net/rack-%d.mangle" % rack] = mangle
+    return files
+
+
+# Containers live in the 192.168.0.0/16 lxc network, whose gateway and dhcp
+# range are in 192.168.0.0/24. Past it, each rack R gets the block of
+# RACK_NET_SIZE addresses starting at 192.168.1.0 + R * RACK_NET_SIZE, in
+# which host H is addressed H + 1 (see rack_net() in vm-nat.awk)
+RACK_NET_SIZE = 64
+MAX_RACKS = (65536 - 256) // RACK_NET_SIZE
+MAX_VMS_PER_RACK = RACK_NET_SIZE - 2
+
+
+def get_container_ip(rack, host):
+    addr = 256 + rack * RACK_NET_SIZE + host + 1
+    return "192.168.{a}.{b}".format(a=addr // 256, b=addr % 256)
+
+
+# Per-VM traffic shaping used when the network bandwidth of an instance type
+# is unknown: each VM gets VM_RATE Mbit/s and may borrow up to VM_LINK Mbit/s
+DEFAULT_VM_RATE = 625
+DEFAULT_VM_LINK = 1250
+
+
+# Get the guaranteed and ceiling rates (in Mbit/s) of each of the vms VMs
+# sharing the nic of a given EC2 instance type
+def get_vm_rates(instance_type, vms):
+    bandwidth = get_network_bandwidth(instance_type)
+    if bandwidth is None:
+        return (DEFAULT_VM_RATE, DEFAULT_VM_LINK)
+    rate = max(1, bandwidth // max(vms, 1))
+    return (rate, min(bandwidth, 2 * rate))
+
+
+# Generate the topology manifest of a cluster. Each node of master_nodes +
+# slave_nodes runs the rack of its RACK_TAG (see get_cluster_racks()), and
+# hosts one VM per secondary ip address of that node, up to the rack's
+# capacity in vm_topology. vm-rate and vm-link in net_model override the VM
+# rates derived from the instance type. Lines read
+#   rack <id> <name> <address> <vms> <vm mem> <vm cpus> <yarn mem> <yarn vcores>
+#        <vm rate (Mbit/s)> <vm link (Mbit/s)>
+#   vm <rack id> <host id> <name> <address> <container address>
+def get_cluster_topology(master_nodes, slave_nodes, vm_topology, net_model):
+    nodes = master_nodes + slave_nodes
+    racks = get_cluster_racks(nodes)
+    if nodes and max(racks) >= MAX_RACKS:
+        raise UsageError("At most {m} racks are supported, got rack {n}".format(
+            m=MAX_RACKS, n=max(racks)))
+    lines = []
+    for rack, node in zip(racks, nodes):
+        shape = vm_topology.get(str(rack), vm_topology.get("default"))
+        if shape is None:
+            raise UsageError("yarn-topo.txt has neither rack-{r} nor rack-default".format(r=rack))
+        (capacity, vm_mem, vm_cpus, yarn_mem, yarn_vcores) = shape
+        vm_ips = get_secondary_ip_addresses(node)[:min(capacity, MAX_VMS_PER_RACK)]
+        (vm_rate, vm_link) = get_vm_rates(node.instance_type, len(vm_ips))
+        model = get_rack_net_model(net_model, rack)
+        vm_rate = int(model.get("vm-rate", vm_rate))
+        vm_link = int(model.get("vm-link", vm_link))
+        lines.append("rack {r} r{r} {a} {n} {m} {c} {ym} {yc} {vr} {vl}".format(
+            r=rack, a=get_ip_address(node, True), n=len(vm_ips),
+            m=vm_mem, c=vm_cpus, ym=yarn_mem, yc=yarn_vcores, vr=vm_rate, vl=vm_link))
+        for host, ip in enumerate(vm_ips):
+            lines.append("vm {r} {h} r{r}h{h} {a} {c}".format(
+                r=rack, h=host, a=ip, c=get_container_ip(rack, host)))
+    return "\n".join(lines)
+
+
+# Share of the memory a host keeps outside its VMs (or a VM outside its yarn
+# containers) that goes to the heaps of the hadoop daemons running there; the
+# rest is left to the OS and to the daemons' non-heap memory
+DAEMON_HEAP_SHARE = 0.6
+# Lower and upper heap sizes (MB) of each daemon
+DAEMON_HEAP_BOUNDS = {
+    "NN": (512, 16384),
+    "RM": (512, 16384),
+    "DN": (256, 4096),
+    "NM": (256, 2048),
+}
+# Heaps of at least this many MB are collected by G1, smaller ones by the
+# throughput collector
+G1_MIN_HEAP = 4096
+MAX_GC_THREADS = 8
+# Yarn rounds container requests up to multiples of the minimum allocation,
+# which keeps at most this many containers on the smallest node manager
+MAX_CONTAINERS_PER_NM = 256
+MIN_ALLOCATION_MB = 32
+MIN_ALLOCATION_VCORES = 4
+
+
+def bound(value, lower, upper):
+    return int(max(lower, min(upper, value)))
+
+
+# Get the heap size (MB) of a daemon given the memory (MB) it may draw from
+def get_daemon_heap(daemon, mem):
+    (lower, upper) = DAEMON_HEAP_BOUNDS[daemon]
+    return bound(mem * DAEMON_HEAP_SHARE, lower, upper) // 64 * 64
+
+
+# Get the jvm options of a daemon with a given heap size (MB) that may use
+# a given number of cpus. The jvm sizes its gc thread pools after every cpu
+# of the host, even in a VM pinned to a few of them.
+def get_daemon_gc_opts(heap, cpus, fixed_heap=False):
+    opts = ["-XX:+UseG1GC", "-XX:MaxGCPauseMillis=200"] if heap >= G1_MIN_HEAP \
+        else ["-XX:+UseParallelGC"]
+    opts.append("-XX:ParallelGCThreads=%d" % bound(cpus, 1, MAX_GC_THREADS))
+    if fixed_heap:
+        opts.append("-Xms%dm" % heap)
+    return " ".join(opts)
+
+
+# Get the number of rpc handlers of a server with a given number of clients,
+# 20 ln(clients) as sized for the namenode by the hadoop vendors
+def get_rpc_handlers(clients):
+    return bound(20 * math.log(max(clients, 2)), 10, 200)
+
+
+# Compile the tuning profile of every rack of a topology manifest, whose
+# racks run on nodes (see get_cluster_racks()): the heap and gc settings of
+# the daemons of the rack's host and VMs, sized from its instance type and
+# VM shape, and the rpc handler counts and scheduler allocation bounds of the
+# cluster. Daemons of an unknown instance type keep the defaults of their
+# start scripts, and so do NodeManagers of VMs whose memory yarn-topo.txt
+# gives all to yarn: the table is taken as written, never cut down.
+# Returns a dict mapping deployed paths (relative to /root) to their content,
+# shell variable assignments read by the node scripts and the start scripts.
+def compile_tuning_profile(topology, nodes):
+    racks = []
+    for line in topology.splitlines():
+        fields = line.split()
+        if fields[0] == "rack":
+            racks.append([int(x) for x in fields[1:2] + fields[4:9]])
+    nms = [rack for rack in racks if rack[1] > 0]
+    # Rack 0's VM, which runs the application masters, may advertise any vcores
+    workers = [rack for rack in nms if rack[0] != 0] or nms or racks
+    yarn_mems = [rack[4] for rack in nms or racks]
+    cluster = [
+        ("NN_HANDLERS", get_rpc_handlers(len(racks))),
+        ("RM_HANDLERS", get_rpc_handlers(sum(rack[1] for rack in racks))),
+        ("MIN_ALLOCATION_MB", bound(min(yarn_mems) // MAX_CONTAINERS_PER_NM,
+                                    MIN_ALLOCATION_MB, min(yarn_mems))),
+        ("MAX_ALLOCATION_MB", max(yarn_mems)),
+        ("MIN_ALLOCATION_VCORES", min(MIN_ALLOCATION_VCORES, min(rack[5] for rack in workers))),
+        ("MAX_ALLOCATION_VCORES", max(rack[5] for rack in workers)),
+    ]
+
+    instance_types = dict(zip(get_cluster_racks(nodes), [i.instance_type for i in nodes]))
+    files = {}
+    for (rack, vms, vm_mem, vm_cpus, yarn_mem, _) in racks:
+        instance_type = instance_types[rack]
+        profile = list(cluster)
+        resources = get_instance_resources(instance_type)
+        if resources is not None:
+            (vcpus, mem) = resources
+            spare_cpus = max(1, vcpus - vms * vm_cpus)
+            spare_mem = max(0, mem - vms * vm_mem)
+            if rack == 0:
+                # The NameNode and the ResourceManager get 40% each, the DataNode the rest
+                for daemon in ["NN", "RM"]:
+                    heap = get_daemon_heap(daemon, spare_mem * 0.4)
+                    profile.append((daemon + "_HEAPSIZE", heap))
+                    profile.append((daemon + "_OPTS", get_daemon_gc_opts(heap, spare_cpus, True)))
+                spare_mem *= 0.2
+            heap = get_daemon_heap("DN", spare_mem)
+            profile.append(("DN_HEAPSIZE", heap))
+            profile.append(("DN_OPTS", get_daemon_gc_opts(heap, spare_cpus)))
+            profile.append(("DN_HANDLERS", bound(4 * spare_cpus, 3, 32)))
+        if vm_mem > yarn_mem:
+            heap = get_daemon_heap("NM", vm_mem - yarn_mem)
+            profile.append(("NM_HEAPSIZE", heap))
+            profile.append(("NM_OPTS", get_daemon_gc_opts(heap, vm_cpus)))
+        else:
+            profile.append(("NM_OPTS", get_daemon_gc_opts(0, vm_cpus)))
+        files["etc/yarn-tune/rack-%d.rc" % rack] = \
+            "# rack {r}: {t}, {n} VMs of {m} MB and {c} cpus\n".format(
+                r=rack, t=instance_type, n=vms, m=vm_mem, c=vm_cpus) + \
+            "".join("%s=\"%s\"\n" % (key, value) for (key, value) in profile)
+    return files
+
+
+# Where yarn-ec2 keeps the sha256 of the artifacts that artifacts.txt leaves
+# unpinned, as "<sha256>  <file>" lines. Each is recorded from the first
+# master or bake instance that downloaded the file over https, and deployed
+# to every later cluster, whose nodes then check the file against it.
+ARTIFACT_PINS_FILE = os.path.join(os.path.expanduser("~"), ".yarn-ec2", "artifacts.sha256")
+
+
+def load_artifact_pins():
+    pins = {}
+    if os.path.exists(ARTIFACT_PINS_FILE):
+        with open(ARTIFACT_PINS_FILE) as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) == 2:
+                    pins[fields[1]] = fields[0]
+    return pins
+
+
+# Record the sha256 of the artifacts a node has downloaded (see
+# fetch-artifacts.sh) for those not pinned yet. Pins already recorded are
+# never replaced, so a file that changed upstream fails its check instead.
+def record_artifact_pins(host, opts):
+    pins = load_artifact_pins()
+    known = len(pins)
+    sums = ssh_read(host, opts, "cat /opt/tarfiles/*.sha256 2>/dev/null || :", force_root=True)
+    for line in sums.decode("utf-8").splitlines():
+        fields = line.split()
+        if len(fields) == 2 and re.match(r"^[0-9a-f]{64}$", fields[0]):
+            pins.setdefault(fields[1], fields[0])
+    if len(pins) > known:
+        if not os.path.isdir(os.path.dirname(ARTIFACT_PINS_FILE)):
+            os.makedirs(os.path.dirname(ARTIFACT_PINS_FILE))
+        with open(ARTIFACT_PINS_FILE + ".tmp", "w") as f:
+            f.write("".join("%s  %s\n" % (pins[name], name) for name in sorted(pins)))
+        os.rename(ARTIFACT_PINS_FILE + ".tmp", ARTIFACT_PINS_FILE)
+        print("Recorded the sha256 of {n} artifacts in {f}".format(
+            n=len(pins) - known, f=ARTIFACT_PINS_FILE))
+
+
+# Render the configuration file templates in a given local directory,
+# filling in any template parameters with information about the cluster
+# (e.g. lists of masters and slaves).
+# root_dir should be an absolute path to the directory with the files we want to deploy.
+# Returns a dict mapping paths (relative to /root) to their rendered content.
+def render_deploy_files(root_dir, opts, cluster_name, master_nodes, slave_nodes):
     master_addresses = [get_dns_name(i, True) for i in master_nodes]
     slave_addresses = [get_dns_name(i, True) for i in slave_nodes]
 
+    vm_topology_text = get_vm_topology_text(opts, root_dir)
+    net_model = parse_net_model(vm_topology_text)
+    topology = get_cluster_topology(
+        master_nodes, slave_nodes, parse_vm_topology(vm_topology_text), net_model)
+    with open(os.path.join(get_state_dir(opts, cluster_name), "topology.txt"), "w") as f:
+        f.write(topology)
+
     # Instantiate templates
     template_vars = {
         "master_list": '\n'.join(master_addresses),
         "slave_list": '\n'.join(slave_addresses),
-        "rack0": '\n'.join(get_secondary_ip_addresses(master_nodes[0])),
-        "rack1": '',
-        "rack2": '',
-        "rack3": '',
-        "rack4": '',
+        "topology": topology,
+        "bake_hash": get_bake_hash(),
     }
 
-    for i in xrange(0, len(slave_nodes)):
-        template_vars['rack' + str(i + 1)] = '\n'.join(get_secondary_ip_addresses(slave_nodes[i]))
+    # Substitute all template parameters in a single pass over each file
+    template_re = re.compile(
+        r"\{\{(" + "|".join(re.escape(key) for key in template_vars) + r")\}\}")
 
-    # Create a temp directory in which we will place all the files to be
-    # deployed after we substitute template parameters in them
-    tmp_dir = tempfile.mkdtemp()
+    rendered = {}
     for path, dirs, files in os.walk(root_dir):
         if path.find(".svn") == -1:
-            dest_dir = os.path.join('/', path[len(root_dir):])
-            local_dir = tmp_dir + dest_dir
-            if not os.path.exists(local_dir):
-                os.makedirs(local_dir)
+            dest_dir = path[len(root_dir):].lstrip('/')
             for filename in files:
                 if filename[0] not in '#.~' and filename[-1] != '~':
-                    dest_file = os.path.join(dest_dir, filename)
-                    local_file = tmp_dir + dest_file
-                    with open(os.path.join(path, filename)) as src:
-                        with open(local_file, "w") as dest:
-                            text = src.read()
-                            for key in template_vars:
-                                text = text.replace("{{" + key + "}}", template_vars[key])
-                            dest.write(text)
-                            dest.close()
-    # rsync the whole directory over to the master machine
-    command = [
-        'rsync', '-rv',
-        '-e', stringify_command(ssh_command(opts)),
-        "%s/" % tmp_dir,
-        "%s@%s:/root" % ("root", active_master)
-    ]
-    subprocess.check_call(command)
-    # Remove the temp directory we created above
-    shutil.rmtree(tmp_dir)
+                    with codecs.open(os.path.join(path, filename), encoding="utf-8") as src:
+                        text = template_re.sub(lambda m: template_vars[m.group(1)], src.read())
+                    rendered[os.path.join(dest_dir, filename)] = text.encode("utf-8")
+    rendered["etc/yarn-topo.txt"] = vm_topology_text.encode("utf-8")
+    pins = load_artifact_pins()
+    rendered["etc/yarn-artifacts.sha256"] = "".join(
+        "%s  %s\n" % (pins[name], name) for name in sorted(pins)).encode("utf-8")
+    for dest, text in compile_net_model(topology, net_model).items():
+        rendered[dest] = text.encode("utf-8")
+    for dest, text in compile_tuning_profile(topology, master_nodes + slave_nodes).items():
+        rendered[dest] = text.encode("utf-8")
+    return rendered
+
+
+# Get the manifest (sha1 and path of every file) of a set of rendered files
+def get_deploy_manifest(rendered):
+    return "".join("%s  %s\n" % (hashlib.sha1(rendered[dest]).hexdigest(), dest)
+                   for dest in sorted(rendered))
+
+
+# Deploy the configuration file templates in a given local directory to
+# a cluster, rendered by render_deploy_files() unless already rendered.
+# Files are only deployed to the first master instance in the cluster, and
+# we expect the setup script to be run on that instance to copy them to
+# other nodes.
+#
+# Files are rendered in memory and streamed to the master as a single tar
+# archive over ssh. The sha1 of every deployed file is kept on the master in
+# DEPLOY_MANIFEST, and files whose content has not changed since the
+# previous deploy are not sent again.
+#
+# Returns the list of deployed paths (relative to /root) that changed.
+def deploy_files(conn, root_dir, opts, cluster_name, master_nodes, slave_nodes, rendered=None):
+    print("Deploying files to master...")
+    active_master = get_dns_name(master_nodes[0], opts.private_ips)
+    if rendered is None:
+        rendered = render_deploy_files(root_dir, opts, cluster_name, master_nodes, slave_nodes)
+
+    checksums = dict((dest, hashlib.sha1(data).hexdigest()) for dest, data in rendered.items())
+    deployed = {}
+    for line in ssh_read(active_master, opts, "cat /root/%s 2>/dev/null || :" % DEPLOY_MANIFEST,
+                         force_root=True).decode("utf-8").splitlines():
+        if line.strip():
+            (checksum, dest) = line.split(None, 1)
+            deployed[dest] = checksum
+    changed = sorted(dest for dest in rendered if deployed.get(dest) != checksums[dest])
+    if not changed:
+        print("All {n} files are up to date".format(n=len(rendered)))
+        return changed
+
+    # Stream the changed files and the new manifest to the master as one tar archive
+    files = dict((dest, rendered[dest]) for dest in changed)
+    files[DEPLOY_MANIFEST] = get_deploy_manifest(rendered).encode("utf-8")
+    print("Sending {c} of {n} files".format(c=len(changed), n=len(rendered)))
+    ssh_write(active_master, opts, ['tar', 'x', '-C', '/root'], make_tar(files),
+              force_root=True)
+    return changed
+
+
+# Get an in-memory tar archive of a dict mapping paths to file contents
+def make_tar(files):
+    archive = io.BytesIO()
+    tar = tarfile.open(fileobj=archive, mode="w")
+    for path in sorted(files):
+        info = tarfile.TarInfo(path)
+        info.size = len(files[path])
+        info.mode = 0o644
+        info.mtime = time.time()
+        tar.addfile(info, io.BytesIO(files[path]))
+    tar.close()
+    return archive.getvalue()
+
+
+# Where deploy_files() keeps the checksums of the last deployed files on the master
+DEPLOY_MANIFEST = "var/yarn-ec2-deploy.sha1"
 
 
 def stringify_command(parts):
@@ -1097,11 +2265,46 @@ def stringify_command(parts):
         return ' '.join(map(pipes.quote, parts))
 
 
+# Directory holding the ControlMaster sockets of this yarn-ec2 process
+ssh_control_dir = None
+ssh_control_lock = threading.Lock()
+
+
+# Get (creating it on first use) the directory for multiplexed ssh connections.
+# The master connections are closed and the directory removed at exit.
+def get_ssh_control_dir():
+    global ssh_control_dir
+    with ssh_control_lock:
+        if ssh_control_dir is None:
+            # keep the path short: unix socket paths are limited to ~100 chars
+            ssh_control_dir = tempfile.mkdtemp(prefix="yarn-ec2-", dir="/tmp")
+            atexit.register(close_ssh_connections)
+    return ssh_control_dir
+
+
+def close_ssh_connections():
+    global ssh_control_dir
+    if ssh_control_dir is None:
+        return
+    with open(os.devnull, 'wb') as devnull:
+        for sock in os.listdir(ssh_control_dir):
+            subprocess.call(
+                ['ssh', '-o', 'ControlPath=' + os.path.join(ssh_control_dir, sock), '-O', 'exit', 'x'],
+                stdout=devnull, stderr=devnull)
+    shutil.rmtree(ssh_control_dir, ignore_errors=True)
+    ssh_control_dir = None
+
+
 def ssh_args(opts):
     parts = []
 
     parts += ['-o', 'StrictHostKeyChecking=no']
     parts += ['-o', 'UserKnownHostsFile=/dev/null']
+    if not opts.no_ssh_multiplexing:
+        # One master connection per user@host:port, shared by all later commands
+        parts += ['-o', 'ControlMaster=auto']
+        parts += ['-o', 'ControlPath=' + os.path.join(get_ssh_control_dir(), '%C')]
+        parts += ['-o', 'ControlPersist=10m']
     if opts.identity_file is not None:
         parts += ['-i', opts.identity_file]
     return parts
@@ -1111,15 +2314,31 @@ def ssh_command(opts):
     return ['ssh'] + ssh_args(opts)
 
 
+# Get the delay before retry number `attempt` (counting from 0): exponential
+# backoff capped at `cap` seconds, half of which is randomized so that
+# concurrent callers do not retry in lockstep.
+def get_backoff_delay(attempt, base=1.0, cap=30.0):
+    delay = min(cap, base * (2 ** attempt))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
 # Run a command on a host through ssh, retrying up to five times
 # and then throwing an exception if ssh continues to fail.
-def ssh(host, opts, command, force_root=False):
+# Pass tty=False when several commands may run at once, so that they
+# do not fight over the local terminal.
+def ssh(host, opts, command, force_root=False, tty=True):
     tries = 0
     while True:
         try:
-            return subprocess.check_call(
-                ssh_command(opts) + ['-t', '-t', '%s@%s' % ('root' if force_root else opts.user, host),
-                                     stringify_command(command)])
+            with tracer.span("ssh", host=host, command=stringify_command(command), tries=tries):
+                user_host = '%s@%s' % ('root' if force_root else opts.user, host)
+                if tty:
+                    return subprocess.check_call(
+                        ssh_command(opts) + ['-t', '-t', user_host, stringify_command(command)])
+                with open(os.devnull, 'rb') as devnull:
+                    return subprocess.check_call(
+                        ssh_command(opts) + [user_host, stringify_command(command)],
+                        stdin=devnull)
         except subprocess.CalledProcessError as e:
             if tries > 5:
                 # If this was an ssh failure, provide the user with hints.
@@ -1130,9 +2349,10 @@ def ssh(host, opts, command, force_root=False):
                         "--key-pair parameters and try again.".format(host))
                 else:
                     raise e
-            print("Error executing remote command, retrying after 30 seconds: {0}".format(e),
-                  file=stderr)
-            time.sleep(30)
+            delay = get_backoff_delay(tries)
+            print("Error executing remote command, retrying after {d:.1f} seconds: {e}".format(
+                d=delay, e=e), file=stderr)
+            time.sleep(delay)
             tries = tries + 1
 
 
@@ -1151,31 +2371,98 @@ def _check_output(*popenargs, **kwargs):
     return output
 
 
-def ssh_read(host, opts, command):
-    return _check_output(
-        ssh_command(opts) + ['%s@%s' % (opts.user, host), stringify_command(command)])
+def ssh_read(host, opts, command, force_root=False):
+    with tracer.span("ssh_read", host=host, command=stringify_command(command)):
+        return _check_output(
+            ssh_command(opts) + ['%s@%s' % ('root' if force_root else opts.user, host),
+                                 stringify_command(command)])
 
 
-def ssh_write(host, opts, command, arguments):
+def ssh_write(host, opts, command, arguments, force_root=False):
     tries = 0
     while True:
-        proc = subprocess.Popen(
-            ssh_command(opts) + ['%s@%s' % (opts.user, host), stringify_command(command)],
-            stdin=subprocess.PIPE)
-        proc.stdin.write(arguments)
-        proc.stdin.close()
-        status = proc.wait()
+        with tracer.span("ssh_write", host=host, command=stringify_command(command),
+                         tries=tries, bytes=len(arguments)):
+            proc = subprocess.Popen(
+                ssh_command(opts) + ['%s@%s' % ('root' if force_root else opts.user, host),
+                                     stringify_command(command)],
+                stdin=subprocess.PIPE)
+            proc.stdin.write(arguments)
+            proc.stdin.close()
+            status = proc.wait()
         if status == 0:
             break
         elif tries > 5:
             raise RuntimeError("ssh_write failed with error %s" % proc.returncode)
         else:
-            print("Error {0} while executing remote command, retrying after 30 seconds".
-                  format(status), file=stderr)
-            time.sleep(30)
+            delay = get_backoff_delay(tries)
+            print("Error {0} while executing remote command, retrying after {1:.1f} seconds".
+                  format(status, delay), file=stderr)
+            time.sleep(delay)
             tries = tries + 1
 
 
+# Run fn(host) for every host on a bounded pool of worker threads.
+# Returns a dict mapping each host to the value returned by fn. Once a call
+# fails no new work is started, and a ParallelExecutionError summarizing
+# every failure is raised after the calls already in flight have finished.
+def run_parallel(hosts, fn, parallelism):
+    pending = list(reversed(hosts))
+    results = {}
+    errors = {}
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                if errors or not pending:
+                    return
+                host = pending.pop()
+            try:
+                result = fn(host)
+            except Exception as e:
+                with lock:
+                    errors[host] = e
+            else:
+                with lock:
+                    results[host] = result
+
+    workers = [threading.Thread(target=worker)
+               for _ in xrange(min(max(parallelism, 1), len(pending)))]
+    for t in workers:
+        t.daemon = True
+        t.start()
+    for t in workers:
+        # join with a timeout so that Ctrl-C is still delivered to the main thread
+        while t.is_alive():
+            t.join(0.5)
+
+    if errors:
+        raise ParallelExecutionError(results, errors)
+    return results
+
+
+def parallel_ssh(hosts, opts, command, force_root=False):
+    return run_parallel(
+        hosts,
+        lambda host: ssh(host, opts, command, force_root=force_root, tty=False),
+        opts.ssh_parallelism)
+
+
+def parallel_ssh_read(hosts, opts, command):
+    return run_parallel(
+        hosts,
+        lambda host: ssh_read(host, opts, command),
+        opts.ssh_parallelism)
+
+
+def parallel_ssh_write(hosts, opts, command, arguments):
+    return run_parallel(
+        hosts,
+        lambda host: ssh_write(host, opts, command, arguments),
+        opts.ssh_parallelism)
+
+
 # Gets a list of zones to launch instances in
 def get_zones(conn, opts):
     if opts.zone == 'all':
@@ -1219,12 +2506,205 @@ def get_dns_name(instance, private_ips=False):
     return dns
 
 
+# Where monitor_cluster() writes the samples taken on a cluster's nodes, in its state directory
+MONITOR_FILE = "monitor.tsv"
+
+# Counters of each kind of sample taken by ymon (see exec/ymon), after its time, kind and name
+MONITOR_COLUMNS = {
+    "vm": ["cpus", "cpu_ns", "mem_bytes", "mem_limit_bytes", "mem_failcnt"],
+    "tc": ["bytes", "packets", "drops", "overlimits"],
+    "disk": ["reads", "read_sectors", "writes", "write_sectors", "io_ms"],
+    "daemon": ["cpu_ms", "rss_bytes"],
+}
+
+# Peak cpu (% of the cpuset) or memory (% of the limit) use at which a container counts as throttled
+MONITOR_SATURATION = 90
+
+
+# Sample the containers, htb classes, disk and daemons of every cluster node with ymon, one
+# streaming ssh connection per node, into MONITOR_FILE as tab-separated lines of the sample
+# time, the node's rack, the kind and name of what was sampled and its counters. Runs for
+# --monitor-duration seconds, or until interrupted, and then prints a summary.
+def monitor_cluster(opts, cluster_name, master_nodes, slave_nodes):
+    hosts = [get_dns_name(i, opts.private_ips) for i in master_nodes + slave_nodes]
+    racks = dict(zip(hosts, get_cluster_racks(master_nodes + slave_nodes)))
+    monitor_file = os.path.join(get_state_dir(opts, cluster_name), MONITOR_FILE)
+    interval = max(opts.monitor_interval, 1)
+    samples = max(opts.monitor_duration // interval, 1) if opts.monitor_duration > 0 else 0
+    command = "ymon {i} {n}".format(i=interval, n=samples)
+    procs = {}
+    lock = threading.Lock()
+    stopped = threading.Event()
+
+    with open(monitor_file, "w") as out:
+        for kind in sorted(MONITOR_COLUMNS):
+            out.write("# time\track\t{k}\tname\t{c}\n".format(
+                k=kind, c="\t".join(MONITOR_COLUMNS[kind])))
+
+        def stream(host):
+            proc = subprocess.Popen(ssh_command(opts) + ['root@' + host, command],
+                                    stdout=subprocess.PIPE)
+            with lock:
+                procs[host] = proc
+            for line in iter(proc.stdout.readline, b""):
+                (ts, sample) = line.decode("utf-8").split("\t", 1)
+                with lock:
+                    if not stopped.is_set():
+                        out.write("{t}\t{r}\t{s}".format(t=ts, r=racks[host], s=sample))
+            return proc.wait()
+
+        print("Sampling {n} nodes every {i} seconds into {f}{u}...".format(
+            n=len(hosts), i=interval, f=monitor_file,
+            u=" (Ctrl-C to stop)" if samples == 0 else " for %d seconds" % (samples * interval)))
+        failed = []
+        try:
+            failed = [h for h, status in run_parallel(hosts, stream, len(hosts)).items() if status]
+        except KeyboardInterrupt:
+            print("")
+        except ParallelExecutionError as e:
+            failed = list(e.errors)
+        finally:
+            with lock:
+                stopped.set()
+                for proc in procs.values():
+                    if proc.poll() is None:
+                        proc.terminate()
+
+    if failed:
+        print("WARNING: could not sample {n} nodes: {h}".format(
+            n=len(failed), h=", ".join(sorted(failed))), file=stderr)
+    print_monitor_summary(monitor_file)
+
+
+# Summarize the samples of one container, htb class, disk or daemon, given as a list of
+# (time, counters) tuples. Returns a tuple of its label, its peak use (for sorting), a
+# description of its average and peak use, and the throttling it hit, if any.
+def summarize_monitor_series(kind, rack, name, samples):
+    columns = MONITOR_COLUMNS[kind]
+    spans = [(t1 - t0, v0, v1) for (t0, v0), (t1, v1) in zip(samples, samples[1:]) if t1 > t0]
+
+    # Average and peak per-second rate of a counter, times scale
+    def rate(column, scale=1.0):
+        i = columns.index(column)
+        # counters start over when a container or daemon restarts
+        rates = [(v1[i] - v0[i]) * scale / dt for dt, v0, v1 in spans if v1[i] >= v0[i]]
+        return (sum(rates) / len(rates), max(rates)) if rates else (0.0, 0.0)
+
+    def increase(column):
+        i = columns.index(column)
+        return sum(max(v1[i] - v0[i], 0) for _, v0, v1 in spans)
+
+    throttled = []
+    if kind == "vm":
+        (cpu, cpu_peak) = rate("cpu_ns", 100 / 1e9 / max(samples[-1][1][0], 1))
+        mem_peak = max([100.0 * v[2] / v[3] for _, v in samples if v[3]] or [0])
+        if cpu_peak >= MONITOR_SATURATION:
+            throttled.append("cpuset saturated")
+        if mem_peak >= MONITOR_SATURATION:
+            throttled.append("memory near its limit")
+        if increase("mem_failcnt"):
+            throttled.append("memory limit hit {n} times".format(n=increase("mem_failcnt")))
+        return (name, max(cpu_peak, mem_peak),
+                "cpu {c:5.1f}% avg {p:5.1f}% peak   mem {m:5.1f}% peak".format(
+                    c=cpu, p=cpu_peak, m=mem_peak), throttled)
+    elif kind == "tc":
+        # htb class 1:1 shapes the whole rack, and 1:<host + 10, in hex> each of its vms
+        minor = int(name.split(":")[-1], 16)
+        if minor == 1:
+            label = "r{r} uplink".format(r=rack)
+        else:
+            label = "r{r}h{h}".format(r=rack, h=minor - 10)
+        (mbit, mbit_peak) = rate("bytes", 8 / 1e6)
+        if increase("drops"):
+            throttled.append("{n} packets dropped".format(n=increase("drops")))
+        if increase("overlimits"):
+            throttled.append("{n} overlimits".format(n=increase("overlimits")))
+        return (label, mbit_peak, "{a:8.1f} Mbit/s avg {p:8.1f} Mbit/s peak".format(
+            a=mbit, p=mbit_peak), throttled)
+    elif kind == "disk":
+        read = rate("read_sectors", 512 / 1e6)[0]
+        write = rate("write_sectors", 512 / 1e6)[0]
+        (util, util_peak) = rate("io_ms", 100 / 1e3)
+        if util_peak >= MONITOR_SATURATION:
+            throttled.append("disk saturated")
+        return ("r{r} {n}".format(r=rack, n=name), util_peak,
+                "read {r:6.1f} MB/s write {w:6.1f} MB/s avg   busy {u:5.1f}% avg {p:5.1f}% "
+                "peak".format(r=read, w=write, u=util, p=util_peak), throttled)
+    else:
+        (cpu, cpu_peak) = rate("cpu_ms", 100 / 1e3)
+        rss_peak = max(v[1] for _, v in samples) / 2 ** 20
+        return ("r{r} {n}".format(r=rack, n=name), cpu_peak,
+                "cpu {c:5.1f}% avg {p:5.1f}% peak   rss {m:.0f} MB peak".format(
+                    c=cpu, p=cpu_peak, m=rss_peak), throttled)
+
+
+# Print the summary of a monitor file: for each kind of sample, whatever was throttled
+# and the busiest of the rest
+def print_monitor_summary(monitor_file, busiest=10):
+    series = {}
+    with open(monitor_file) as f:
+        for line in f:
+            fields = line.rstrip("\n").split("\t")
+            if line.startswith("#") or len(fields) < 4 or fields[2] not in MONITOR_COLUMNS:
+                continue
+            (ts, rack, kind, name) = fields[:4]
+            counters = [int(v) if v.isdigit() else 0 for v in fields[4:]]
+            counters += [0] * (len(MONITOR_COLUMNS[kind]) - len(counters))
+            series.setdefault((kind, int(rack), name), []).append((int(ts), counters))
+
+    titles = [("vm", "Containers (cpu % of cpuset, memory % of limit)"),
+              ("tc", "Traffic shaping classes"),
+              ("disk", "Disks"),
+              ("daemon", "Daemons")]
+    for kind, title in titles:
+        rows = sorted(
+            (summarize_monitor_series(kind, rack, name, sorted(samples))
+             for (k, rack, name), samples in series.items() if k == kind),
+            key=lambda row: (not row[3], -row[1]))
+        if not rows:
+            continue
+        num_throttled = len([row for row in rows if row[3]])
+        print("{t}: {n} sampled, {m} throttled".format(t=title, n=len(rows), m=num_throttled))
+        for (label, _, usage, throttled) in rows[:max(num_throttled, busiest)]:
+            print("  {l:<16}{u}{t}".format(
+                l=label, u=usage, t="   THROTTLED: " + ", ".join(throttled) if throttled else ""))
+        if len(rows) > max(num_throttled, busiest):
+            print("  ...")
+    if not series:
+        print("No samples were taken")
+
+
+# Actions that only read a cluster's topology, and may use the local cache
+READ_ONLY_ACTIONS = ["get-master", "login", "status", "monitor"]
+
+
+def run_read_only_action(action, opts, cluster_name, master_nodes, slave_nodes):
+    if action == "status":
+        for role, instances in (("master", master_nodes), ("slave", slave_nodes)):
+            for inst in instances:
+                print("{r:<8}{i:<22}{t:<14}{s:<10}{d}".format(
+                    r=role, i=inst.id, t=inst.instance_type, s=inst.state,
+                    d=(inst.public_dns_name if not opts.private_ips else
+                       inst.private_ip_address) or "-"))
+    elif not master_nodes[0].public_dns_name and not opts.private_ips:
+        print("Master has no public DNS name.  Maybe you meant to specify --private-ips?")
+    elif action == "get-master":
+        print(get_dns_name(master_nodes[0], opts.private_ips))
+    elif action == "monitor":
+        monitor_cluster(opts, cluster_name, master_nodes, slave_nodes)
+    else:
+        master = get_dns_name(master_nodes[0], opts.private_ips)
+        print("Logging into master " + master + "...")
+        proxy_opt = []
+        if opts.proxy_port is not None:
+            proxy_opt = ['-D', opts.proxy_port]
+        subprocess.check_call(
+            ssh_command(opts) + proxy_opt + ['-t', '-t', "%s@%s" % (opts.user, master)])
+
+
 def real_main():
     (opts, action, cluster_name) = parse_args()
 
-    # Input parameter validation
-    get_validate_yarn_version(opts.yarn_version, opts.yarn_git_repo)
-
     # Ensure identity file
     if opts.identity_file is not None:
         if not os.path.exists(opts.identity_file):
@@ -1239,27 +2719,45 @@ def real_main():
                   file=stderr)
             sys.exit(1)
 
-    if opts.instance_type not in EC2_INSTANCE_TYPES:
+    if action == "plan":
+        (vm_topology_text, secondary_ips) = plan_vm_topology(opts)
+        print("# yarn-topo.txt")
+        sys.stdout.write(vm_topology_text)
+        print("# launch with --auto-topology, or --secondary-ips={n}".format(n=secondary_ips))
+        return
+
+    # Read-only actions are answered from the local cache when possible
+    if action in READ_ONLY_ACTIONS and not opts.no_cache:
+        cached = get_cached_cluster(opts, cluster_name)
+        if cached is not None:
+            (master_nodes, slave_nodes) = cached
+            run_read_only_action(action, opts, cluster_name, master_nodes, slave_nodes)
+            return
+
+    # Input parameter validation
+    get_validate_yarn_version(opts.yarn_version, opts.yarn_git_repo)
+
+    slave_info = get_instance_info(opts.instance_type)
+    if slave_info is None:
         print("Warning: Unrecognized EC2 instance type for instance-type: {t}".format(
             t=opts.instance_type), file=stderr)
 
         if opts.master_instance_type != "":
-            if opts.master_instance_type not in EC2_INSTANCE_TYPES:
+            if get_instance_info(opts.master_instance_type) is None:
                 print("Warning: Unrecognized EC2 instance type for master-instance-type: {t}".format(
                     t=opts.master_instance_type), file=stderr)
-        # Since we try instance types even if we can't resolve them, we check if they resolve first
-        # and, if they do, see if they resolve to the same VM type.
-        if opts.instance_type in EC2_INSTANCE_TYPES and \
-                        opts.master_instance_type in EC2_INSTANCE_TYPES:
-            if EC2_INSTANCE_TYPES[opts.instance_type] != \
-                    EC2_INSTANCE_TYPES[opts.master_instance_type]:
-                print("Error: yarn-ec2 currently does not support having a master and slaves "
-                      "with different AMI virtualization types.", file=stderr)
-                print("master instance virtualization type: {t}".format(
-                    t=EC2_INSTANCE_TYPES[opts.master_instance_type]), file=stderr)
-                print("slave instance virtualization type: {t}".format(
-                    t=EC2_INSTANCE_TYPES[opts.instance_type]), file=stderr)
-                sys.exit(1)
+    # Since we try instance types even if we can't resolve them, we check if they resolve first
+    # and, if they do, see if they resolve to the same VM type.
+    master_info = get_instance_info(opts.master_instance_type)
+    if slave_info is not None and master_info is not None:
+        if slave_info["virtualization"] != master_info["virtualization"]:
+            print("Error: yarn-ec2 currently does not support having a master and slaves "
+                  "with different AMI virtualization types.", file=stderr)
+            print("master instance virtualization type: {t}".format(
+                t=master_info["virtualization"]), file=stderr)
+            print("slave instance virtualization type: {t}".format(
+                t=slave_info["virtualization"]), file=stderr)
+            sys.exit(1)
 
     # Prevent breaking ami_prefix (/, .git and startswith checks)
     # Prevent forks with non yarn-ec2 names for now.
@@ -1284,53 +2782,43 @@ def real_main():
     if opts.zone == "":
         opts.zone = random.choice(conn.get_all_zones()).name
 
+    if opts.auto_topology:
+        opts.secondary_ips = plan_vm_topology(opts)[1]
+
     if action == "launch":
         if opts.slaves <= 0:
             opts.slaves = 0
         if opts.resume:
             (master_nodes, slave_nodes) = get_existing_cluster(conn, opts, cluster_name)
         else:
-            (master_nodes, slave_nodes) = launch_cluster(conn, opts, cluster_name)
+            with tracer.span("launch-instances"):
+                (master_nodes, slave_nodes) = launch_cluster(conn, opts, cluster_name)
         wait_for_cluster_state(
             conn=conn,
             opts=opts,
             cluster_instances=(master_nodes + slave_nodes),
             cluster_state='ssh-ready'
         )
-        reassign_cluster_ips(
-            conn=conn,
-            master_nodes=master_nodes,
-            slave_nodes=slave_nodes,
-            opts=opts,
-            cluster_name=cluster_name
-        )
-        setup_cluster(
-            conn=conn,
-            master_nodes=master_nodes,
-            slave_nodes=slave_nodes,
-            opts=opts,
-            deploy_ssh_key=True
-        )
+        save_cluster_cache(opts, cluster_name, master_nodes, slave_nodes)
+        try:
+            setup_cluster(
+                conn=conn,
+                master_nodes=master_nodes,
+                slave_nodes=slave_nodes,
+                opts=opts,
+                cluster_name=cluster_name,
+                deploy_ssh_key=True
+            )
+        finally:
+            save_trace(opts, cluster_name, master_nodes + slave_nodes)
 
-    elif action == "get-master":
+    elif action in READ_ONLY_ACTIONS:
         (master_nodes, slave_nodes) = get_existing_cluster(conn, opts, cluster_name)
-        if not master_nodes[0].public_dns_name and not opts.private_ips:
-            print("Master has no public DNS name.  Maybe you meant to specify --private-ips?")
-        else:
-            print(get_dns_name(master_nodes[0], opts.private_ips))
+        run_read_only_action(action, opts, cluster_name, master_nodes, slave_nodes)
 
-    elif action == "login":
-        (master_nodes, slave_nodes) = get_existing_cluster(conn, opts, cluster_name)
-        if not master_nodes[0].public_dns_name and not opts.private_ips:
-            print("Master has no public DNS name.  Maybe you meant to specify --private-ips?")
-        else:
-            master = get_dns_name(master_nodes[0], opts.private_ips)
-            print("Logging into master " + master + "...")
-            proxy_opt = []
-            if opts.proxy_port is not None:
-                proxy_opt = ['-D', opts.proxy_port]
-            subprocess.check_call(
-                ssh_command(opts) + proxy_opt + ['-t', '-t', "%s@%s" % (opts.user, master)])
+    elif action == "refresh-cache":
+        # Started in the background by get_cached_cluster()
+        get_existing_cluster(conn, opts, cluster_name, die_on_error=False)
 
     elif action == "stop":
         response = raw_input(
@@ -1357,6 +2845,7 @@ def real_main():
                         inst.terminate()
                     else:
                         inst.stop()
+            invalidate_cluster_cache(opts, cluster_name)
 
     elif action == "start":
         (master_nodes, slave_nodes) = get_existing_cluster(conn, opts, cluster_name)
@@ -1374,20 +2863,18 @@ def real_main():
             cluster_instances=(master_nodes + slave_nodes),
             cluster_state='ssh-ready'
         )
-        reassign_cluster_ips(
-            conn=conn,
-            master_nodes=master_nodes,
-            slave_nodes=slave_nodes,
-            opts=opts,
-            cluster_name=cluster_name
-        )
-        setup_cluster(
-            conn=conn,
-            master_nodes=master_nodes,
-            slave_nodes=slave_nodes,
-            opts=opts,
-            deploy_ssh_key=True
-        )
+        save_cluster_cache(opts, cluster_name, master_nodes, slave_nodes)
+        try:
+            setup_cluster(
+                conn=conn,
+                master_nodes=master_nodes,
+                slave_nodes=slave_nodes,
+                opts=opts,
+                cluster_name=cluster_name,
+                deploy_ssh_key=True
+            )
+        finally:
+            save_trace(opts, cluster_name, master_nodes + slave_nodes)
 
         # Determine types of running instances
         existing_master_type = master_nodes[0].instance_type
@@ -1400,90 +2887,37 @@ def real_main():
         opts.instance_type = existing_slave_type
 
     elif action == "destroy":
-        (master_nodes, slave_nodes) = get_existing_cluster(
-            conn, opts, cluster_name, die_on_error=False)
+        destroy_cluster(conn, opts, cluster_name)
 
-        if any(master_nodes + slave_nodes):
-            print("The following instances will be terminated:")
-            for inst in master_nodes + slave_nodes:
-                print("> %s" % get_dns_name(inst, opts.private_ips))
 
-            print("ALL DATA ON ALL INSTANCES WILL BE LOST!!")
+    elif action == "bake":
+        bake_image(conn, opts, cluster_name)
 
-            msg = "Are you sure you want to destroy the cluster {c}? (y/N) ".format(c=cluster_name)
-            response = raw_input(msg)
-            if response == "y":
-                if len(master_nodes) != 0:
-                    print("Terminating master...")
-                    for inst in master_nodes:
-                        inst.terminate()
-                    print("{m} instances terminated".format(m=len(master_nodes)))
-                if len(slave_nodes) != 0:
-                    print("Terminating slaves...")
-                    for inst in slave_nodes:
-                        inst.terminate()
-                    print("{s} instances terminated".format(s=len(slave_nodes)))
-
-                # Delete security groups as well
-                if opts.delete_groups:
-                    group_names = [cluster_name + "-master", cluster_name + "-slaves"]
-                    wait_for_cluster_state(
-                        conn=conn,
-                        opts=opts,
-                        cluster_instances=(master_nodes + slave_nodes),
-                        cluster_state='terminated'
-                    )
-                    print("Deleting security groups (this may take some time)...")
-                    attempt = 1
-                    while attempt <= 3:
-                        print("Attempt %d" % attempt)
-                        groups = [g for g in conn.get_all_security_groups() if g.name in group_names]
-                        success = True
-                        # Delete individual rules in all groups before deleting groups to
-                        # remove dependencies between them
-                        for group in groups:
-                            print("Deleting rules in security group " + group.name)
-                            for rule in group.rules:
-                                for grant in rule.grants:
-                                    success &= group.revoke(ip_protocol=rule.ip_protocol,
-                                                            from_port=rule.from_port,
-                                                            to_port=rule.to_port,
-                                                            src_group=grant)
-
-                        # Sleep for AWS eventual-consistency to catch up, and for instances
-                        # to terminate
-                        time.sleep(30)  # Yes, it does have to be this long :-(
-                        for group in groups:
-                            try:
-                                # It is needed to use group_id to make it work with VPC
-                                conn.delete_security_group(group_id=group.id)
-                                print("Deleted security group %s" % group.name)
-                            except boto.exception.EC2ResponseError:
-                                success = False
-                                print("Failed to delete security group %s" % group.name)
-
-                        # Unfortunately, group.revoke() returns True even if a rule was not
-                        # deleted, so this needs to be rerun if something fails
-                        if success:
-                            break
-
-                        attempt += 1
-
-                    if not success:
-                        print("Failed to delete all security groups after 3 tries.")
-                        print("Try re-running in a few minutes.")
-        else:
-            print("ERROR: cannot find any running instances, did you misspell '{c}'?".format(c=cluster_name))
-
-        print("")
-        print("!! To avoid unnecessary EC2 cost:")
-        print("-------------------------")
-        print("!! Please double-check AWS web console to")
-        print("!! ascertain the temination of all your instances")
-        print("!! at possibly many AWS regional data centers.")
-        print("")
-        print("Thanks.")
+    elif action == "add-slaves":
+        if opts.slaves <= 0:
+            raise UsageError("Must add at least 1 slave (-s)")
+        (master_nodes, slave_nodes) = get_existing_cluster(conn, opts, cluster_name)
+        # Nodes of clusters set up before rack ids existed keep their racks
+        assign_cluster_racks(conn, master_nodes + slave_nodes, opts)
+        with tracer.span("launch-instances"):
+            new_slaves = launch_cluster(conn, opts, cluster_name, add_slaves=True)[1]
+        wait_for_cluster_state(
+            conn=conn,
+            opts=opts,
+            cluster_instances=new_slaves,
+            cluster_state='ssh-ready'
+        )
+        slave_nodes = slave_nodes + new_slaves
+        save_cluster_cache(opts, cluster_name, master_nodes, slave_nodes)
+        try:
+            add_cluster_slaves(conn, master_nodes, slave_nodes, new_slaves, opts, cluster_name)
+        finally:
+            save_trace(opts, cluster_name, master_nodes + slave_nodes)
 
+    elif action == "remove-slaves":
+        (master_nodes, slave_nodes) = get_existing_cluster(conn, opts, cluster_name)
+        slave_nodes = remove_cluster_slaves(conn, master_nodes, slave_nodes, opts, cluster_name)
+        save_trace(opts, cluster_name, master_nodes + slave_nodes)
 
     else:
         print("Invalid action: %s" % action, file=stderr)